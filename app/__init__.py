@@ -6,10 +6,12 @@ from flask_bootstrap import Bootstrap
 from flask_login import LoginManager
 from flask_mail import Mail
 from flask_pagedown import PageDown
+from .utils.engine import engine_options, configure_engine
+from .utils import routing, http_cache, aio, query_stats, metrics, profiler, passwords
 
 moment = Moment()
 bootstrap = Bootstrap()
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': routing.RoutingSession})
 login_manager = LoginManager()
 login_manager.login_view = 'auth.login'
 mail = Mail()
@@ -20,14 +22,40 @@ def create_app(config_name):
     app = Flask(__name__)
     app.config.from_object(config[config_name])
     config[config_name].init_app(app)
+    app.config.setdefault(
+        'SQLALCHEMY_ENGINE_OPTIONS',
+        engine_options(app.config['SQLALCHEMY_DATABASE_URI'], app.config)
+    )
+    replica_url = app.config['READ_REPLICA_URL']
+    if replica_url:
+        app.config.setdefault('SQLALCHEMY_BINDS', {})[routing.REPLICA_BIND] = {
+            'url': replica_url, **engine_options(replica_url, app.config)
+        }
 
     moment.init_app(app)
     bootstrap.init_app(app)
     db.init_app(app)
+    with app.app_context():
+        configure_engine(db.engine, 'local', app.config)
+        if replica_url:
+            configure_engine(db.engines[routing.REPLICA_BIND], 'replica', app.config)
+    profiler.init_app(app)
+    query_stats.init_app(app, db)
+    metrics.init_app(app)
+    routing.init_app(app, db)
+    http_cache.init_app(app)
+    aio.init_app(app)
+    passwords.init_app(app)
     login_manager.init_app(app)
     mail.init_app(app)
     pagedown.init_app(app)
 
+    from .utils import consistency, ratelimit, profiles, live
+    live.init_app(app)
+    consistency.init_app(app)
+    ratelimit.init_app(app)
+    profiles.init_app(app)
+
     from .main import main as main_blueprint
     app.register_blueprint(main_blueprint)
 
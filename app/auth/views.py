@@ -7,7 +7,8 @@ from .. import db
 from app.email import send_email
 from flask_login import login_user, login_required, current_user, logout_user
 import random
-from app.utils.dual_db import register_user, confirm_user
+from app.utils.dual_db import register_user, confirm_user, update_password_hash
+from app.utils.passwords import HashingBusy
 
 
 @auth.before_app_request
@@ -85,7 +86,17 @@ def login():
         user = User.query.filter_by(email=form.email.data.lower()).first()
 
         # Check if the user exists and the entered password is correct
-        if user is not None and user.verify_password(form.password.data):
+        try:
+            verified = user is not None and user.verify_password(form.password.data)
+        except HashingBusy:
+            flash('We are busy signing people in, please try again in a moment.')
+            return render_template('auth/login.html', form=form), 503
+
+        if verified:
+            # Save the hash if it was upgraded to the current settings
+            if db.session.is_modified(user):
+                update_password_hash(user)
+
             login_user(user, True)   # Log in the user
 
             # Get the 'next' URL parameter from the request
@@ -144,11 +155,15 @@ def register():
             form.email.data[:5]) for _ in range(len(form.email.data[:5])))
 
         # Create a new User object with the submitted form data
-        user = User(
-            email=form.email.data.lower(),
-            username=username,
-            password=form.password.data
-        )
+        try:
+            user = User(
+                email=form.email.data.lower(),
+                username=username,
+                password=form.password.data
+            )
+        except HashingBusy:
+            flash('We are busy signing people up, please try again in a moment.')
+            return render_template('auth/signup.html', form=form), 503
 
         # Add the user to the database session and commit the changes
         register_user(
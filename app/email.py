@@ -1,37 +1,55 @@
-import os
-from threading import Thread
-import sib_api_v3_sdk
-from sib_api_v3_sdk.rest import ApiException
+import time
 from flask import current_app
+from app.utils.aio import background
+from app.utils import metrics
 
+BREVO_SEND_URL = 'https://api.brevo.com/v3/smtp/email'
 
-def send_async_email(app, subject, sender, recipients, text_body, html_body):
-    with app.app_context():
-        configuration = sib_api_v3_sdk.Configuration()
-        configuration.api_key['api-key'] = app.config["BREVO_API_KEY"]
+emails = metrics.counter(
+    'emails_total', 'Emails by result: sent, failed or suppressed.', ('result',))
+email_duration = metrics.histogram(
+    'email_send_duration_seconds', 'Time for Brevo to accept an email.')
+email_queue = metrics.gauge(
+    'email_queue_depth', 'Emails queued or being sent.')
 
-        api_instance = sib_api_v3_sdk.TransactionalEmailsApi(
-            sib_api_v3_sdk.ApiClient(configuration)
-        )
 
-        email = sib_api_v3_sdk.SendSmtpEmail(
-            sender={"email": sender},
-            to=[{"email": r} for r in recipients],
-            subject=subject,
-            html_content=html_body,
-            text_content=text_body,
-        )
+async def send_async_email(app, subject, sender, recipients, text_body, html_body):
+    # Brevo's transactional email API, awaited on the shared background loop
+    import httpx
+    client = await background.http()
+    email = {
+        "sender": {"email": sender},
+        "to": [{"email": r} for r in recipients],
+        "subject": subject,
+        "htmlContent": html_body,
+        "textContent": text_body,
+    }
 
-        try:
-            api_instance.send_transac_email(email)
-        except ApiException as e:
-            app.logger.error(f"Brevo email error: {e}")
+    started = time.perf_counter()
+    try:
+        response = await client.post(
+            BREVO_SEND_URL,
+            json=email,
+            headers={"api-key": app.config["BREVO_API_KEY"] or ""}
+        )
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        emails.inc('failed')
+        app.logger.error(f"Brevo email error: {e!r}")
+    else:
+        emails.inc('sent')
+    finally:
+        email_queue.dec()
+    email_duration.observe(time.perf_counter() - started)
 
 
 def send_email(subject, sender, recipients, text_body, html_body):
     app = current_app._get_current_object()
-    Thread(
-        target=send_async_email,
-        args=(app, subject, sender, recipients, text_body, html_body),
-        daemon=True
-    ).start()
+    if app.config['MAIL_SUPPRESS_SEND']:
+        emails.inc('suppressed')
+        app.logger.info(f"Email not sent (MAIL_SUPPRESS_SEND): {subject} to {recipients}")
+        return
+    email_queue.inc()
+    background.submit(
+        send_async_email(app, subject, sender, recipients, text_body, html_body)
+    )
@@ -1,5 +1,5 @@
 from . import main
-from flask import render_template
+from flask import render_template, jsonify, request
 
 
 @main.app_errorhandler(404)
@@ -7,6 +7,17 @@ def page_not_found(e):
     return render_template('404.html'), 404
 
 
+@main.app_errorhandler(429)
+def too_many_requests(e):
+    # likes, comments and follows are fetch() calls and get JSON; either
+    # way the client is told when to come back
+    headers = {'Retry-After': e.retry_after}
+    if request.accept_mimetypes.best == 'text/html':
+        return render_template('429.html', message=e.description,
+                               retry_after=e.retry_after), 429, headers
+    return jsonify({'error': e.description, 'retry_after': e.retry_after}), 429, headers
+
+
 @main.app_errorhandler(500)
 def internal_server_error(e):
     return render_template('500.html'), 500
@@ -5,23 +5,190 @@ from flask import (
     url_for,
     jsonify,
     request,
-    current_app
+    current_app,
+    send_file,
+    abort,
+    Response,
+    g
 )
 from . import main
 from flask_login import login_required, current_user
-from sqlalchemy import desc, or_, and_
+from sqlalchemy import func
 from sqlalchemy.orm import joinedload
 from .forms import PostForm, EditProfileForm
-from ..models import Post, User, Like, Comment
-from datetime import datetime
+from ..models import Post, User, Comment, Like, Follow, PostTag
 from .. import db
 from ..email import send_email
-from app.utils.dual_db import create_post, update_user_profile, toggle_like_remote, \
+from app.utils.dual_db import create_post, update_user_profile, queue_post_like, \
     create_comment, follow_user_remote, unfollow_user_remote
+from app.utils.routing import read_replica, pinned_to_primary
+from app.utils.pagination import paginate
+from app.utils.http_cache import conditional
+from app.utils.query_stats import query_budget
+from app.utils.ratelimit import rate_limit, sheds_load
+from app.utils import search as text_search
+from app.utils import profiles
+from app.utils.trending import get_trending
+from app.utils.ranking import get_ranker
+from app.utils.live import broker, event_stream, get_events
+from app.utils.avatar import avatar_url, cached_avatar_path, valid_avatar_request, \
+    avatar_mimetype, GRAVATAR_URL
+
+
+POSTS_PER_PAGE = 5
+# the user fields the feed and profile templates show
+PROFILE_COLUMNS = (User.id, User.name, User.username, User.headline,
+                   User.location, User.about_me, User.email, User.avatar_hash)
+
+
+def feed_order(ranked=False):
+    """Keyset columns of the feed: newest first, or highest score first."""
+    return (Post.rank_score, Post.id) if ranked else (Post.timestamp, Post.id)
+
+
+def ranked_feed():
+    # ?sort=top, scored by app/utils/ranking.py
+    if request.args.get("sort") != "top":
+        return False
+    get_ranker(current_app._get_current_object())
+    return True
+
+
+def post_page(cursor, author_id=None, ranked=False):
+    """One page of post cards (newest first), optionally for one author."""
+    query = Post.query.options(
+        joinedload(Post.author),
+        joinedload(Post.comments),
+        joinedload(Post.likes)
+    )
+    if author_id is not None:
+        query = query.filter_by(author_id=author_id)
+    return paginate(query, feed_order(ranked), cursor=cursor,
+                    limit=POSTS_PER_PAGE)
+
+
+def tag_page(tag, cursor):
+    """One page of a tag's posts, found through the (tag, timestamp, post_id) index."""
+    page = paginate(
+        db.session.query(PostTag.timestamp, PostTag.post_id).filter(PostTag.tag == tag),
+        (PostTag.timestamp, PostTag.post_id), cursor=cursor, limit=POSTS_PER_PAGE
+    )
+    post_ids = [row.post_id for row in page]
+    posts = {post.id: post for post in Post.query.options(joinedload(Post.author))
+             .filter(Post.id.in_(post_ids))}
+    page.items = [posts[post_id] for post_id in post_ids if post_id in posts]
+    return page
+
+
+def trending_tags():
+    return get_trending(current_app._get_current_object()).top()
+
+
+# VERSION TOKENS, see app/utils/http_cache.py
+def card_tokens(user):
+    return tuple(getattr(user, column.key, None) for column in PROFILE_COLUMNS)
+
+
+def feed_page():
+    """(ranked, page, comments, suggestions) for /feed, loaded once a request."""
+    if "feed_page" not in g:
+        # cursor based pagination, over time or score (?sort=top)
+        ranked = ranked_feed()
+        page = post_page(request.args.get("cursor"), ranked=ranked)
+        comments = Comment.query.filter(
+            Comment.post_id.in_([post.id for post in page.items])).all()
+        users = User.query.filter(User.id != current_user.id).limit(6).all()
+        g.feed_page = (ranked, page, comments, users)
+    return g.feed_page
+
+
+def counters(query, column):
+    """(count, max(column)) of ``query``'s rows, as two scalar subqueries."""
+    return (query.with_entities(func.count()).scalar_subquery(),
+            query.with_entities(func.max(column)).scalar_subquery())
+
+
+def feed_version():
+    """Cheap tokens that change whenever /feed would render differently.
+
+    Two small queries whatever the page holds: the page's posts (ids,
+    timestamps, like counts and scores, off the keyset index) and counters
+    of their comments, the viewer's likes on them, the viewer's follows
+    and the users suggested. Profile edits of other users show up with the
+    next change to the page; a browser that just wrote (see
+    app/utils/routing.py) is versioned from the rendered rows instead.
+    """
+    if pinned_to_primary():
+        return feed_rows_version()
+    ranked = ranked_feed()
+    viewer_id = current_user.id
+    page = paginate(db.session.query(Post.id, Post.timestamp, Post.like_count,
+                                     Post.rank_score, Post.author_id),
+                    feed_order(ranked), cursor=request.args.get("cursor"),
+                    limit=POSTS_PER_PAGE)
+    post_ids = [row.id for row in page]
+    counts = db.session.query(
+        *counters(Comment.query.filter(Comment.post_id.in_(post_ids)), Comment.id),
+        *counters(Like.query.filter(Like.author_id == viewer_id,
+                                    Like.post_id.in_(post_ids)), Like.id),
+        *counters(Follow.query.filter(Follow.follower_id == viewer_id), Follow.timestamp),
+        db.session.query(func.max(User.id)).scalar_subquery()
+    ).one()
+    last_modified = max((row.timestamp for row in page), default=None)
+    return last_modified, (ranked, [tuple(row) for row in page], page.next_cursor is not None,
+                           tuple(counts), card_tokens(current_user), trending_tags())
+
+
+def feed_rows_version():
+    """Tokens hashed from the rows /feed renders, loaded through feed_page()."""
+    ranked, page, comments, users = feed_page()
+    viewer_id = current_user.id
+    posts = [(post.id, post.timestamp, post.like_count, post.rank_score,
+              card_tokens(post.author),
+              any(like.author_id == viewer_id for like in post.likes))
+             for post in page.items]
+    following = db.session.query(Follow.followed_id) \
+        .filter(Follow.follower_id == viewer_id,
+                Follow.followed_id.in_([user.id for user in users])) \
+        .order_by(Follow.followed_id).all()
+    last_modified = max((post.timestamp for post in page.items), default=None)
+    return last_modified, (ranked, posts, page.next_cursor is not None,
+                           [(comment.id, comment.post_id) for comment in comments],
+                           card_tokens(current_user), [card_tokens(user) for user in users],
+                           [row.followed_id for row in following], trending_tags())
+
+
+def profile_page(username):
+    """(profile, suggestions, followed ids) for /user/<username>, loaded once a request.
+
+    A handful of queries whatever the page holds, the viewer-independent
+    part served from the profile cache, see app/utils/profiles.py.
+    """
+    if "profile_page" not in g:
+        profile = profiles.cached_profile(db.session, username, request.args.get("cursor"),
+                                          limit=POSTS_PER_PAGE)
+        if profile is None:
+            abort(404)
+        viewer_id = getattr(current_user, "id", None)
+        g.profile_page = (profile, *profiles.load_viewer(db.session, viewer_id,
+                                                         [profile.card.id]))
+    return g.profile_page
+
+
+def profile_version(username):
+    profile, suggestions, following = profile_page(username)
+    return profile.last_modified, (profile.version(), card_tokens(current_user),
+                                   [card.as_tuple() for card in suggestions],
+                                   sorted(following))
 
 
 @main.route("/feed", methods=["GET", "POST"])
 @login_required
+@read_replica
+@conditional(feed_version)
+@query_budget(30)
+@rate_limit(6, burst=3, methods=["POST"])
+@sheds_load("replication", methods=["POST"])
 def index():
     form = PostForm()
 
@@ -36,43 +203,9 @@ def index():
         flash("Posted Successfully")
         return redirect(url_for("main.index"))
     
-    # cursor based pagination
-    cursor = request.args.get("cursor", None)
-    limit = 5
-    query = Post.query.options(
-        joinedload(Post.author),
-        joinedload(Post.comments),
-        joinedload(Post.likes)
-    ).order_by(Post.timestamp.desc(), Post.id.desc())
-
-    if cursor:
-        cursor_ts, cursor_id = cursor.split("|")
-        cursor_ts = datetime.fromisoformat(cursor_ts)
-        cursor_id = int(cursor_id)
-
-        query = query.filter(
-            or_(
-                Post.timestamp < cursor_ts,
-                and_(
-                    Post.timestamp == cursor_ts,
-                    Post.id < cursor_id
-                )
-            )
-        )
-
-    posts = query.limit(limit + 1).all()
-    has_more = len(posts) > limit
-    posts = posts[:limit]
-
-    next_cursor = None
-    if has_more:
-        last = posts[-1]
-        next_cursor = f"{last.timestamp.isoformat()}|{last.id}"
-
-    post_ids = [post.id for post in posts]
-    comments = Comment.query.filter(Comment.post_id.in_(post_ids)).all()
-
-    users = User.query.filter(User.id != current_user.id).limit(6).all()
+    ranked, page, comments, users = feed_page()
+    posts = page.items
+    next_cursor = page.next_cursor
 
     """Render the 'index.html' template, passing the form, posts and comments
     to the template"""
@@ -84,7 +217,9 @@ def index():
         nav_color="black",
         next_cursor=next_cursor,
         users=users,
-        user=current_user
+        user=current_user,
+        trending=trending_tags(),
+        sort="top" if ranked else None
     )
 
 
@@ -99,56 +234,113 @@ def get_image(id):
     return redirect(post.media_url)
 
 
-@main.route("/user/<username>")
-def user(username):
-    user_profile = User.query.filter_by(username=username).first_or_404()
+@main.route("/avatar/<avatar_hash>")
+def avatar(avatar_hash):
+    # Local avatar cache, used when CTRACK_AVATAR_PROXY is enabled so pages
+    # don't wait on gravatar.com
+    size = request.args.get("s", 100, type=int)
+    default = request.args.get("d", "identicon")
+    rating = request.args.get("r", "g")
+    if not valid_avatar_request(avatar_hash, size, default, rating):
+        abort(404)
 
-    # cursor based pagination for this user's posts
-    cursor = request.args.get("cursor", None)
-    limit = 5
-    query = Post.query.options(
-        joinedload(Post.author),
-        joinedload(Post.comments),
-        joinedload(Post.likes)
-    ).filter_by(author_id=user_profile.id).order_by(Post.timestamp.desc(), Post.id.desc())
-
-    if cursor:
-        try:
-            cursor_ts, cursor_id = cursor.split("|")
-            cursor_ts = datetime.fromisoformat(cursor_ts)
-            cursor_id = int(cursor_id)
-            query = query.filter(
-                or_(
-                    Post.timestamp < cursor_ts,
-                    and_(Post.timestamp == cursor_ts, Post.id < cursor_id)
-                )
-            )
-        except Exception:
-            pass  # invalid cursor -> return first page
-
-    posts = query.limit(limit + 1).all()
-    has_more = len(posts) > limit
-    posts = posts[:limit]
-
-    next_cursor = None
-    if has_more:
-        last = posts[-1]
-        next_cursor = f"{last.timestamp.isoformat()}|{last.id}"
-
-    post_ids = [post.id for post in posts]
-    comments = Comment.query.filter(Comment.post_id.in_(post_ids)).all()
-    users = User.query.filter(User.id != current_user.id).limit(6).all()
+    path = cached_avatar_path(
+        current_app.config["CTRACK_AVATAR_CACHE_DIR"],
+        avatar_hash, size, default, rating
+    )
+    if path is None:
+        return redirect(avatar_url(GRAVATAR_URL, avatar_hash, size, default, rating))
+    return send_file(path, mimetype=avatar_mimetype(path), max_age=7 * 24 * 3600)
 
+
+@main.route("/user/<username>")
+@read_replica
+@conditional(profile_version)
+@query_budget(15)
+def user(username):
+    profile, suggestions, following = profile_page(username)
     return render_template(
         "user.html",
-        user=user_profile,
-        users=users,
+        user=profile.card,
+        followers=profile.followers,
+        followed=profile.followed,
+        following=following,
+        users=suggestions,
         nav_color="rgba(0,0,0,0.6)",
-        posts=posts,
-        comments=comments,
-        next_cursor=next_cursor
+        posts=profile.posts,
+        next_cursor=profile.next_cursor
+    )
+
+
+@main.route("/api/feed")
+@login_required
+@read_replica
+@query_budget(20)
+def api_feed():
+    # Next page of feed post cards for infinite scroll, without re-rendering
+    # the sidebar, suggestions and post form
+    page = post_page(request.args.get("cursor"), ranked=ranked_feed())
+    return jsonify({
+        "html": render_template("_posts.html", posts=page.items),
+        "next_cursor": page.next_cursor
+    })
+
+
+@main.route("/api/user/<username>/posts")
+@read_replica
+@query_budget(20)
+def api_user_posts(username):
+    # Next page of a profile's timeline for infinite scroll
+    profile = profiles.cached_profile(db.session, username, request.args.get("cursor"),
+                                      limit=POSTS_PER_PAGE)
+    if profile is None:
+        abort(404)
+    return jsonify({
+        "html": render_template("_timeline.html", posts=profile.posts),
+        "next_cursor": profile.next_cursor
+    })
+
+
+@main.route("/search")
+@login_required
+@read_replica
+def search():
+    # ranked full-text search over people, posts and comments
+    q = request.args.get("q", "").strip()
+    kind = request.args.get("kind")
+    if kind not in ("user", "post", "comment"):
+        kind = None
+
+    page = text_search.search(db.session, q, kind=kind,
+                              cursor=request.args.get("cursor"), limit=10)
+    results = text_search.load_results(db.session, page)
+    return render_template(
+        "search.html",
+        q=q,
+        kind=kind,
+        results=results,
+        next_cursor=page.next_cursor,
+        nav_color="rgba(0,0,0,0.6)"
+    )
+
+
+@main.route("/tag/<name>")
+@login_required
+@read_replica
+def tag(name):
+    # posts with a #hashtag, newest first
+    name = name.lower()
+    page = tag_page(name, request.args.get("cursor"))
+    return render_template(
+        "tag.html",
+        tag=name,
+        posts=page.items,
+        next_cursor=page.next_cursor,
+        trending=trending_tags(),
+        nav_color="rgba(0,0,0,0.6)"
     )
 
+
 @main.route("/edit-profile", methods=["GET", "POST"])
 @login_required
 def edit_profile():
@@ -168,7 +360,7 @@ def edit_profile():
         db.session.add(current_user._get_current_object())
         db.session.commit()
 
-        update_user_profile(current_user)
+        update_user_profile(current_user._get_current_object())
 
         # Display a flash message to indicate successful profile update
         flash("Your profile has been updated.")
@@ -188,39 +380,64 @@ def edit_profile():
     return render_template("edit_profile.html", form=form)
 
 
-@main.route("/like_post/<post_id>", methods=["POST"])
+@main.route("/like_post/<int:post_id>", methods=["POST"])
 @login_required
+@rate_limit(60, burst=20)
+@sheds_load("replication")
 def like_post(post_id):
-    post = Post.query.get(post_id)
-
-    if not post:
+    # {"liked": true/false} sets the state, an empty body toggles it
+    data = request.get_json(silent=True) or {}
+    liked = data.get("liked")
+    if liked is not None:
+        liked = bool(liked)
+
+    result = queue_post_like(current_user.id, post_id, liked)
+    if result is None:
         return jsonify({"error": "Post does not exist."}), 404
 
-    like = Like.query.filter_by(
-        author_id=current_user.id, post_id=post.id).first()
-
-    if like:
-        # If the user has already liked the post, remove the like
-        db.session.delete(like)
-        db.session.commit()
-        toggle_like_remote(current_user.id, post.id, like=False)
-    else:
-        # If the user has not liked the post, create a new like
-        like = Like(author_id=current_user.id, post_id=post_id)
-        db.session.add(like)
-        db.session.commit()
-        toggle_like_remote(current_user.id, post.id, like=True)
+    liked, likes = result
     res = {
         # Total number of likes for the post
-        "likes": len(post.likes),
+        "likes": likes,
         # Check if the current user has liked the post
-        "liked": current_user.id in map(lambda x: x.author_id, post.likes),
+        "liked": liked,
     }
     return jsonify(res)
 
 
+@main.route("/live/counts")
+@login_required
+def live_counts():
+    # Server-Sent Events with like/comment counts for the posts on the page
+    post_ids = {
+        int(post_id) for post_id in request.args.get("posts", "").split(",")
+        if post_id.isdigit()
+    }
+    # past the cap, watch the newest posts: they get the likes and comments
+    post_ids = set(sorted(post_ids, reverse=True)[:current_app.config["LIVE_MAX_POSTS"]])
+    if not post_ids:
+        return jsonify({"error": "no posts to watch"}), 400
+
+    # an idle stream must not keep a pooled connection checked out
+    db.session.close()
+
+    sub = broker.subscribe(post_ids)
+    get_events().start()
+    stream = event_stream(
+        sub,
+        heartbeat=current_app.config["LIVE_HEARTBEAT_SECONDS"],
+        max_seconds=current_app.config["LIVE_MAX_SECONDS"]
+    )
+    return Response(stream, mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+
 @main.route("/add_comment/<post_id>", methods=["POST"])
 @login_required
+@rate_limit(10, burst=5)
+@sheds_load("replication", "email")
 def add_comment(post_id):
     # Retrieve the post object based on the provided post_id
     post = Post.query.filter_by(id=int(post_id)).first()
@@ -259,10 +476,13 @@ def add_comment(post_id):
 
 @main.route("/follow/<username>")
 @login_required
+@rate_limit(30, burst=10)
+@sheds_load("replication", "email")
 def follow(username):
     user_to_follow = User.query.filter_by(username=username).first()
     current_user.follow(user_to_follow)
     db.session.commit()
+    profiles.forget_user(current_user.id, user_to_follow.id)
 
     follow_user_remote(current_user.id, user_to_follow.id)
 
@@ -280,10 +500,13 @@ def follow(username):
 
 @main.route("/unfollow/<username>")
 @login_required
+@rate_limit(30, burst=10)
+@sheds_load("replication")
 def unfollow(username):
     user_to_unfollow = User.query.filter_by(username=username).first()
     current_user.unfollow(user_to_unfollow)
     db.session.commit()
+    profiles.forget_user(current_user.id, user_to_unfollow.id)
 
     unfollow_user_remote(current_user.id, user_to_unfollow.id)
 
@@ -293,6 +516,7 @@ def unfollow(username):
 
 @main.route('/network')
 @login_required
+@read_replica
 def network():
     users = User.query.filter(User.id != current_user.id).all()
     return render_template('network.html', users=users, nav_color="rgba(0,0,0,0.6)", nav_color1='black')
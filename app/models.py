@@ -1,18 +1,23 @@
 from . import db
-from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
 from . import login_manager
 from itsdangerous import URLSafeTimedSerializer as Serializer
 from flask import current_app
 from datetime import datetime
 from sqlalchemy import LargeBinary
-import hashlib
 from markdown import markdown
 import bleach
+from .utils.avatar import avatar_url, email_hash, GRAVATAR_URL, PROXY_URL
+from .utils.routing import use_replica
+from .utils.passwords import get_hasher, HashingBusy
 
 
 class Follow(db.Model):
     __tablename__ = 'follows'
+    __table_args__ = (
+        # followers of a user; follower lookups use the primary key
+        db.Index('ix_follows_followed_id', 'followed_id'),
+    )
     follower_id = db.Column(
         db.Integer, db.ForeignKey('users.id'), primary_key=True
     )
@@ -76,10 +81,23 @@ class User(db.Model, UserMixin):
 
     @password.setter
     def password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = get_hasher().hash(password)
 
     def verify_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        """Check a password; a hash made with old settings is replaced.
+
+        The caller saves the new hash (db.session.is_modified(user)). When
+        the hasher is too busy the upgrade waits for a later login.
+        """
+        hasher = get_hasher()
+        if not hasher.verify(self.password_hash, password):
+            return False
+        if hasher.needs_rehash(self.password_hash):
+            try:
+                self.password_hash = hasher.hash(password)
+            except HashingBusy:
+                pass
+        return True
 
     def generate_confirmation_token(self):
         s = Serializer(current_app.config['SECRET_KEY'])
@@ -100,12 +118,15 @@ class User(db.Model, UserMixin):
         return True
 
     def gravatar_hash(self):
-        return hashlib.md5(self.email.lower().encode('utf-8'), usedforsecurity=False).hexdigest()
+        return email_hash(self.email)
 
     def gravatar(self, size=100, default='identicon', rating='g'):
-        url = 'https://secure.gravatar.com/avatar'
+        if current_app.config.get('CTRACK_AVATAR_PROXY'):
+            url = PROXY_URL
+        else:
+            url = GRAVATAR_URL
         hash = self.avatar_hash or self.gravatar_hash()
-        return f'{url}/{hash}?s={size}&d={default}&r={rating}'
+        return avatar_url(url, hash, size, default, rating)
 
     def follow(self, user):
         if not self.is_following(user):
@@ -135,11 +156,23 @@ class User(db.Model, UserMixin):
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    with use_replica(db.session):
+        user = db.session.get(User, int(user_id))
+    if user is None:
+        # not replicated yet, ask the primary
+        user = db.session.get(User, int(user_id))
+    return user
 
 
 class Post(db.Model):
     __tablename__ = 'posts'
+    __table_args__ = (
+        # keyset pagination of the feed and of a profile's posts
+        db.Index('ix_posts_timestamp_id', 'timestamp', 'id'),
+        db.Index('ix_posts_author_id_timestamp_id', 'author_id', 'timestamp', 'id'),
+        # keyset pagination of the ranked feed
+        db.Index('ix_posts_rank_score_id', 'rank_score', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.Text)
     body_html = db.Column(db.Text)
@@ -148,6 +181,10 @@ class Post(db.Model):
     media_type = db.Column(db.String(20))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     featured = db.Column(db.Boolean, default=False)
+    # kept in step with the likes table by app/utils/likes.py
+    like_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # ranked feed score, see app/utils/ranking.py
+    rank_score = db.Column(db.Float, nullable=False, default=0, server_default='0')
     author_id = db.Column(
         db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'))
     comments = db.relationship('Comment', backref="post", passive_deletes=True)
@@ -158,15 +195,19 @@ class Post(db.Model):
         db.session.add(self)
 
     @staticmethod
-    def on_changed_body(target, value, oldvalue, initiator):
+    def render_body(value):
         allowed_tags = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
                         'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul', 'br',
                         'h1', 'h2', 'h3', 'p'
                         ]
-        target.body_html = bleach.linkify(bleach.clean(
+        return bleach.linkify(bleach.clean(
             markdown(value, output_format='html'),
             tags=allowed_tags, strip=True))
 
+    @staticmethod
+    def on_changed_body(target, value, oldvalue, initiator):
+        target.body_html = Post.render_body(value)
+
     def __repr__(self):
         return f'<Post {self.body[:10]}...'
 
@@ -176,6 +217,9 @@ db.event.listen(Post.body, 'set', Post.on_changed_body)
 
 class Comment(db.Model):
     __tablename__ = 'comments'
+    __table_args__ = (
+        db.Index('ix_comments_post_id_timestamp', 'post_id', 'timestamp'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.Text)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
@@ -194,6 +238,11 @@ class Comment(db.Model):
 
 class Like(db.Model):
     __tablename__ = 'likes'
+    __table_args__ = (
+        # one like per user and post
+        db.Index('uq_likes_author_id_post_id', 'author_id', 'post_id', unique=True),
+        db.Index('ix_likes_post_id', 'post_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     author_id = db.Column(db.Integer, db.ForeignKey(
         'users.id', ondelete='CASCADE'), nullable=False)
@@ -202,3 +251,88 @@ class Like(db.Model):
 
     def __repr__(self):
         return f'<Like by {self.author}...'
+
+
+class SearchDocument(db.Model):
+    """Searchable text of a post, comment or profile, see app/utils/search.py."""
+    __tablename__ = 'search_documents'
+    __table_args__ = (
+        db.Index('uq_search_documents_kind_doc_id', 'kind', 'doc_id', unique=True),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    # 'post', 'comment' or 'user'
+    kind = db.Column(db.String(8), nullable=False)
+    doc_id = db.Column(db.Integer, nullable=False)
+    body = db.Column(db.Text, nullable=False, default='')
+    timestamp = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<SearchDocument {self.kind} {self.doc_id}>'
+
+
+class PostTag(db.Model):
+    """A #hashtag in a post's body, see app/utils/tags.py."""
+    __tablename__ = 'post_tags'
+    __table_args__ = (
+        # keyset pagination of a tag's posts; the post's timestamp is
+        # copied here so a tag page never touches posts to find its page
+        db.Index('ix_post_tags_tag_timestamp_post_id', 'tag', 'timestamp', 'post_id'),
+    )
+    post_id = db.Column(db.Integer, db.ForeignKey(
+        'posts.id', ondelete='CASCADE'), primary_key=True)
+    tag = db.Column(db.String(64), primary_key=True)
+    timestamp = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<PostTag #{self.tag} {self.post_id}>'
+
+
+class PostMention(db.Model):
+    """An @username in a post's body that names an existing user."""
+    __tablename__ = 'post_mentions'
+    __table_args__ = (
+        db.Index('ix_post_mentions_user_id_timestamp_post_id',
+                 'user_id', 'timestamp', 'post_id'),
+    )
+    post_id = db.Column(db.Integer, db.ForeignKey(
+        'posts.id', ondelete='CASCADE'), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey(
+        'users.id', ondelete='CASCADE'), primary_key=True)
+    timestamp = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<PostMention {self.user_id} {self.post_id}>'
+
+
+class TagTrend(db.Model):
+    """Uses of a tag in one time bucket, see app/utils/trending.py."""
+    __tablename__ = 'tag_trends'
+    tag = db.Column(db.String(64), primary_key=True)
+    bucket = db.Column(db.DateTime, primary_key=True, index=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<TagTrend #{self.tag} {self.bucket} {self.count}>'
+
+
+class RateLimit(db.Model):
+    """One token bucket of the shared rate limiter, see app/utils/ratelimit.py."""
+    __tablename__ = 'rate_limits'
+    key = db.Column(db.String(128), primary_key=True)
+    full_at = db.Column(db.Float, nullable=False, index=True)
+
+    def __repr__(self):
+        return f'<RateLimit {self.key} {self.full_at}>'
+
+
+class CountEvent(db.Model):
+    """A post's new like or comment count on its way to every worker's live streams."""
+    __tablename__ = 'count_events'
+    id = db.Column(db.Integer, primary_key=True)
+    post_id = db.Column(db.Integer, nullable=False)
+    likes = db.Column(db.Integer)
+    comments = db.Column(db.Integer)
+    created = db.Column(db.Float, nullable=False, index=True)
+
+    def __repr__(self):
+        return f'<CountEvent {self.post_id} {self.likes} {self.comments}>'
@@ -1,4 +1,5 @@
 import os
+import sys
 import sqlite3
 import psycopg2
 from psycopg2.extras import RealDictCursor
@@ -8,9 +9,13 @@ from typing import List, Dict, Any
 import logging
 import re
 from datetime import datetime
+import hashlib
 from dotenv import load_dotenv
 load_dotenv()
 
+# the search index is built with the app's own code
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -135,6 +140,8 @@ class SupabaseToSQLiteConverter:
                         media_type VARCHAR(20),
                         timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
                         featured BOOLEAN DEFAULT FALSE,
+                        like_count INTEGER NOT NULL DEFAULT 0,
+                        rank_score FLOAT NOT NULL DEFAULT 0,
                         author_id INTEGER,
                         FOREIGN KEY (author_id) REFERENCES users (id) ON DELETE CASCADE
                     )
@@ -164,6 +171,58 @@ class SupabaseToSQLiteConverter:
                     )
                 """)
                 
+                # Create post_tags table
+                self.sqlite_conn.execute("""
+                    CREATE TABLE IF NOT EXISTS post_tags (
+                        post_id INTEGER NOT NULL,
+                        tag VARCHAR(64) NOT NULL,
+                        timestamp DATETIME NOT NULL,
+                        PRIMARY KEY (post_id, tag),
+                        FOREIGN KEY (post_id) REFERENCES posts (id) ON DELETE CASCADE
+                    )
+                """)
+                
+                # Create post_mentions table
+                self.sqlite_conn.execute("""
+                    CREATE TABLE IF NOT EXISTS post_mentions (
+                        post_id INTEGER NOT NULL,
+                        user_id INTEGER NOT NULL,
+                        timestamp DATETIME NOT NULL,
+                        PRIMARY KEY (post_id, user_id),
+                        FOREIGN KEY (post_id) REFERENCES posts (id) ON DELETE CASCADE,
+                        FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+                    )
+                """)
+                
+                # Create tag_trends table (recent counts, not copied)
+                self.sqlite_conn.execute("""
+                    CREATE TABLE IF NOT EXISTS tag_trends (
+                        tag VARCHAR(64) NOT NULL,
+                        bucket DATETIME NOT NULL,
+                        count INTEGER NOT NULL,
+                        PRIMARY KEY (tag, bucket)
+                    )
+                """)
+                
+                # Create rate_limits table (token buckets, not copied)
+                self.sqlite_conn.execute("""
+                    CREATE TABLE IF NOT EXISTS rate_limits (
+                        key VARCHAR(128) NOT NULL PRIMARY KEY,
+                        full_at FLOAT NOT NULL
+                    )
+                """)
+                
+                # Create count_events table (live count changes, not copied)
+                self.sqlite_conn.execute("""
+                    CREATE TABLE IF NOT EXISTS count_events (
+                        id INTEGER NOT NULL PRIMARY KEY,
+                        post_id INTEGER NOT NULL,
+                        likes INTEGER,
+                        comments INTEGER,
+                        created FLOAT NOT NULL
+                    )
+                """)
+                
             logger.info("Created all tables successfully")
             
         except Exception as e:
@@ -236,17 +295,95 @@ class SupabaseToSQLiteConverter:
             logger.info("Copying likes data...")
             self.copy_table_data('likes')
             
+            # Copy hashtags and mentions (reference posts and users)
+            logger.info("Copying post_tags data...")
+            self.copy_table_data('post_tags')
+            logger.info("Copying post_mentions data...")
+            self.copy_table_data('post_mentions')
+            
         except Exception as e:
             logger.error(f"Failed to copy data with relationships: {e}")
             raise
     
+    def create_indexes(self) -> None:
+        """Create the model indexes once the data is loaded (faster than indexing row by row)"""
+        try:
+            with self.sqlite_conn:
+                # the unique like index needs duplicates gone first
+                self.sqlite_conn.execute("""
+                    DELETE FROM likes WHERE id NOT IN
+                    (SELECT MIN(id) FROM likes GROUP BY author_id, post_id)
+                """)
+                self.sqlite_conn.executescript("""
+                    CREATE UNIQUE INDEX IF NOT EXISTS ix_users_email ON users (email);
+                    CREATE UNIQUE INDEX IF NOT EXISTS ix_users_username ON users (username);
+                    CREATE INDEX IF NOT EXISTS ix_follows_followed_id ON follows (followed_id);
+                    CREATE INDEX IF NOT EXISTS ix_posts_timestamp ON posts (timestamp);
+                    CREATE INDEX IF NOT EXISTS ix_posts_timestamp_id ON posts (timestamp, id);
+                    CREATE INDEX IF NOT EXISTS ix_posts_author_id_timestamp_id ON posts (author_id, timestamp, id);
+                    CREATE INDEX IF NOT EXISTS ix_posts_rank_score_id ON posts (rank_score, id);
+                    CREATE INDEX IF NOT EXISTS ix_comments_timestamp ON comments (timestamp);
+                    CREATE INDEX IF NOT EXISTS ix_comments_post_id_timestamp ON comments (post_id, timestamp);
+                    CREATE UNIQUE INDEX IF NOT EXISTS uq_likes_author_id_post_id ON likes (author_id, post_id);
+                    CREATE INDEX IF NOT EXISTS ix_likes_post_id ON likes (post_id);
+                    CREATE INDEX IF NOT EXISTS ix_post_tags_tag_timestamp_post_id ON post_tags (tag, timestamp, post_id);
+                    CREATE INDEX IF NOT EXISTS ix_post_mentions_user_id_timestamp_post_id ON post_mentions (user_id, timestamp, post_id);
+                    CREATE INDEX IF NOT EXISTS ix_tag_trends_bucket ON tag_trends (bucket);
+                    CREATE INDEX IF NOT EXISTS ix_rate_limits_full_at ON rate_limits (full_at);
+                    CREATE INDEX IF NOT EXISTS ix_count_events_created ON count_events (created);
+                """)
+                self.sqlite_conn.execute("ANALYZE")
+            logger.info("Created indexes successfully")
+        except Exception as e:
+            logger.error(f"Failed to create indexes: {e}")
+            raise
+
+    def build_search_index(self) -> None:
+        """Create search_documents with its FTS5 table and triggers, and index the copied rows"""
+        try:
+            import sqlalchemy as sa
+            from app.utils import search
+            engine = sa.create_engine(f"sqlite:///{self.sqlite_path}")
+            try:
+                with engine.connect() as conn:
+                    search.ensure_index(conn)
+                    conn.commit()
+                    totals = {}
+                    for table, rows in search.reindex(conn):
+                        totals[table] = totals.get(table, 0) + rows
+            finally:
+                engine.dispose()
+            logger.info("Indexed for search: " + ", ".join(f"{n} {t}" for t, n in totals.items()))
+        except Exception as e:
+            logger.error(f"Failed to build the search index: {e}")
+            raise
+
+    def backfill_avatar_hashes(self) -> None:
+        """Fill avatar_hash for users copied without one so pages never hash emails"""
+        try:
+            cursor = self.sqlite_conn.cursor()
+            cursor.execute(
+                "SELECT id, email FROM users WHERE avatar_hash IS NULL AND email IS NOT NULL"
+            )
+            rows = [
+                (hashlib.md5(email.lower().encode('utf-8'), usedforsecurity=False).hexdigest(), user_id)
+                for user_id, email in cursor.fetchall()
+            ]
+            with self.sqlite_conn:
+                self.sqlite_conn.executemany("UPDATE users SET avatar_hash = ? WHERE id = ?", rows)
+            logger.info(f"Backfilled avatar_hash for {len(rows)} users")
+        except Exception as e:
+            logger.error(f"Failed to backfill avatar hashes: {e}")
+            raise
+
     def verify_data_integrity(self) -> None:
         """Verify that data was copied correctly and relationships are intact"""
         try:
             cursor = self.sqlite_conn.cursor()
             
             # Check row counts
-            tables = ['users', 'posts', 'follows', 'comments', 'likes']
+            tables = ['users', 'posts', 'follows', 'comments', 'likes', 'post_tags', 'post_mentions',
+                      'search_documents']
             for table in tables:
                 cursor.execute(f"SELECT COUNT(*) FROM {table}")
                 count = cursor.fetchone()[0]
@@ -285,6 +422,15 @@ class SupabaseToSQLiteConverter:
             
             # Copy data in the correct order
             self.copy_data_with_relationships()
+
+            # Index after the bulk copy
+            self.create_indexes()
+
+            # Make sure every user has a precomputed avatar hash
+            self.backfill_avatar_hashes()
+
+            # Search documents for every post, comment and user
+            self.build_search_index()
             
             # Verify data integrity
             self.verify_data_integrity()
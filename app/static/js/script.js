@@ -77,6 +77,9 @@ function follow_unfollow(data, username) {
   }
 }
 
+// pending like requests per post, see like()
+const likeTimers = {};
+
 /**
      * Like function for updating class names of i and span tags without refreshing webpage
      *
@@ -99,22 +102,22 @@ function like(postId) {
 
   }
 
-  // Send a POST request to the server to like the post
-  fetch(`/like_post/${postId}`, { method: "POST" })
-    // .then((res) => res.json()) // Parse the response as JSON
-    // .then((data) => {
-    //     // Updating the like count and visual styles class based on the response data
-    //     likeCount.innerHTML = data["likes"];
-    //     if (data["liked"] === true) {
-    //         // likeButton.className = "fas fa-thumbs-up fa-xl fa-flip-horizontal text-primary";
-    //         // likeSpan.className = "text-primary"
-    //     } else {
-    //         // likeButton.className = "far fa-thumbs-up fa-xl fa-flip-horizontal text-secondary";
-    //         // likeSpan.className = "text-secondary"
-    //     }
-    // })
-    // Display an error message if the request fails
-    .catch((e) => alert("Could not like post."));
+  // Debounce rapid clicks and send the state the user ended on, so
+  // retries are idempotent and flip-flops never reach the server
+  const liked = likeSpan.classList.contains('text-primary');
+  clearTimeout(likeTimers[postId]);
+  likeTimers[postId] = setTimeout(() => {
+    delete likeTimers[postId];
+    fetch(`/like_post/${postId}`, {
+      method: "POST",
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ liked: liked })
+    })
+      .then((res) => res.json())
+      .then((data) => { likeCount.innerHTML = data["likes"]; })
+      // Display an error message if the request fails
+      .catch((e) => alert("Could not like post."));
+  }, 400);
 }
 
 
@@ -219,4 +222,33 @@ async function add_comment_to_db(comment, post_id) {
   } catch (error) {
     console.log(error);
   }
-}
\ No newline at end of file
+}
+
+
+// live like/comment counts for the posts on the page
+let countsSource = null;
+
+function watch_counts() {
+  /*
+   * Opens (or re-opens, after more posts were appended) a Server-Sent Events
+   * stream that pushes new like and comment counts for every post on the page.
+  */
+  const ids = Array.from(document.querySelectorAll("[id^='likes-count-']"))
+    .map((el) => el.id.replace("likes-count-", ""));
+  if (countsSource) countsSource.close();
+  if (!ids.length || !window.EventSource) return;
+
+  countsSource = new EventSource(`/live/counts?posts=${ids.join(",")}`);
+  countsSource.onmessage = (event) => {
+    const counts = JSON.parse(event.data);
+    for (const [postId, c] of Object.entries(counts)) {
+      const likeCount = document.getElementById(`likes-count-${postId}`);
+      // a debounced click of our own is about to settle the count
+      if (c.likes !== undefined && likeCount && !likeTimers[postId]) {
+        likeCount.innerHTML = c.likes;
+      }
+      const commentCount = document.querySelector(`.comments-${postId}`);
+      if (c.comments !== undefined && commentCount) commentCount.innerHTML = c.comments;
+    }
+  };
+}
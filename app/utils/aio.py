@@ -0,0 +1,94 @@
+import asyncio
+import atexit
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundLoop:
+    """One asyncio event loop per process, running on a daemon thread.
+
+    Outbound I/O (Brevo email, Supabase uploads, remote-DB replication) is
+    scheduled here instead of holding a request worker or starting a thread
+    per call: coroutines share one loop and one pooled HTTP client, and the
+    remaining blocking calls (psycopg2) share a bounded executor. The loop
+    starts lazily and again after a fork, so preloading servers are fine.
+    """
+
+    def __init__(self, workers=8):
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.pid = None
+        self.loop = None
+        self.executor = None
+        self.client = None
+
+    def _ensure_started(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return self.loop
+            # first use, or a forked child that inherited a dead loop
+            self.loop = asyncio.new_event_loop()
+            self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix='background-io')
+            self.loop.set_default_executor(self.executor)
+            self.client = None
+            self.pending = set()
+            self.pid = os.getpid()
+            threading.Thread(target=self.loop.run_forever, name='background-loop',
+                             daemon=True).start()
+            return self.loop
+
+    def _track(self, future, what):
+        with self.lock:
+            self.pending.add(future)
+
+        def done(f):
+            with self.lock:
+                self.pending.discard(f)
+            if not f.cancelled() and f.exception() is not None:
+                logger.error('background %s failed', what, exc_info=f.exception())
+        future.add_done_callback(done)
+        return future
+
+    def submit(self, coro):
+        """Schedule a coroutine; returns a concurrent.futures.Future."""
+        loop = self._ensure_started()
+        return self._track(asyncio.run_coroutine_threadsafe(coro, loop), coro.__qualname__)
+
+    def submit_blocking(self, func, *args, **kwargs):
+        """Run a blocking call on the shared executor, fire and forget."""
+        self._ensure_started()
+        return self._track(self.executor.submit(func, *args, **kwargs),
+                           getattr(func, '__qualname__', repr(func)))
+
+    def run(self, coro, timeout=None):
+        """Run a coroutine on the loop and wait for its result."""
+        return self.submit(coro).result(timeout)
+
+    async def http(self):
+        """The process-wide pooled httpx.AsyncClient (call on the loop)."""
+        if self.client is None:
+            import httpx
+            self.client = httpx.AsyncClient(timeout=httpx.Timeout(10.0, connect=5.0))
+        return self.client
+
+    def drain(self, timeout=10):
+        """Wait for scheduled work, e.g. at shutdown; returns what is left."""
+        with self.lock:
+            if self.pid != os.getpid():
+                return 0
+            pending = list(self.pending)
+        done, not_done = wait(pending, timeout=timeout)
+        return len(not_done)
+
+
+background = BackgroundLoop()
+atexit.register(background.drain)
+
+
+def init_app(app):
+    background.workers = app.config['BACKGROUND_WORKERS']
@@ -0,0 +1,101 @@
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import time
+import urllib.request
+from functools import lru_cache
+from app.utils import metrics
+
+GRAVATAR_URL = 'https://secure.gravatar.com/avatar'
+PROXY_URL = '/avatar'
+
+_hash_re = re.compile(r'^[0-9a-f]{32}$')
+_option_re = re.compile(r'^[A-Za-z0-9_-]{1,32}$')
+# a hash gravatar.com just failed to serve is sent there directly for
+# FAILURE_SECONDS instead of being fetched again
+FAILURE_SECONDS = 60
+_failures = {}  # path -> monotonic time to retry at
+_failures_lock = threading.Lock()
+# leading bytes of the formats gravatar answers with
+_signatures = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+)
+
+
+# AVATAR URLS
+@lru_cache(maxsize=4096)
+def email_hash(email):
+    """Gravatar hash for users whose avatar_hash hasn't been backfilled."""
+    return hashlib.md5(email.lower().encode('utf-8'), usedforsecurity=False).hexdigest()
+
+
+@lru_cache(maxsize=4096)
+def avatar_url(base, avatar_hash, size=100, default='identicon', rating='g'):
+    """Build an avatar URL once per (base, hash, size, default, rating)."""
+    return f'{base}/{avatar_hash}?s={size}&d={default}&r={rating}'
+
+
+# LOCAL AVATAR CACHE
+def valid_avatar_request(avatar_hash, size, default, rating):
+    return bool(
+        _hash_re.match(avatar_hash)
+        and 0 < size <= 2048
+        and _option_re.match(default)
+        and _option_re.match(rating)
+    )
+
+
+def cached_avatar_path(cache_dir, avatar_hash, size, default, rating, timeout=3):
+    """Return the path of a locally cached avatar, fetching it on a miss.
+
+    Returns None when gravatar.com can't be reached, or couldn't be in the
+    last FAILURE_SECONDS, so the caller can fall back to redirecting the
+    browser there. Misses are fetched in parallel; two requests missing
+    the same avatar may both fetch it, and the last rename wins.
+    """
+    path = os.path.join(cache_dir, f'{avatar_hash}-{size}-{default}-{rating}')
+    if os.path.exists(path):
+        metrics.cache_requests.inc('avatar', 'hit')
+        return path
+    metrics.cache_requests.inc('avatar', 'miss')
+
+    now = time.monotonic()
+    if _failures.get(path, 0) > now:
+        return None
+    url = avatar_url(GRAVATAR_URL, avatar_hash, size, default, rating)
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            data = response.read()
+    except Exception:
+        with _failures_lock:
+            for failed in [p for p, retry_at in _failures.items() if retry_at <= now]:
+                del _failures[failed]
+            _failures[path] = now + FAILURE_SECONDS
+        return None
+
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return path
+
+def avatar_mimetype(path):
+    """Content type of a cached avatar, told by its first bytes.
+
+    Gravatar serves whatever the user uploaded (PNG, JPEG or GIF, and
+    WebP where asked); anything else goes out as octet-stream.
+    """
+    with open(path, 'rb') as f:
+        head = f.read(12)
+    for signature, mimetype in _signatures:
+        if head.startswith(signature):
+            return mimetype
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'application/octet-stream'
@@ -0,0 +1,324 @@
+import json
+import math
+import platform
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import sqlalchemy as sa
+from app import db
+from app.models import User, Post, Comment, Like, Follow
+from app.utils import query_stats
+from app.utils.pagination import encode_cursor
+from app.utils.bulk_import import Importer, generate_users, generate_posts
+
+QUERY_HEADER = 'X-Query-Count'
+# share of the journeys in the concurrent load, roughly a browsing session
+MIX = {
+    'feed': 20,
+    'feed_scroll': 25,
+    'profile': 15,
+    'network': 5,
+    'like': 20,
+    'comment': 8,
+    'follow': 4,
+    'unfollow': 3,
+}
+CURSOR_PAGES = 20
+
+
+# SEEDING
+def seed(app, users=200, follows=20, posts=2000, likes=5, comments=2, rng=None):
+    """Recreate the schema and fill it: users and posts with the bulk importer.
+
+    ``follows``, ``likes`` and ``comments`` are per user or per post on
+    average. Returns the row counts.
+    """
+    rng = rng or random.Random(1)
+    now = datetime.utcnow()
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        # the import tool's generated data, loaded the way it loads files
+        usernames = [f'user{i}' for i in range(users)]
+        with db.engine.connect() as conn:
+            importer = Importer(conn, batch_size=500)
+            try:
+                for kind, rows in (
+                        ('users', generate_users(users, 'user', now=now)),
+                        ('posts', generate_posts(posts, usernames, rng, now=now))):
+                    for _ in getattr(importer, kind)(rows):
+                        pass
+            finally:
+                importer.close()
+        user_ids = db.session.scalars(sa.select(User.id)).all()
+        post_ids = db.session.scalars(sa.select(Post.id)).all()
+
+        follow_rows = {(a, b) for a in user_ids
+                       for b in rng.sample(user_ids, min(follows, users)) if a != b}
+        like_rows = {(rng.choice(user_ids), rng.choice(post_ids))
+                     for _ in range(likes * len(post_ids))}
+        comment_rows = [dict(body='Nice post!', author_id=rng.choice(user_ids),
+                             post_id=rng.choice(post_ids),
+                             timestamp=now - timedelta(minutes=rng.randrange(60 * 24 * 30)))
+                        for _ in range(comments * len(post_ids))]
+        conn = db.session.connection()
+        if follow_rows:
+            conn.execute(sa.insert(Follow.__table__), [
+                dict(follower_id=a, followed_id=b, timestamp=now) for a, b in follow_rows])
+        if like_rows:
+            conn.execute(sa.insert(Like.__table__), [
+                dict(author_id=a, post_id=p) for a, p in like_rows])
+        if comment_rows:
+            conn.execute(sa.insert(Comment.__table__), comment_rows)
+        conn.execute(sa.update(Post.__table__).values(like_count=sa.select(sa.func.count())
+                     .where(Like.post_id == Post.id).scalar_subquery()))
+        db.session.commit()
+    return dict(users=users, follows=len(follow_rows), posts=len(post_ids),
+                likes=len(like_rows), comments=len(comment_rows))
+
+
+class Fixture:
+    """Ids, usernames and feed cursors the journeys pick from."""
+
+    def __init__(self, app, rng):
+        self.rng = rng
+        with app.app_context():
+            users = db.session.execute(sa.select(User.id, User.username)).all()
+            self.post_ids = db.session.scalars(sa.select(Post.id)).all()
+            keys = db.session.execute(
+                sa.select(Post.timestamp, Post.id).order_by(Post.timestamp.desc(), Post.id.desc())
+            ).all()
+            with app.test_request_context():
+                self.cursors = [encode_cursor(list(keys[i]))
+                                for i in range(4, min(len(keys), 5 * CURSOR_PAGES), 5)]
+        self.user_ids = [row.id for row in users]
+        self.usernames = [row.username for row in users]
+        if not self.post_ids or len(self.user_ids) < 2:
+            raise ValueError('the benchmark database needs users and posts; seed it first')
+
+    def journey(self, name, client):
+        """Make one request of journey ``name``; returns the response."""
+        rng = self.rng
+        if name == 'feed':
+            return client.get('/feed')
+        if name == 'feed_scroll':
+            return client.get('/api/feed', params={'cursor': rng.choice(self.cursors)})
+        if name == 'profile':
+            return client.get(f'/user/{rng.choice(self.usernames)}')
+        if name == 'network':
+            return client.get('/network')
+        if name == 'like':
+            return client.post(f'/like_post/{rng.choice(self.post_ids)}',
+                               json={'liked': rng.random() < 0.5})
+        if name == 'comment':
+            post_id = rng.choice(self.post_ids)
+            return client.post(f'/add_comment/{post_id}',
+                               json={'body': 'Benchmark comment', 'post_id': post_id})
+        if name in ('follow', 'unfollow'):
+            return client.get(f'/{name}/{rng.choice(self.usernames)}')
+        raise KeyError(name)
+
+
+# CLIENTS
+def session_cookie(app, user_id):
+    """A signed Flask session cookie logging in ``user_id``."""
+    serializer = app.session_interface.get_signing_serializer(app)
+    return serializer.dumps({'_user_id': str(user_id), '_fresh': True})
+
+
+class TestClient:
+    """Flask test client with the httpx call signature the journeys use."""
+
+    def __init__(self, app, user_id):
+        self.client = app.test_client()
+        self.client.set_cookie(app.config.get('SESSION_COOKIE_NAME', 'session'),
+                               session_cookie(app, user_id))
+
+    def get(self, path, params=None):
+        return self.client.get(path, query_string=params)
+
+    def post(self, path, json=None):
+        return self.client.post(path, json=json)
+
+
+def status_of(response):
+    return getattr(response, 'status_code', None)
+
+
+# QUERY COUNTING
+def count_queries(app):
+    """Report each request's SQL statement count in a response header."""
+    @app.after_request
+    def report_count(response):
+        stats = query_stats.current()
+        if stats is not None:
+            response.headers[QUERY_HEADER] = str(stats.count)
+        return response
+
+
+# STATISTICS
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    # nearest rank
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def summarize(samples, elapsed=None):
+    """{journey: stats} from [(journey, seconds, queries, status)]."""
+    by_journey = {}
+    for name, seconds, queries, status in samples:
+        by_journey.setdefault(name, []).append((seconds, queries, status))
+    report = {}
+    for name, rows in sorted(by_journey.items()):
+        latencies = sorted(seconds * 1000 for seconds, _, _ in rows)
+        queries = [q for _, q, _ in rows if q is not None]
+        report[name] = {
+            'requests': len(rows),
+            'errors': sum(1 for _, _, status in rows if status is None or status >= 400),
+            'p50_ms': round(percentile(latencies, 50), 2),
+            'p95_ms': round(percentile(latencies, 95), 2),
+            'p99_ms': round(percentile(latencies, 99), 2),
+            'queries': round(sum(queries) / len(queries), 2) if queries else None,
+        }
+    if elapsed:
+        report['_total'] = {
+            'requests': len(samples),
+            'seconds': round(elapsed, 3),
+            'throughput_rps': round(len(samples) / elapsed, 1),
+        }
+    return report
+
+
+def timed(fixture, name, client):
+    start = time.perf_counter()
+    try:
+        response = fixture.journey(name, client)
+    except Exception:
+        return name, time.perf_counter() - start, None, None
+    seconds = time.perf_counter() - start
+    queries = response.headers.get(QUERY_HEADER)
+    return name, seconds, int(queries) if queries is not None else None, status_of(response)
+
+
+# RUNS
+def run_sequential(app, fixture, requests_per_journey=100, journeys=None):
+    """Each journey ``requests_per_journey`` times through the test client."""
+    client = TestClient(app, fixture.user_ids[0])
+    samples = []
+    for name in journeys or MIX:
+        # the first request of a journey pays for template compilation
+        fixture.journey(name, client)
+        samples += [timed(fixture, name, client) for _ in range(requests_per_journey)]
+    return summarize(samples)
+
+
+def run_concurrent(app, fixture, total=1000, concurrency=16, url=None, journeys=None):
+    """``total`` requests of the journey mix from ``concurrency`` threads over HTTP.
+
+    Without ``url`` the app is served in-process by a threaded werkzeug
+    server; pass the URL of a gunicorn started with FLASK_CONFIG=benchmark
+    to load the production server instead.
+    """
+    import httpx
+    from werkzeug.serving import make_server, WSGIRequestHandler
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = None
+    if url is None:
+        server = make_server('127.0.0.1', 0, app, threaded=True,
+                             request_handler=QuietHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f'http://127.0.0.1:{server.server_port}'
+
+    mix = {name: weight for name, weight in MIX.items() if not journeys or name in journeys}
+    plan = fixture.rng.choices(list(mix), weights=list(mix.values()), k=total)
+    cookie_name = app.config.get('SESSION_COOKIE_NAME', 'session')
+    clients = [
+        httpx.Client(base_url=url, timeout=30, cookies={
+            cookie_name: session_cookie(app, fixture.user_ids[i % len(fixture.user_ids)])})
+        for i in range(concurrency)
+    ]
+
+    def worker(i):
+        return [timed(fixture, name, clients[i]) for name in plan[i::concurrency]]
+
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            samples = [sample for chunk in pool.map(worker, range(concurrency))
+                       for sample in chunk]
+        elapsed = time.perf_counter() - start
+    finally:
+        for client in clients:
+            client.close()
+        if server is not None:
+            server.shutdown()
+    return summarize(samples, elapsed)
+
+
+# BASELINES
+def environment(app, volumes):
+    with app.app_context():
+        dialect = db.engine.dialect.name
+    return {
+        'date': datetime.utcnow().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'database': dialect,
+        'volumes': volumes,
+    }
+
+
+def save(path, results):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def compare(baseline, results, tolerance=0.2):
+    """Regressions of ``results`` against ``baseline``, as readable lines.
+
+    A journey regresses when its p95 or its mean queries per request grow
+    by more than ``tolerance`` (queries vary a little with the random
+    users and posts picked, an N+1 multiplies them).
+    """
+    regressions = []
+    for phase in ('sequential', 'concurrent'):
+        old_phase, new_phase = baseline.get(phase, {}), results.get(phase, {})
+        for name, new in new_phase.items():
+            old = old_phase.get(name)
+            if old is None or name == '_total':
+                continue
+            if old['p95_ms'] and new['p95_ms'] > old['p95_ms'] * (1 + tolerance):
+                regressions.append(f"{phase}/{name}: p95 {old['p95_ms']} -> {new['p95_ms']} ms")
+            if old.get('queries') is not None and new.get('queries') is not None \
+                    and new['queries'] > old['queries'] * (1 + tolerance):
+                regressions.append(f"{phase}/{name}: queries {old['queries']} -> {new['queries']}")
+        old_total, new_total = old_phase.get('_total'), new_phase.get('_total')
+        if old_total and new_total and \
+                new_total['throughput_rps'] < old_total['throughput_rps'] * (1 - tolerance):
+            regressions.append(f"{phase}: throughput {old_total['throughput_rps']} -> "
+                               f"{new_total['throughput_rps']} req/s")
+    return regressions
+
+
+def format_report(phase, report):
+    lines = [f'{phase}:',
+             f"  {'journey':<12}{'n':>6}{'err':>5}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'queries':>9}"]
+    for name, stats in report.items():
+        if name == '_total':
+            continue
+        queries = '-' if stats['queries'] is None else stats['queries']
+        lines.append(f"  {name:<12}{stats['requests']:>6}{stats['errors']:>5}"
+                     f"{stats['p50_ms']:>9}{stats['p95_ms']:>9}{stats['p99_ms']:>9}{queries:>9}")
+    total = report.get('_total')
+    if total:
+        lines.append(f"  {total['requests']} requests in {total['seconds']}s, "
+                     f"{total['throughput_rps']} req/s")
+    return '\n'.join(lines)
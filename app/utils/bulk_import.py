@@ -0,0 +1,317 @@
+import csv
+import json
+import os
+import random
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import partial
+from types import SimpleNamespace
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql, sqlite
+from werkzeug.security import generate_password_hash
+from app.models import User, Post, Follow, PostTag, PostMention
+from app.utils.avatar import email_hash
+from app.utils.search import document, index_documents
+from app.utils.tags import extract_tags, extract_mentions, save_rows
+from app.utils.ranking import recompute
+
+users = User.__table__
+posts = Post.__table__
+follows = Follow.__table__
+
+USER_FIELDS = ('name', 'headline', 'education', 'talks_about', 'location', 'about_me')
+
+
+# SOURCES
+def read_rows(path):
+    """Stream dicts from a .csv (with a header row) or .jsonl file."""
+    ext = os.path.splitext(path)[1].lower()
+    with open(path, newline='' if ext == '.csv' else None, encoding='utf-8') as f:
+        if ext == '.csv':
+            yield from csv.DictReader(f)
+        elif ext in ('.jsonl', '.ndjson'):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            raise ValueError(f'{path}: expected a .csv or .jsonl file')
+
+
+def write_rows(path, rows):
+    """Write dicts as JSON lines, e.g. a generated data set to import later."""
+    count = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        for row in rows:
+            f.write(json.dumps(row, default=str) + '\n')
+            count += 1
+    return count
+
+
+def batched(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def truthy(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'y', 't')
+    return bool(value)
+
+
+def parse_time(value, default):
+    if not value:
+        return default
+    if isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(value)
+
+
+# GENERATED DATA
+def generate_users(count, prefix='user', password_hash=None, start=0, now=None):
+    """Users ``<prefix><n>``; one password hash shared by all keeps it fast."""
+    now = now or datetime.utcnow()
+    password_hash = password_hash or generate_password_hash('password')
+    for i in range(start, start + count):
+        yield dict(username=f'{prefix}{i}', email=f'{prefix}{i}@example.test',
+                   password_hash=password_hash, confirmed=True, name=f'User {i}',
+                   headline=f'Generated user {i}', about_me='Generated by flask import-data.',
+                   member_since=now - timedelta(days=365))
+
+
+def generate_follows(usernames, per_user, rng=None):
+    rng = rng or random.Random(1)
+    for follower in usernames:
+        for followed in rng.sample(usernames, min(per_user, len(usernames))):
+            if followed != follower:
+                yield dict(follower=follower, followed=followed)
+
+
+def generate_posts(count, usernames, rng=None, days=30, now=None):
+    """Markdown posts with #topic tags and the odd @mention, over ``days`` days."""
+    rng = rng or random.Random(1)
+    now = now or datetime.utcnow()
+    for i in range(count):
+        mention = f' cc @{rng.choice(usernames)}' if rng.random() < 0.1 else ''
+        yield dict(author=rng.choice(usernames),
+                   body=f'Post {i} with some **markdown** about #topic{i % 25}{mention}',
+                   timestamp=now - timedelta(minutes=rng.randrange(60 * 24 * days)))
+
+
+# PARALLEL WORK
+def prepare_post(body):
+    """(body_html, tags, mentions) of a body; runs in the worker processes."""
+    return Post.render_body(body), extract_tags(body), extract_mentions(body)
+
+
+class RemoteWriter:
+    """Replays imported batches on the remote, one transaction per batch.
+
+    A single thread keeps them in order (follows after their users) while
+    the next local batch is prepared; at most ``max_pending`` batches wait.
+    """
+
+    def __init__(self, engine, max_pending=2):
+        self.engine = engine
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix='import-remote')
+        self.pending = deque()
+
+    def submit(self, func, *args):
+        self.pending.append(self.executor.submit(self._run, func, *args))
+        while len(self.pending) > self.max_pending:
+            self.pending.popleft().result()
+
+    def _run(self, func, *args):
+        with self.engine.begin() as conn:
+            func(conn, *args)
+
+    def close(self):
+        try:
+            while self.pending:
+                self.pending.popleft().result()
+        finally:
+            self.executor.shutdown()
+
+
+# IMPORT
+def insert_ignore(conn, table, rows):
+    """Insert ``rows``, skipping those whose primary key already exists."""
+    dialect = {'postgresql': postgresql, 'sqlite': sqlite}.get(conn.dialect.name)
+    if dialect is None:
+        raise NotImplementedError(f'cannot import into a {conn.dialect.name} database')
+    conn.execute(dialect.insert(table).on_conflict_do_nothing(
+        index_elements=[column.name for column in table.primary_key]), rows)
+
+
+def replay(conn, inserts, docs):
+    """Write an imported batch to the remote: [(table, rows)] and search documents."""
+    for table, rows in inserts:
+        if rows:
+            insert_ignore(conn, table, rows)
+    index_documents(conn, docs)
+
+
+class Importer:
+    """Bulk-loads users, follows and posts in batches, one commit per batch.
+
+    Rows go in with executemany; passwords are hashed and bodies rendered
+    by ``workers`` processes (0: in this one). Each batch also gets its
+    search documents, tags and mentions, and is replayed on the remote
+    when ``remote`` is an engine. Imported posts are history, so they
+    don't count towards trending tags; call finish() to rank them.
+    """
+
+    def __init__(self, conn, remote=None, workers=None, batch_size=1000,
+                 password_method='scrypt'):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.password_method = password_method
+        self.workers = os.cpu_count() if workers is None else workers
+        self.pool = ProcessPoolExecutor(self.workers) if self.workers else None
+        self.remote = RemoteWriter(remote) if remote is not None else None
+
+    def map(self, func, items):
+        if self.pool is None:
+            return list(map(func, items))
+        # a few chunks per process: fewer round trips, still balanced
+        chunksize = max(1, len(items) // (4 * self.workers))
+        return list(self.pool.map(func, items, chunksize=chunksize))
+
+    def ids_by_username(self, names):
+        names = list(set(names))
+        if not names:
+            return {}
+        return dict(self.conn.execute(
+            sa.select(users.c.username, users.c.id).where(users.c.username.in_(names))).all())
+
+    def commit(self, inserts, docs):
+        index_documents(self.conn, docs)
+        self.conn.commit()
+        if self.remote is not None:
+            self.remote.submit(replay, inserts, docs)
+
+    def users(self, rows):
+        """Yields (imported, skipped) per batch.
+
+        Rows whose username or email exists, or with neither a password nor
+        a password_hash, are skipped.
+        """
+        for batch in batched(rows, self.batch_size):
+            existing = self.conn.execute(
+                sa.select(users.c.username, users.c.email).where(sa.or_(
+                    users.c.username.in_([row['username'] for row in batch]),
+                    users.c.email.in_([row['email'] for row in batch])))).all()
+            names = {row.username for row in existing}
+            emails = {row.email for row in existing}
+            new = []
+            for row in batch:
+                if row['username'] in names or row['email'] in emails \
+                        or not (row.get('password') or row.get('password_hash')):
+                    continue
+                names.add(row['username'])
+                emails.add(row['email'])
+                new.append(row)
+
+            to_hash = [row['password'] for row in new if not row.get('password_hash')]
+            hashes = iter(self.map(partial(generate_password_hash, method=self.password_method),
+                                   to_hash))
+            values = []
+            for row in new:
+                member_since = parse_time(row.get('member_since'), datetime.utcnow())
+                value = dict(
+                    username=row['username'], email=row['email'],
+                    password_hash=row.get('password_hash') or next(hashes),
+                    confirmed=truthy(row.get('confirmed')),
+                    avatar_hash=email_hash(row['email']),
+                    member_since=member_since, last_seen=member_since)
+                value.update({field: row.get(field) or None for field in USER_FIELDS})
+                values.append(value)
+
+            if values:
+                ids = self.conn.execute(
+                    sa.insert(users).returning(users.c.id, sort_by_parameter_order=True),
+                    values).scalars().all()
+                for value, user_id in zip(values, ids):
+                    value['id'] = user_id
+            docs = [document('user', SimpleNamespace(**value)) for value in values]
+            self.commit([(users, values)], docs)
+            yield len(values), len(batch) - len(values)
+
+    def follows(self, rows):
+        """Yields (imported, skipped) per batch of follower/followed usernames."""
+        for batch in batched(rows, self.batch_size):
+            ids = self.ids_by_username(
+                [row['follower'] for row in batch] + [row['followed'] for row in batch])
+            values, seen = [], set()
+            for row in batch:
+                key = (ids.get(row['follower']), ids.get(row['followed']))
+                if None in key or key[0] == key[1] or key in seen:
+                    continue
+                seen.add(key)
+                values.append(dict(follower_id=key[0], followed_id=key[1],
+                                   timestamp=parse_time(row.get('timestamp'),
+                                                        datetime.utcnow())))
+            if values:
+                insert_ignore(self.conn, follows, values)
+            self.commit([(follows, values)], [])
+            yield len(values), len(batch) - len(values)
+
+    def posts(self, rows):
+        """Yields (imported, skipped) per batch; posts by unknown authors are skipped."""
+        for batch in batched(rows, self.batch_size):
+            authors = self.ids_by_username(row['author'] for row in batch)
+            batch_posts = [row for row in batch if row['author'] in authors]
+            prepared = self.map(prepare_post, [row['body'] or '' for row in batch_posts])
+            mentioned = self.ids_by_username(
+                name for _, _, names in prepared for name in names)
+
+            values = []
+            for row, (body_html, _, _) in zip(batch_posts, prepared):
+                values.append(dict(
+                    body=row['body'] or '', body_html=body_html,
+                    post_name=row.get('post_name') or '',
+                    media_url=row.get('media_url') or None,
+                    media_type=row.get('media_type') or None,
+                    timestamp=parse_time(row.get('timestamp'), datetime.utcnow()),
+                    featured=truthy(row.get('featured')),
+                    like_count=0, rank_score=0, author_id=authors[row['author']]))
+            tags, mentions = [], []
+            if values:
+                ids = self.conn.execute(
+                    sa.insert(posts).returning(posts.c.id, sort_by_parameter_order=True),
+                    values).scalars().all()
+                for value, post_id, (_, post_tags, names) in zip(values, ids, prepared):
+                    value['id'] = post_id
+                    tags += [dict(post_id=post_id, tag=tag, timestamp=value['timestamp'])
+                             for tag in post_tags]
+                    mentions += [dict(post_id=post_id, user_id=mentioned[name],
+                                      timestamp=value['timestamp'])
+                                 for name in names if name in mentioned]
+                save_rows(self.conn, tags, mentions)
+            docs = [document('post', SimpleNamespace(**value)) for value in values]
+            self.commit([(posts, values), (PostTag.__table__, tags),
+                         (PostMention.__table__, mentions)], docs)
+            yield len(values), len(batch) - len(values)
+
+    def finish(self):
+        """Rank the imported posts, locally and on the remote; waits for the remote."""
+        recompute(self.conn)
+        self.conn.commit()
+        try:
+            if self.remote is not None:
+                self.remote.submit(recompute)
+                self.remote.close()
+        finally:
+            self.close()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
@@ -0,0 +1,80 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class WriteCoalescer:
+    """Collapse rapid writes to the same key into the last one.
+
+    ``submit(key, value, original)`` records the desired value for ``key``.
+    After ``window`` seconds (counted from the first submit, so a stream of
+    flips can't postpone it forever) ``apply(key, value)`` runs once on a
+    background thread with the final value. If the final value equals the
+    value the key had before the first submit, nothing is applied.
+    """
+
+    def __init__(self, apply, window):
+        self.apply = apply
+        self.window = window
+        self.pending = {}  # key -> [value, original, due]
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.thread = None
+
+    def submit(self, key, value, original=None):
+        with self.lock:
+            entry = self.pending.get(key)
+            if entry is None:
+                self.pending[key] = [value, original, time.monotonic() + self.window]
+            else:
+                entry[0] = value
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run, name='write-coalescer', daemon=True)
+                self.thread.start()
+            self.wakeup.notify()
+
+    def pending_value(self, key, default=None):
+        with self.lock:
+            entry = self.pending.get(key)
+            return default if entry is None else entry[0]
+
+    def __len__(self):
+        return len(self.pending)
+
+    def _take_due(self, now=None):
+        due = []
+        for key, (value, original, deadline) in list(self.pending.items()):
+            if now is None or deadline <= now:
+                del self.pending[key]
+                if value != original:
+                    due.append((key, value))
+        return due
+
+    def _apply_all(self, items):
+        for key, value in items:
+            try:
+                self.apply(key, value)
+            except Exception:
+                logger.exception('coalesced write for %r failed', key)
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while not self.pending:
+                    self.wakeup.wait()
+                now = time.monotonic()
+                next_due = min(entry[2] for entry in self.pending.values())
+                if next_due > now:
+                    self.wakeup.wait(next_due - now)
+                    continue
+                items = self._take_due(now)
+            self._apply_all(items)
+
+    def flush(self):
+        """Apply everything pending right now (shutdown, tests)."""
+        with self.lock:
+            items = self._take_due()
+        self._apply_all(items)
@@ -0,0 +1,345 @@
+import hashlib
+import json
+import os
+import time
+from bisect import bisect_right
+from collections import namedtuple
+from datetime import datetime
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql, sqlite
+from app.models import User, Post, Comment, Follow, Like, PostTag, PostMention
+from app.utils import metrics
+
+# key: how rows are matched across the stores; columns: what dual_db
+# replicates and so must agree (last_seen, rank_score, ... legitimately
+# differ); timestamp: when a row was written, for the lag estimate;
+# generated: columns the remote assigns itself (likes get their own ids)
+TableSpec = namedtuple('TableSpec', 'table key columns timestamp generated')
+
+SPECS = [
+    TableSpec(User.__table__, ('id',),
+              ('username', 'email', 'password_hash', 'confirmed', 'name', 'headline',
+               'location', 'about_me', 'avatar_hash'), 'member_since', ()),
+    TableSpec(Post.__table__, ('id',),
+              ('body', 'post_name', 'media_url', 'media_type', 'timestamp', 'featured',
+               'like_count', 'author_id'), 'timestamp', ()),
+    TableSpec(Comment.__table__, ('id',),
+              ('body', 'timestamp', 'author_id', 'post_id'), 'timestamp', ()),
+    TableSpec(Follow.__table__, ('follower_id', 'followed_id'), (), 'timestamp', ()),
+    TableSpec(Like.__table__, ('author_id', 'post_id'), (), None, ('id',)),
+    TableSpec(PostTag.__table__, ('post_id', 'tag'), ('timestamp',), 'timestamp', ()),
+    TableSpec(PostMention.__table__, ('post_id', 'user_id'), ('timestamp',), 'timestamp', ()),
+]
+SPECS_BY_NAME = {spec.table.name: spec for spec in SPECS}
+SEPARATOR = '\x1f'
+NULL = '\\N'
+
+
+# ROW HASHES
+# Both stores must render a row to the same text: Python does it for rows
+# it reads, Postgres in SQL so that only per-chunk sums cross the network.
+def text_of(value):
+    if value is None:
+        return NULL
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S.%f')
+    return str(value)
+
+
+def row_hash(values):
+    """First 60 bits of the md5 of a row's text, as an int."""
+    text = SEPARATOR.join(text_of(v) for v in values)
+    return int(hashlib.md5(text.encode(), usedforsecurity=False).hexdigest()[:15], 16)
+
+
+def sql_text_of(column):
+    if isinstance(column.type, sa.DateTime):
+        value = sa.func.to_char(column, 'YYYY-MM-DD HH24:MI:SS.US')
+    else:
+        value = sa.cast(column, sa.Text)
+    return sa.func.coalesce(value, NULL)
+
+
+def sql_row_hash(columns):
+    text = sa.func.concat_ws(SEPARATOR, *[sql_text_of(c) for c in columns])
+    hex_digits = sa.literal('x') + sa.func.substr(sa.func.md5(text), 1, 15)
+    return sa.cast(sa.cast(hex_digits, postgresql.BIT(60)), sa.BigInteger)
+
+
+def hashed_columns(spec):
+    return [spec.table.c[name] for name in spec.key + spec.columns]
+
+
+def chunk_column(spec):
+    # chunks split on the leading key column, an integer in every table, so
+    # both stores agree on the ranges whatever their collation
+    return spec.table.c[spec.key[0]]
+
+
+# CHUNK DIGESTS
+class Digest:
+    """Row count and sum of row hashes of one chunk; order doesn't matter."""
+
+    __slots__ = ('rows', 'total')
+
+    def __init__(self, rows=0, total=0):
+        self.rows = rows
+        self.total = total
+
+    def add(self, value):
+        self.rows += 1
+        self.total += value
+
+    def __eq__(self, other):
+        return (self.rows, self.total) == (other.rows, other.total)
+
+
+def local_digests(conn, spec, chunk_size):
+    """Walk the table in key order; returns (chunk starts, {chunk: Digest}).
+
+    Chunk ``i`` holds leading keys in ``[starts[i - 1], starts[i])``, the
+    same convention as bisect_right and Postgres' width_bucket.
+    """
+    columns = hashed_columns(spec)
+    result = conn.execution_options(stream_results=True, yield_per=chunk_size).execute(
+        sa.select(*columns).order_by(*[spec.table.c[name] for name in spec.key]))
+    starts, digests = [], {}
+    current, previous = None, None
+    for row in result:
+        lead = row[0]
+        if current is None or (current.rows >= chunk_size and lead != previous):
+            starts.append(lead)
+            current = digests[len(starts)] = Digest()
+        current.add(row_hash(row))
+        previous = lead
+    return starts, digests
+
+
+def remote_digests(conn, spec, starts):
+    """{chunk: Digest} of the other store for the local chunk ``starts``."""
+    column = chunk_column(spec)
+    columns = hashed_columns(spec)
+    if conn.dialect.name == 'postgresql':
+        bucket = sa.func.width_bucket(column, postgresql.array(starts)) if starts \
+            else sa.literal(0)
+        rows = conn.execute(
+            sa.select(bucket, sa.func.count(), sa.func.sum(sql_row_hash(columns)))
+            .group_by(bucket)
+        ).all()
+        return {chunk: Digest(count, int(total)) for chunk, count, total in rows}
+
+    # other stores (a SQLite remote in development) hash in Python
+    digests = {}
+    result = conn.execution_options(stream_results=True, yield_per=1000).execute(
+        sa.select(*columns))
+    for row in result:
+        chunk = bisect_right(starts, row[0])
+        digests.setdefault(chunk, Digest()).add(row_hash(row))
+    return digests
+
+
+def chunk_range(spec, starts, chunk):
+    column = chunk_column(spec)
+    clauses = []
+    if chunk > 0:
+        clauses.append(column >= starts[chunk - 1])
+    if chunk < len(starts):
+        clauses.append(column < starts[chunk])
+    return sa.and_(sa.true(), *clauses)
+
+
+def row_hashes(conn, spec, where):
+    """{key: row hash} of the rows matching ``where``."""
+    columns = hashed_columns(spec)
+    width = len(spec.key)
+    if conn.dialect.name == 'postgresql':
+        rows = conn.execute(sa.select(*columns[:width], sql_row_hash(columns)).where(where))
+        return {tuple(row[:width]): row[width] for row in rows}
+    rows = conn.execute(sa.select(*columns).where(where))
+    return {tuple(row[:width]): row_hash(row) for row in rows}
+
+
+# VERIFICATION
+class TableReport:
+    def __init__(self, name):
+        self.name = name
+        self.chunks = 0
+        self.mismatched_chunks = 0
+        self.local_rows = 0
+        self.remote_rows = 0
+        self.missing = []  # keys only in the local store
+        self.extra = []  # keys only in the remote store
+        self.differing = []  # keys whose replicated columns differ
+        self.oldest_missing = None
+
+    @property
+    def consistent(self):
+        return not (self.missing or self.extra or self.differing)
+
+    def as_dict(self):
+        return {
+            'chunks': self.chunks,
+            'mismatched_chunks': self.mismatched_chunks,
+            'local_rows': self.local_rows,
+            'remote_rows': self.remote_rows,
+            'missing': len(self.missing),
+            'extra': len(self.extra),
+            'differing': len(self.differing),
+            'oldest_missing': self.oldest_missing.isoformat() if self.oldest_missing else None,
+        }
+
+
+def verify_table(local, remote, spec, chunk_size=500):
+    """Compare one table chunk by chunk; only mismatched chunks are read row by row."""
+    report = TableReport(spec.table.name)
+    starts, mine = local_digests(local, spec, chunk_size)
+    theirs = remote_digests(remote, spec, starts)
+    report.chunks = len(starts)
+    report.local_rows = sum(d.rows for d in mine.values())
+    report.remote_rows = sum(d.rows for d in theirs.values())
+
+    for chunk in sorted(set(mine) | set(theirs)):
+        if mine.get(chunk, Digest()) == theirs.get(chunk, Digest()):
+            continue
+        report.mismatched_chunks += 1
+        where = chunk_range(spec, starts, chunk)
+        local_rows = row_hashes(local, spec, where)
+        remote_rows = row_hashes(remote, spec, where)
+        for key, value in local_rows.items():
+            if key not in remote_rows:
+                report.missing.append(key)
+            elif remote_rows[key] != value:
+                report.differing.append(key)
+        report.extra += [key for key in remote_rows if key not in local_rows]
+
+    if report.missing and spec.timestamp:
+        report.oldest_missing = min(
+            (ts for ts in select_column(local, spec, spec.timestamp, report.missing)
+             if ts is not None), default=None)
+    return report
+
+
+def key_filter(spec, keys):
+    columns = [spec.table.c[name] for name in spec.key]
+    if len(columns) == 1:
+        return columns[0].in_([key[0] for key in keys])
+    return sa.tuple_(*columns).in_(keys)
+
+
+def batches(items, size=500):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def select_column(conn, spec, name, keys):
+    for batch in batches(keys):
+        yield from conn.execute(
+            sa.select(spec.table.c[name]).where(key_filter(spec, batch))).scalars()
+
+
+def verify(local, remote, tables=None, chunk_size=500):
+    """[TableReport] for ``tables`` (default: every replicated table)."""
+    specs = [SPECS_BY_NAME[name] for name in tables] if tables else SPECS
+    return [verify_table(local, remote, spec, chunk_size) for spec in specs]
+
+
+# REPAIR
+def upsert(conn, spec, rows):
+    dialect = {'postgresql': postgresql, 'sqlite': sqlite}.get(conn.dialect.name)
+    if dialect is None:
+        raise NotImplementedError(f'cannot repair a {conn.dialect.name} database')
+    statement = dialect.insert(spec.table)
+    if spec.columns:
+        statement = statement.on_conflict_do_update(
+            index_elements=list(spec.key),
+            set_={name: statement.excluded[name] for name in spec.columns})
+    else:
+        statement = statement.on_conflict_do_nothing(index_elements=list(spec.key))
+    conn.execute(statement, rows)
+
+
+def repair(local, remote, reports):
+    """Make the remote match the local store for the rows in ``reports``.
+
+    Missing rows are inserted whole and differing rows get the local
+    values; rows only the remote has are deleted, children first. Search
+    documents aren't touched: run ``flask reindex-search --remote`` after.
+    Returns the number of rows written.
+    """
+    written = 0
+    by_name = {report.name: report for report in reports}
+    for spec in SPECS:
+        report = by_name.get(spec.table.name)
+        if report is None or not (report.missing or report.differing):
+            continue
+        columns = [c for c in spec.table.c if c.name not in spec.generated]
+        for batch in batches(report.missing + report.differing):
+            rows = [dict(row._mapping) for row in local.execute(
+                sa.select(*columns).where(key_filter(spec, batch)))]
+            if rows:
+                upsert(remote, spec, rows)
+                written += len(rows)
+    for spec in reversed(SPECS):
+        report = by_name.get(spec.table.name)
+        if report is None:
+            continue
+        for batch in batches(report.extra):
+            written += remote.execute(
+                sa.delete(spec.table).where(key_filter(spec, batch))).rowcount
+    return written
+
+
+# STATUS
+# `flask verify-replication` saves its findings for /metrics to report
+def save_status(path, reports, now=None):
+    status = {
+        'verified_at': (now or time.time()),
+        'tables': {report.name: report.as_dict() for report in reports},
+    }
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(status, f, indent=1)
+    os.replace(tmp_path, path)
+    return status
+
+
+def load_status(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+divergent_rows = metrics.gauge(
+    'replication_divergent_rows', 'Rows that differ between the stores at the last '
+    'verification, by table and kind (missing, extra, differing).',
+    ('table', 'kind'), merge='max')
+unreplicated_age = metrics.gauge(
+    'replication_unreplicated_age_seconds', 'Age of the oldest local row the remote '
+    'lacked at the last verification; 0 when it had them all.', merge='max')
+last_verified = metrics.gauge(
+    'replication_last_verified_timestamp_seconds', 'When the stores were last compared.',
+    merge='max')
+
+
+def init_app(app):
+    path = app.config['REPLICATION_STATUS_FILE']
+
+    @metrics.collector
+    def collect_replication_status():
+        status = load_status(path)
+        if status is None:
+            return
+        last_verified.set(status['verified_at'])
+        oldest = None
+        for name, table in status['tables'].items():
+            for kind in ('missing', 'extra', 'differing'):
+                divergent_rows.set(table[kind], name, kind)
+            if table['oldest_missing']:
+                ts = datetime.fromisoformat(table['oldest_missing'])
+                oldest = ts if oldest is None else min(oldest, ts)
+        unreplicated_age.set(
+            (datetime.utcnow() - oldest).total_seconds() if oldest else 0)
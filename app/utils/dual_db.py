@@ -1,19 +1,98 @@
-import os
 import sqlalchemy as sa
-from sqlalchemy.orm import sessionmaker
+import atexit
 import threading
+import time
+from functools import wraps
+from flask import current_app
 from app.models import User, Post, Like, Comment
 from app import db
+from app.utils.likes import set_like
+from app.utils.routing import mark_write
+from app.utils.coalesce import WriteCoalescer
+from app.utils.live import get_events
+from app.utils.aio import background
+from app.utils import metrics
+from app.utils.services import remote_enabled, remote_engine, remote_session, storage
+from app.utils.search import document, index_documents, KINDS
+from app.utils.tags import post_rows, save_rows
+from app.utils.trending import get_trending
+from app.utils.ranking import rescore
+from app.utils.profiles import forget_user, forget_post
 
-REMOTE_DB_URL = os.environ.get('REMOTE_CTRACK_DB_URL')
-remote_engine = sa.create_engine(REMOTE_DB_URL) if REMOTE_DB_URL else None
-RemoteSession = sessionmaker(bind=remote_engine) if remote_engine else None
+
+replication_queue = metrics.gauge(
+    'replication_queue_depth', 'Remote writes queued or running.')
+replication_lag = metrics.histogram(
+    'replication_lag_seconds', 'From queueing a remote write to its commit, by operation.',
+    ('operation',), buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+replication_writes = metrics.counter(
+    'replication_writes_total', 'Remote writes, by operation and result.',
+    ('operation', 'result'))
+replication_oldest = metrics.gauge(
+    'replication_oldest_pending_seconds', 'Age of the oldest remote write still '
+    'queued or running in any worker.', merge='max')
+_pending_writes = {}  # token -> time.monotonic() when queued
+_pending_lock = threading.Lock()
+
+
+@metrics.collector
+def collect_pending_writes():
+    with _pending_lock:
+        oldest = min(_pending_writes.values(), default=None)
+    replication_oldest.set(time.monotonic() - oldest if oldest is not None else 0)
 
 
 # ASYNC WRITE TO REMOTE
 def async_write_to_remote(func, *args, **kwargs):
-    if remote_engine:
-        threading.Thread(target=func, args=args, kwargs=kwargs).start()
+    # psycopg2 blocks, so replication shares the background loop's bounded
+    # executor instead of starting a thread per write
+    if remote_enabled():
+        # create_post.<locals>.remote_commit -> create_post.remote_commit
+        operation = func.__qualname__.replace('<locals>.', '')
+        queued = time.monotonic()
+        token = object()
+
+        @wraps(func)
+        def replicate():
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                # the change is lost; `flask verify-replication` finds it
+                replication_writes.inc(operation, 'error')
+                raise
+            else:
+                replication_writes.inc(operation, 'ok')
+                replication_lag.observe(time.monotonic() - queued, operation)
+            finally:
+                replication_queue.dec()
+                with _pending_lock:
+                    _pending_writes.pop(token, None)
+
+        with _pending_lock:
+            _pending_writes[token] = queued
+        replication_queue.inc()
+        background.submit_blocking(replicate)
+
+
+# SEARCH INDEX
+def index_for_search(*objs):
+    """Upsert the search documents of objs in the current transaction.
+
+    Returns the documents so the caller can pass them to index_remote()
+    once the transaction has committed.
+    """
+    db.session.flush()
+    docs = [document(KINDS[type(obj)], obj) for obj in objs]
+    index_documents(db.session.connection(), docs)
+    return docs
+
+
+def index_remote(docs):
+    if remote_enabled():
+        def remote_index():
+            with remote_engine().begin() as conn:
+                index_documents(conn, docs)
+        async_write_to_remote(remote_index)
 
 
 # REGISTER USER
@@ -21,24 +100,27 @@ def register_user(username, email, password_hash):
     user = User(username=username, email=email)
     user.password_hash = password_hash
     db.session.add(user)
+    docs = index_for_search(user)
     db.session.commit()
-    user_data = dict(id=user.id, username=user.username, email=user.email, password_hash=user.password_hash)
-    if remote_engine:
+    user_data = dict(id=user.id, username=user.username, email=user.email,
+                     password_hash=user.password_hash, avatar_hash=user.avatar_hash)
+    if remote_enabled():
         def remote_commit():
-            session = RemoteSession()
+            session = remote_session()
             remote_user = User(**user_data)
             session.add(remote_user)
             session.commit()
             session.close()
         async_write_to_remote(remote_commit)
+    index_remote(docs)
     return user
 
 
 # CONFIRM USER
 def confirm_user(email):
-    if remote_engine:
+    if remote_enabled():
         def remote_confirm():
-            session = RemoteSession()
+            session = remote_session()
             remote_user = session.query(User).filter_by(email=email).first()
             if remote_user:
                 remote_user.confirmed = True
@@ -47,18 +129,48 @@ def confirm_user(email):
         async_write_to_remote(remote_confirm)
     return True
 
-from supabase import create_client, Client
+# UPDATE PASSWORD HASH
+def update_password_hash(user: User):
+    # a sign-in rehashed the password with the current settings
+    db.session.commit()
+    user_id = user.id
+    password_hash = user.password_hash
+    if remote_enabled():
+        def remote_update():
+            with remote_engine().begin() as conn:
+                conn.execute(sa.update(User.__table__).where(User.__table__.c.id == user_id)
+                             .values(password_hash=password_hash))
+        async_write_to_remote(remote_update)
 
-SUPABASE_URL = os.environ.get("SUPABASE_URL")
-SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
-def upload_media_to_supabase(file, filename, bucket="ctrack"):
-    response = supabase.storage.from_(bucket).upload(filename, file)
-    # print('response: ', response)
-    url = supabase.storage.from_(bucket).get_public_url(filename)
+media_uploads = metrics.counter(
+    'media_uploads_total', 'Uploads to Supabase storage, by result.', ('result',))
+media_upload_bytes = metrics.counter(
+    'media_upload_bytes_total', 'Bytes uploaded to Supabase storage.')
+media_upload_duration = metrics.histogram(
+    'media_upload_duration_seconds', 'Time to upload one file to Supabase storage.',
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+
+
+async def upload_media(file, filename, bucket="ctrack"):
+    # runs on the background loop, which owns the client and its connections
+    started = time.perf_counter()
+    try:
+        bucket = (await storage()).from_(bucket)
+        await bucket.upload(filename, file)
+        url = await bucket.get_public_url(filename)
+    except Exception:
+        media_uploads.inc('error')
+        raise
+    media_uploads.inc('ok')
+    media_upload_bytes.inc(amount=len(file))
+    media_upload_duration.observe(time.perf_counter() - started)
     return url
 
+
+def upload_media_to_supabase(file, filename, bucket="ctrack"):
+    return background.run(upload_media(file, filename, bucket), timeout=60)
+
 # CREATE POST
 def create_post(body, post_name, post_data, author_id) -> Post:
     # Upload media to Supabase Storage
@@ -83,7 +195,13 @@ def create_post(body, post_name, post_data, author_id) -> Post:
     )
     # Save to local DB
     db.session.add(post)
+    docs = index_for_search(post)
+    tags, mentions = post_rows(db.session.connection(), post)
+    save_rows(db.session.connection(), tags, mentions)
+    rescore(db.session.connection(), post.id)
     db.session.commit()
+    forget_user(author_id)
+    get_trending(current_app._get_current_object()).record([row['tag'] for row in tags])
 
     post_id = post.id
     post_body = post.body
@@ -93,12 +211,13 @@ def create_post(body, post_name, post_data, author_id) -> Post:
     post_media_type = post.media_type
     post_timestamp = post.timestamp
     post_featured = post.featured
+    post_rank_score = post.rank_score
     post_author_id = post.author_id
 
     # Save to remote DB asynchronously
-    if remote_engine:
+    if remote_enabled():
         def remote_commit():
-            session = RemoteSession()
+            session = remote_session()
             remote_post = Post(
                 id=post_id,
                 body=post_body,
@@ -108,17 +227,27 @@ def create_post(body, post_name, post_data, author_id) -> Post:
                 media_type=post_media_type,
                 timestamp=post_timestamp,
                 featured=post_featured,
+                rank_score=post_rank_score,
                 author_id=post_author_id
             )
             session.add(remote_post)
+            session.flush()
+            save_rows(session.connection(), tags, mentions)
             session.commit()
             session.close()
         async_write_to_remote(remote_commit)
+    index_remote(docs)
     return post
 
 
 # UPDATE USER PROFILE
 def update_user_profile(user: User):
+    # name, username and headline are searchable
+    docs = index_for_search(user)
+    db.session.commit()
+    forget_user(user.id)
+    index_remote(docs)
+
     user_id = user.id
     username = user.username
     full_name = user.name
@@ -126,9 +255,9 @@ def update_user_profile(user: User):
     location = user.location
     about_me = user.about_me
 
-    if remote_engine:
+    if remote_enabled():
         def remote_update():
-            session = RemoteSession()
+            session = remote_session()
             remote_user = session.get(User, user_id)
             if remote_user:
                 remote_user.username = username
@@ -142,20 +271,82 @@ def update_user_profile(user: User):
 
 
 # LIKE/UNLIKE POST
+def set_post_like(author_id, post_id, liked=None):
+    """Like/unlike (toggle when liked is None); returns (liked, like_count) or None."""
+    try:
+        result = set_like(db.session.connection(), author_id, post_id, liked)
+        if result is not None:
+            rescore(db.session.connection(), post_id)
+            get_events().record(db.session.connection(), post_id, likes=result[1])
+    except sa.exc.IntegrityError:
+        # the post doesn't exist (foreign key)
+        result = None
+    if result is None:
+        db.session.rollback()
+        return None
+    db.session.commit()
+    mark_write(db.session)
+    forget_post(post_id)
+    toggle_like_remote(author_id, post_id, result[0])
+    return result
+
+
+_like_buffer_lock = threading.Lock()
+
+
+def get_like_buffer(app):
+    """The app's like coalescer, or None when LIKE_COALESCE_WINDOW_MS is 0."""
+    window = app.config['LIKE_COALESCE_WINDOW_MS'] / 1000
+    if not window:
+        return None
+    with _like_buffer_lock:
+        buffer = app.extensions.get('like_buffer')
+        if buffer is None:
+            def apply(key, liked):
+                with app.app_context():
+                    set_post_like(*key, liked)
+            buffer = app.extensions['like_buffer'] = WriteCoalescer(apply, window)
+            atexit.register(buffer.flush)
+    return buffer
+
+
+def queue_post_like(author_id, post_id, liked=None):
+    """Like/unlike through the coalescing buffer; returns (liked, like_count) or None.
+
+    Only the state a user settles on within the window is written, locally
+    and on the remote. The returned count already includes the pending change.
+    Pending likes live in this worker's buffer, so toggles landing on
+    different workers are written separately; the page's own debounce
+    (like() in static/js/script.js) is what keeps one browser's clicks
+    together. Nothing is written here, so the browser isn't pinned to the
+    primary (see app/utils/routing.py); set_post_like() marks the write
+    once the buffer flushes it.
+    """
+    buffer = get_like_buffer(current_app._get_current_object())
+    if buffer is None:
+        return set_post_like(author_id, post_id, liked)
+
+    row = db.session.query(
+        Post.like_count,
+        sa.exists().where(Like.author_id == author_id, Like.post_id == Post.id)
+    ).filter(Post.id == post_id).first()
+    if row is None:
+        return None
+    like_count, stored = row
+
+    key = (author_id, post_id)
+    if liked is None:
+        liked = not buffer.pending_value(key, stored)
+    buffer.submit(key, liked, original=stored)
+    return liked, like_count + (int(liked) - int(stored))
+
+
 def toggle_like_remote(author_id, post_id, like):
-    if remote_engine:
+    if remote_enabled():
         def remote_toggle():
-            session = RemoteSession()
-            remote_like = session.query(Like).filter_by(author_id=author_id, post_id=post_id).first()
-            if like:
-                if not remote_like:
-                    remote_like = Like(author_id=author_id, post_id=post_id)
-                    session.add(remote_like)
-            else:
-                if remote_like:
-                    session.delete(remote_like)
-            session.commit()
-            session.close()
+            with remote_engine().begin() as conn:
+                if set_like(conn, author_id, post_id, like) is not None:
+                    rescore(conn, post_id)
         async_write_to_remote(remote_toggle)
 
 
@@ -163,7 +354,12 @@ def toggle_like_remote(author_id, post_id, like):
 def create_comment(body, post: Post, author: User):
     comment = Comment(body=body, post=post, author=author)
     db.session.add(comment)
+    docs = index_for_search(comment)
+    rescore(db.session.connection(), comment.post_id)
+    get_events().record(db.session.connection(), comment.post_id, comments=db.session.query(
+        sa.func.count(Comment.id)).filter(Comment.post_id == comment.post_id).scalar())
     db.session.commit()
+    forget_post(comment.post_id)
 
     # Extract values before leaving app/request context
     comment_id = comment.id
@@ -172,9 +368,9 @@ def create_comment(body, post: Post, author: User):
     comment_author_id = comment.author_id
     comment_timestamp = comment.timestamp
 
-    if remote_engine:
+    if remote_enabled():
         def remote_commit():
-            session = RemoteSession()
+            session = remote_session()
             remote_comment = Comment(
                 id=comment_id,
                 body=comment_body,
@@ -183,17 +379,20 @@ def create_comment(body, post: Post, author: User):
                 timestamp=comment_timestamp
             )
             session.add(remote_comment)
+            session.flush()
+            rescore(session.connection(), comment_post_id)
             session.commit()
             session.close()
         async_write_to_remote(remote_commit)
+    index_remote(docs)
     return comment
 
 
 # FOLLOW USER
 def follow_user_remote(follower_id, followed_id):
-    if remote_engine:
+    if remote_enabled():
         def remote_follow():
-            session = RemoteSession()
+            session = remote_session()
             # Assuming you have a Follow model with follower_id and followed_id
             from app.models import Follow
             follow = session.query(Follow).filter_by(follower_id=follower_id, followed_id=followed_id).first()
@@ -207,9 +406,9 @@ def follow_user_remote(follower_id, followed_id):
 
 # UNFOLLOW USER
 def unfollow_user_remote(follower_id, followed_id):
-    if remote_engine:
+    if remote_enabled():
         def remote_unfollow():
-            session = RemoteSession()
+            session = remote_session()
             from app.models import Follow
             follow = session.query(Follow).filter_by(follower_id=follower_id, followed_id=followed_id).first()
             if follow:
@@ -0,0 +1,149 @@
+import threading
+import time
+import sqlalchemy as sa
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+# name -> PoolStats, one entry per instrumented engine ('local', 'remote')
+pool_stats = {}
+
+
+class PoolStats:
+    """Checkout/wait counters for one engine's connection pool."""
+
+    def __init__(self, name):
+        self.name = name
+        self.capacity = None
+        self.lock = threading.Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.saturated = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.timeouts = 0
+
+    def on_connect(self, dbapi_conn, record):
+        with self.lock:
+            self.connects += 1
+
+    def on_checkout(self, dbapi_conn, record, proxy):
+        with self.lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            if self.capacity and self.in_use >= self.capacity:
+                self.saturated += 1
+
+    def on_checkin(self, dbapi_conn, record):
+        with self.lock:
+            self.in_use = max(self.in_use - 1, 0)
+
+    def record_wait(self, seconds, timed_out=False):
+        with self.lock:
+            self.waits += 1
+            self.wait_time += seconds
+            self.max_wait = max(self.max_wait, seconds)
+            if timed_out:
+                self.timeouts += 1
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'capacity': self.capacity,
+                'connects': self.connects,
+                'checkouts': self.checkouts,
+                'in_use': self.in_use,
+                'peak_in_use': self.peak_in_use,
+                'saturated_checkouts': self.saturated,
+                'wait_avg_ms': round(self.wait_time / self.waits * 1000, 3) if self.waits else 0.0,
+                'wait_max_ms': round(self.max_wait * 1000, 3),
+                'timeouts': self.timeouts,
+            }
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that reports how long callers wait for a connection."""
+
+    stats = None
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except sa.exc.TimeoutError:
+            if self.stats:
+                self.stats.record_wait(time.perf_counter() - start, timed_out=True)
+            raise
+        if self.stats:
+            self.stats.record_wait(time.perf_counter() - start)
+        return conn
+
+    def recreate(self):
+        # dispose() swaps in a fresh pool; keep reporting into the same stats
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+
+def is_memory_sqlite(url):
+    url = make_url(url)
+    return url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')
+
+
+def engine_options(url, config, prefix='DB'):
+    """create_engine() keyword arguments for ``url`` from ``<prefix>_*`` settings."""
+    url = make_url(url)
+    if is_memory_sqlite(url):
+        # in-memory SQLite needs SQLAlchemy's single-connection pool
+        return {}
+
+    options = {
+        'poolclass': TimedQueuePool,
+        'pool_size': config[f'{prefix}_POOL_SIZE'],
+        'max_overflow': config[f'{prefix}_MAX_OVERFLOW'],
+        'pool_timeout': config[f'{prefix}_POOL_TIMEOUT'],
+        'pool_recycle': config[f'{prefix}_POOL_RECYCLE'],
+        'pool_pre_ping': config[f'{prefix}_POOL_PRE_PING'],
+    }
+    statement_timeout = config[f'{prefix}_STATEMENT_TIMEOUT_MS']
+    if url.get_backend_name() == 'postgresql' and statement_timeout:
+        options['connect_args'] = {
+            'options': f'-c statement_timeout={statement_timeout}'
+        }
+    return options
+
+
+def set_sqlite_pragmas(engine, pragmas):
+    """Run ``PRAGMA key=value`` on every new SQLite connection."""
+    @sa.event.listens_for(engine, 'connect')
+    def on_connect(dbapi_conn, record):
+        cursor = dbapi_conn.cursor()
+        for key, value in pragmas.items():
+            cursor.execute(f'PRAGMA {key}={value}')
+        cursor.close()
+
+
+def configure_engine(engine, name, config, prefix='DB'):
+    """Attach PRAGMAs and pool metrics to an engine created with engine_options()."""
+    if engine.dialect.name == 'sqlite':
+        pragmas = dict(config['SQLITE_PRAGMAS'])
+        if is_memory_sqlite(engine.url):
+            pragmas.pop('journal_mode', None)
+            pragmas.pop('mmap_size', None)
+        set_sqlite_pragmas(engine, pragmas)
+
+    stats = pool_stats[name] = PoolStats(name)
+    if isinstance(engine.pool, TimedQueuePool):
+        stats.capacity = config[f'{prefix}_POOL_SIZE'] + max(config[f'{prefix}_MAX_OVERFLOW'], 0)
+        engine.pool.stats = stats
+    sa.event.listen(engine, 'connect', stats.on_connect)
+    sa.event.listen(engine, 'checkout', stats.on_checkout)
+    sa.event.listen(engine, 'checkin', stats.on_checkin)
+    return engine
+
+
+def pool_status():
+    return {name: stats.as_dict() for name, stats in pool_stats.items()}
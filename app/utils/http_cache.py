@@ -0,0 +1,121 @@
+import hashlib
+import os
+import time
+from functools import wraps
+from flask import request, session, current_app, make_response
+from flask_login import current_user
+from app.utils import metrics
+
+
+# CONDITIONAL GET
+def conditional(version):
+    """Answer GET/HEAD with 304 Not Modified while ``version`` is unchanged.
+
+    ``version(*args, **kwargs)`` gets the view's arguments and returns
+    ``(last_modified, tokens)``: cheap values (newest timestamps, counters,
+    the few row values a page shows) that change whenever the rendered page
+    would. They are hashed together with the viewer and the build into a
+    weak ETag, which is compared before the view runs, so a revalidation
+    costs only the version queries.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD') \
+                    or not current_app.config['CONDITIONAL_GET'] \
+                    or '_flashes' in session:
+                return f(*args, **kwargs)
+
+            last_modified, tokens = version(*args, **kwargs)
+            etag = make_etag(tokens)
+            if request.if_none_match.contains_weak(etag):
+                metrics.cache_requests.inc('conditional_get', 'hit')
+                response = current_app.response_class(status=304)
+            else:
+                metrics.cache_requests.inc('conditional_get', 'miss')
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag, weak=True)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            # personalised pages: the browser may keep them, but must ask first
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            response.vary.add('Cookie')
+            return response
+        return decorated
+    return decorator
+
+
+def make_etag(tokens):
+    """Hash page tokens with everything else a rendered page depends on."""
+    parts = [
+        current_app.extensions['http_cache']['build_id'],
+        current_user.get_id(),
+        csrf_bucket(),
+        tokens,
+    ]
+    return hashlib.blake2b(repr(parts).encode(), digest_size=12).hexdigest()
+
+
+def csrf_bucket():
+    # pages embed CSRF tokens, which expire; re-render well before they do
+    limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    if not limit:
+        return None
+    return int(time.time() // (limit / 2))
+
+
+# STATIC FINGERPRINTS
+_file_hashes = {}
+
+
+def file_hash(path):
+    """Short content hash of a file, recomputed only when it changes."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    if key not in _file_hashes:
+        with open(path, 'rb') as f:
+            _file_hashes[key] = hashlib.blake2b(f.read(), digest_size=6).hexdigest()
+    return _file_hashes[key]
+
+
+def build_id(app):
+    """Hash of the code, templates and static files this process serves."""
+    digest = hashlib.blake2b(digest_size=8)
+    for dirpath, dirnames, filenames in sorted(os.walk(app.root_path)):
+        if '__pycache__' in dirpath:
+            continue
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            digest.update(os.path.relpath(path, app.root_path).encode())
+            digest.update((file_hash(path) or '').encode())
+    return digest.hexdigest()
+
+
+def init_app(app):
+    app.extensions['http_cache'] = {'build_id': build_id(app)}
+
+    @app.url_defaults
+    def fingerprint_static(endpoint, values):
+        # /static/css/style.css?v=<hash>: a new file means a new URL, so
+        # browsers can keep the old one forever
+        if endpoint == 'static' and 'filename' in values and 'v' not in values:
+            digest = file_hash(os.path.join(app.static_folder, values['filename']))
+            if digest:
+                values['v'] = digest
+
+    @app.after_request
+    def cache_static(response):
+        if request.endpoint == 'static' and 'v' in request.args \
+                and response.status_code in (200, 304):
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = app.config['STATIC_MAX_AGE']
+            response.cache_control.immutable = True
+        return response
@@ -0,0 +1,71 @@
+import os
+import subprocess
+import sys
+
+OWN_PACKAGES = {'app', 'ctrack', 'config'}
+STARTUP = '(interpreter startup)'
+
+
+class Node:
+    def __init__(self, name, self_us, children):
+        self.name = name
+        self.self_us = self_us
+        self.children = children
+
+
+def parse(stderr):
+    """Turn ``-X importtime`` output into a list of import trees."""
+    pending = {}  # depth -> children seen so far
+    roots = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        node = Node(name.strip(), int(self_us), pending.pop(depth + 1, []))
+        if depth == 0:
+            roots.append(node)
+        else:
+            pending.setdefault(depth, []).append(node)
+    return roots
+
+
+def subsystem(name):
+    """Our modules by name (app.utils.dual_db), others by top-level package."""
+    parts = name.split('.')
+    if parts[0] == 'app':
+        return '.'.join(parts[:3])
+    return parts[0]
+
+
+def summarize(roots, target):
+    """Self time per subsystem, in microseconds.
+
+    A third-party package is charged with everything it pulls in, so
+    ``supabase`` includes httpx, pydantic and friends unless something
+    imported those first, the same attribution the interpreter uses.
+    """
+    totals = {}
+
+    def walk(node, owner):
+        if owner is None and node.name.split('.')[0] not in OWN_PACKAGES:
+            owner = subsystem(node.name)
+        key = owner or subsystem(node.name)
+        totals[key] = totals.get(key, 0) + node.self_us
+        for child in node.children:
+            walk(child, owner)
+
+    for root in roots:
+        walk(root, None if root.name == target else STARTUP)
+    return totals
+
+
+def import_profile(module='ctrack'):
+    """Import ``module`` in a fresh interpreter and summarize where time went."""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True, env=os.environ.copy()
+    )
+    if result.returncode:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    return summarize(parse(result.stderr), module)
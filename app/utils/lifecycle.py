@@ -0,0 +1,46 @@
+from app import db
+from app.utils.aio import background
+from app.utils import services, metrics
+
+
+def after_fork(app):
+    """Re-initialise per-process resources in a freshly forked worker.
+
+    With a preloaded app, workers inherit the master's pools and clients;
+    sockets must not be shared across processes, so they are dropped here
+    and reopened on first use.
+    """
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+    # the remote engine, and the storage client bound to the master's loop
+    services.reset()
+    # the like coalescer's, trending counter's and feed ranker's threads
+    # didn't survive the fork
+    app.extensions.pop('like_buffer', None)
+    app.extensions.pop('trending_tags', None)
+    app.extensions.pop('feed_ranker', None)
+    # counters start from zero in every worker; the writer thread is gone too
+    metrics.reset()
+    app.extensions.pop('metrics_writer', None)
+
+
+def drain(app, timeout=10):
+    """Finish deferred writes before the process exits.
+
+    Coalesced likes and trending tag counts are written first, since likes
+    queue their replication; then replication and email get ``timeout``
+    seconds. The final metrics snapshot is written last, so it counts them.
+    Returns how many background tasks were still running.
+    """
+    buffer = app.extensions.get('like_buffer')
+    if buffer is not None:
+        buffer.flush()
+    trending = app.extensions.get('trending_tags')
+    if trending is not None:
+        trending.flush()
+    left = background.drain(timeout)
+    writer = app.extensions.get('metrics_writer')
+    if writer is not None:
+        writer.write()
+    return left
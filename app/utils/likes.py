@@ -0,0 +1,78 @@
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql, sqlite
+from app.models import Post, Like
+
+likes = Like.__table__
+posts = Post.__table__
+
+
+def set_like(conn, author_id, post_id, liked=None):
+    """Like or unlike a post and keep posts.like_count in step.
+
+    ``liked=None`` toggles. Returns ``(liked, like_count)``, or None when
+    the post doesn't exist (the caller must roll back). Safe to repeat and
+    to run concurrently thanks to the unique (author_id, post_id) index.
+    """
+    if liked is None:
+        # an unlike that removes nothing means the post wasn't liked yet
+        result = apply_like(conn, author_id, post_id, False)
+        if result is None:
+            return None
+        if result[0]:
+            return False, result[1]
+        liked = True
+    result = apply_like(conn, author_id, post_id, liked)
+    if result is None:
+        return None
+    return liked, result[1]
+
+
+def apply_like(conn, author_id, post_id, liked):
+    """Insert/delete one like; returns (changed, like_count) or None."""
+    match = sa.and_(likes.c.author_id == author_id, likes.c.post_id == post_id)
+
+    if conn.dialect.name == 'postgresql':
+        # one statement: the like change and the counter update together
+        if liked:
+            change = postgresql.insert(likes).values(author_id=author_id, post_id=post_id) \
+                .on_conflict_do_nothing(index_elements=['author_id', 'post_id'])
+        else:
+            change = sa.delete(likes).where(match)
+        change = change.returning(likes.c.post_id).cte('change')
+        delta = sa.select(sa.func.count()).select_from(change).scalar_subquery()
+        row = conn.execute(
+            sa.update(posts).where(posts.c.id == post_id)
+            .values(like_count=posts.c.like_count + (delta if liked else -delta))
+            .returning(posts.c.like_count, delta)
+        ).first()
+        if row is None:
+            return None
+        return row[1] > 0, row[0]
+
+    if liked:
+        if conn.dialect.name == 'sqlite':
+            changed = conn.execute(
+                sqlite.insert(likes).values(author_id=author_id, post_id=post_id)
+                .on_conflict_do_nothing(index_elements=['author_id', 'post_id'])
+            ).rowcount == 1
+        else:
+            try:
+                with conn.begin_nested():
+                    conn.execute(sa.insert(likes).values(author_id=author_id, post_id=post_id))
+                changed = True
+            except sa.exc.IntegrityError:
+                changed = False
+    else:
+        changed = conn.execute(sa.delete(likes).where(match)).rowcount > 0
+
+    delta = (1 if liked else -1) if changed else 0
+    update = sa.update(posts).where(posts.c.id == post_id) \
+        .values(like_count=posts.c.like_count + delta)
+    if conn.dialect.update_returning:
+        row = conn.execute(update.returning(posts.c.like_count)).first()
+    else:
+        conn.execute(update)
+        row = conn.execute(sa.select(posts.c.like_count).where(posts.c.id == post_id)).first()
+    if row is None:
+        return None
+    return changed, row[0]
@@ -0,0 +1,199 @@
+import json
+import logging
+import os
+import threading
+import time
+from flask import current_app
+import sqlalchemy as sa
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    """Counts waiting to be sent to one stream, merged per post.
+
+    A slow client never builds a backlog: newer counts for a post replace
+    older ones, so memory is bounded by the number of watched posts.
+    """
+
+    def __init__(self, post_ids):
+        self.post_ids = post_ids
+        self.pending = {}
+        self.cond = threading.Condition()
+
+    def put(self, post_id, counts):
+        with self.cond:
+            self.pending.setdefault(post_id, {}).update(counts)
+            self.cond.notify()
+
+    def get(self, timeout):
+        """Wait up to ``timeout`` seconds; returns {post_id: counts} (maybe empty)."""
+        with self.cond:
+            if not self.pending:
+                self.cond.wait(timeout)
+            batch, self.pending = self.pending, {}
+        return batch
+
+
+class CountBroker:
+    """In-process pub/sub of like/comment counts, indexed by post id.
+
+    Only the standard library's locks and conditions are used, so it works
+    with threaded workers and, monkey-patched, with gevent.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = {}  # post_id -> set of Subscription
+
+    def subscribe(self, post_ids):
+        sub = Subscription(post_ids)
+        with self.lock:
+            for post_id in post_ids:
+                self.subscribers.setdefault(post_id, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            for post_id in sub.post_ids:
+                subs = self.subscribers.get(post_id)
+                if subs:
+                    subs.discard(sub)
+                    if not subs:
+                        del self.subscribers[post_id]
+
+    def publish(self, post_id, **counts):
+        with self.lock:
+            subs = list(self.subscribers.get(post_id, ()))
+        for sub in subs:
+            sub.put(post_id, counts)
+
+    def connections(self):
+        with self.lock:
+            return len({sub for subs in self.subscribers.values() for sub in subs})
+
+    def watching(self):
+        return bool(self.subscribers)
+
+
+broker = CountBroker()
+
+
+class CountEvents:
+    """Carries new counts from the process that wrote them to every process's broker.
+
+    Writers add a count_events row in their own transaction (record()).
+    While a process has streams open, one thread polls the table every
+    ``interval`` seconds and publishes the new rows to its broker; rows
+    older than ``keep`` seconds are deleted now and then. ``interval=0``
+    publishes straight to this process's broker instead (tests).
+    """
+
+    BATCH = 1000
+
+    def __init__(self, broker, engine, interval=1.0, keep=60):
+        from app.models import CountEvent
+        self.broker = broker
+        self.engine = engine
+        self.table = CountEvent.__table__
+        self.interval = interval
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pid = None
+        self.last_id = None
+        self.since = None
+        self.next_prune = 0
+
+    def record(self, conn, post_id, **counts):
+        if not self.interval:
+            self.broker.publish(post_id, **counts)
+            return
+        conn.execute(sa.insert(self.table).values(post_id=post_id, created=time.time(),
+                                                  **counts))
+
+    def start(self):
+        """Make sure this process polls; called when a stream opens."""
+        with self.lock:
+            # first stream, or a forked worker that didn't inherit the thread
+            if self.interval and self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.last_id = None
+                self.since = time.time()
+                threading.Thread(target=self._run, name='live-events', daemon=True).start()
+        self.wakeup.set()
+
+    def _run(self):
+        while True:
+            if not self.broker.watching():
+                self.wakeup.wait()
+                self.wakeup.clear()
+                # older rows are older than the counts the new pages show
+                self.last_id = None
+                self.since = time.time()
+            time.sleep(self.interval)
+            try:
+                self.poll()
+            except Exception:
+                logger.exception('polling count_events failed')
+
+    def poll(self, now=None):
+        """Publish rows written since the last poll; returns how many."""
+        table = self.table
+        if self.last_id is None:
+            where = table.c.created >= self.since
+        else:
+            # ids are handed out in commit order on SQLite; on Postgres a
+            # row may commit after a later one and be skipped, which the
+            # post's next count makes good
+            where = table.c.id > self.last_id
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                sa.select(table.c.id, table.c.post_id, table.c.likes, table.c.comments)
+                .where(where).order_by(table.c.id).limit(self.BATCH)).all()
+            for row in rows:
+                counts = {name: getattr(row, name) for name in ('likes', 'comments')
+                          if getattr(row, name) is not None}
+                self.broker.publish(row.post_id, **counts)
+            if rows:
+                self.last_id = rows[-1].id
+
+            now = time.time() if now is None else now
+            if now >= self.next_prune:
+                conn.execute(sa.delete(table).where(table.c.created < now - self.keep))
+                conn.commit()
+                self.next_prune = now + self.keep
+        return len(rows)
+
+
+def get_events(app=None):
+    app = app or current_app._get_current_object()
+    return app.extensions['count_events']
+
+
+def init_app(app):
+    from app import db
+    with app.app_context():
+        app.extensions['count_events'] = CountEvents(
+            broker, db.engine, interval=app.config['LIVE_POLL_SECONDS'],
+            keep=app.config['LIVE_EVENT_RETENTION_SECONDS'])
+
+
+def event_stream(sub, heartbeat, max_seconds):
+    """Yield SSE messages for ``sub`` until ``max_seconds`` have passed.
+
+    The browser's EventSource reconnects on its own, which lets workers
+    recycle long-lived connections.
+    """
+    deadline = time.monotonic() + max_seconds
+    try:
+        yield 'retry: 3000\n\n'
+        while time.monotonic() < deadline:
+            batch = sub.get(heartbeat)
+            if batch:
+                payload = {str(post_id): counts for post_id, counts in batch.items()}
+                yield f'data: {json.dumps(payload, separators=(",", ":"))}\n\n'
+            else:
+                yield ': ping\n\n'
+    finally:
+        broker.unsubscribe(sub)
@@ -0,0 +1,427 @@
+import atexit
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, request
+from app.utils import query_stats
+from app.utils.engine import pool_stats
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'ctrack_'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+ARCHIVE = 'archive.json'
+
+
+# METRIC TYPES
+class Metric:
+    """A named family of values, one per combination of label values.
+
+    Updates take the metric's own lock for a single dict operation, so
+    threads only contend on the same metric and never wait on I/O.
+    """
+
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = PREFIX + name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def set(self, value, *labels):
+        """Overwrite a value; collectors use it to mirror totals kept elsewhere."""
+        with self.lock:
+            self.values[labels] = value
+
+    def samples(self):
+        with self.lock:
+            return [[list(labels), value] for labels, value in self.values.items()]
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that goes up and down; ``merge`` is how workers' values combine.
+
+    'sum' suits per-process amounts (connections in use), 'max' values
+    every worker reports alike or where the worst one matters (ages).
+    """
+
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), merge='sum'):
+        super().__init__(name, documentation, labels)
+        self.merge = merge
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def value(self, *labels):
+        with self.lock:
+            return self.values.get(labels, 0)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        # per label set: [count per bucket..., count above the last, sum]
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def samples(self):
+        with self.lock:
+            return [[list(labels), list(counts)] for labels, counts in self.values.items()]
+
+
+# REGISTRY
+registry = {}  # name -> Metric
+collectors = []  # callables that refresh metrics mirrored from elsewhere
+_registry_lock = threading.Lock()
+
+
+def _register(cls, name, *args, **kwargs):
+    with _registry_lock:
+        metric = registry.get(PREFIX + name)
+        if metric is None:
+            metric = registry[PREFIX + name] = cls(name, *args, **kwargs)
+    return metric
+
+
+def counter(name, documentation, labels=()):
+    return _register(Counter, name, documentation, labels)
+
+
+def gauge(name, documentation, labels=(), merge='sum'):
+    return _register(Gauge, name, documentation, labels, merge=merge)
+
+
+def histogram(name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+    return _register(Histogram, name, documentation, labels, buckets=buckets)
+
+
+def collector(f):
+    """Run ``f()`` before every snapshot, e.g. to copy pool statistics."""
+    collectors.append(f)
+    return f
+
+
+def reset():
+    """Zero every metric, e.g. in a forked worker that inherited the master's."""
+    for metric in list(registry.values()):
+        metric.clear()
+
+
+def snapshot():
+    """This process's metrics as a JSON-serialisable dict."""
+    for collect in collectors:
+        try:
+            collect()
+        except Exception:
+            logger.exception('metrics collector %s failed', collect.__name__)
+    return {
+        name: {
+            'type': metric.type,
+            'help': metric.documentation,
+            'labels': list(metric.labels),
+            'buckets': list(getattr(metric, 'buckets', ())),
+            'merge': getattr(metric, 'merge', 'sum'),
+            'samples': metric.samples(),
+        }
+        for name, metric in list(registry.items())
+    }
+
+
+# MULTIPLE PROCESSES
+# With METRICS_DIR set, every worker writes its snapshot to <pid>.json
+# there; /metrics adds them all up. Counters and histograms of exited
+# workers are folded into archive.json so totals never go backwards;
+# gauges only count while their worker is alive.
+def merge(snapshots, into=None):
+    """Add snapshots together: sums (or maxima) per metric and label set."""
+    merged = into if into is not None else {}
+    for snap in snapshots:
+        for name, family in snap.items():
+            target = merged.setdefault(name, {**family, 'samples': []})
+            totals = {tuple(labels): value for labels, value in target['samples']}
+            for labels, value in family['samples']:
+                labels = tuple(labels)
+                if labels not in totals:
+                    totals[labels] = value
+                elif isinstance(value, list):
+                    totals[labels] = [a + b for a, b in zip(totals[labels], value)]
+                elif family.get('merge') == 'max':
+                    totals[labels] = max(totals[labels], value)
+                else:
+                    totals[labels] += value
+            target['samples'] = [[list(labels), value] for labels, value in totals.items()]
+    return merged
+
+
+def without_gauges(snap):
+    return {name: family for name, family in snap.items() if family['type'] != 'gauge'}
+
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_json(path, data):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def write_snapshot(directory):
+    write_json(os.path.join(directory, f'{os.getpid()}.json'), snapshot())
+
+
+def collect_all(directory):
+    """This process's live metrics merged with every other worker's last snapshot."""
+    own = f'{os.getpid()}.json'
+    snapshots = [snapshot()]
+    archive = read_json(os.path.join(directory, ARCHIVE))
+    if archive:
+        snapshots.append(archive)
+    for path in glob.glob(os.path.join(directory, '*.json')):
+        name = os.path.basename(path)
+        pid = name[:-len('.json')]
+        if name == own or not pid.isdigit():
+            continue
+        snap = read_json(path)
+        if snap is None:
+            continue
+        pid = int(pid)
+        snapshots.append(snap if pid_alive(pid) else without_gauges(snap))
+    return merge(snapshots)
+
+
+def mark_process_dead(pid, directory):
+    """Fold an exited worker's counters into the archive (gunicorn child_exit)."""
+    path = os.path.join(directory, f'{pid}.json')
+    snap = read_json(path)
+    if snap is None:
+        return
+    archive_path = os.path.join(directory, ARCHIVE)
+    archive = read_json(archive_path) or {}
+    write_json(archive_path, merge([without_gauges(snap)], into=archive))
+    os.remove(path)
+
+
+class SnapshotWriter:
+    """Writes this process's snapshot every ``interval`` seconds on a daemon thread."""
+
+    def __init__(self, directory, interval):
+        self.directory = directory
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None or not self.interval:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run, name='metrics-writer', daemon=True)
+                self.thread.start()
+
+    def write(self):
+        write_snapshot(self.directory)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write()
+            except Exception:
+                logger.exception('writing metrics snapshot failed')
+
+
+_writer_lock = threading.Lock()
+
+
+def get_writer(app):
+    """The app's per-process SnapshotWriter, or None without METRICS_DIR."""
+    directory = app.config['METRICS_DIR']
+    if not directory:
+        return None
+    with _writer_lock:
+        writer = app.extensions.get('metrics_writer')
+        if writer is None:
+            os.makedirs(directory, exist_ok=True)
+            writer = app.extensions['metrics_writer'] = SnapshotWriter(
+                directory, app.config['METRICS_FLUSH_SECONDS'])
+            atexit.register(writer.write)
+    return writer
+
+
+# EXPOSITION
+def _label_text(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+               for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(families):
+    """Prometheus text exposition format (version 0.0.4)."""
+    lines = []
+    for name, family in sorted(families.items()):
+        lines.append(f'# HELP {name} {family["help"]}')
+        lines.append(f'# TYPE {name} {family["type"]}')
+        names = family['labels']
+        for labels, value in sorted(family['samples'], key=lambda s: s[0]):
+            if family['type'] != 'histogram':
+                lines.append(f'{name}{_label_text(names, labels)} {_number(value)}')
+                continue
+            cumulative = 0
+            for bound, count in zip(family['buckets'] + [float('inf')], value[:-1]):
+                cumulative += count
+                le = _label_text(names, labels, [('le', _number(bound))])
+                lines.append(f'{name}_bucket{le} {cumulative}')
+            lines.append(f'{name}_sum{_label_text(names, labels)} {_number(value[-1])}')
+            lines.append(f'{name}_count{_label_text(names, labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+def exposition(app):
+    directory = app.config['METRICS_DIR']
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        return render(collect_all(directory))
+    return render(snapshot())
+
+
+# REQUESTS
+http_requests = counter(
+    'http_requests_total', 'Requests handled, by endpoint, method and status.',
+    ('endpoint', 'method', 'status'))
+http_duration = histogram(
+    'http_request_duration_seconds', 'Time to build a response, by endpoint.',
+    ('endpoint', 'method'))
+db_queries = counter(
+    'db_queries_total', 'SQL statements run by requests, by endpoint.', ('endpoint',))
+db_seconds = counter(
+    'db_query_seconds_total', 'Time requests spent in SQL statements, by endpoint.',
+    ('endpoint',))
+
+cache_requests = counter(
+    'cache_requests_total', 'Cache lookups, by cache and hit or miss.', ('cache', 'result'))
+
+
+# DATABASE POOLS
+pool_capacity = gauge(
+    'db_pool_capacity', 'Connections a pool may open (size + overflow).', ('pool',))
+pool_in_use = gauge(
+    'db_pool_connections_in_use', 'Connections checked out right now.', ('pool',))
+pool_checkouts = counter(
+    'db_pool_checkouts_total', 'Connections handed out by the pool.', ('pool',))
+pool_saturated = counter(
+    'db_pool_saturated_checkouts_total', 'Checkouts that left the pool full.', ('pool',))
+pool_wait_seconds = counter(
+    'db_pool_wait_seconds_total', 'Time spent waiting for a connection.', ('pool',))
+pool_timeouts = counter(
+    'db_pool_timeouts_total', 'Checkouts that gave up waiting.', ('pool',))
+
+
+@collector
+def collect_pools():
+    for name, stats in list(pool_stats.items()):
+        with stats.lock:
+            if stats.capacity:
+                pool_capacity.set(stats.capacity, name)
+            pool_in_use.set(stats.in_use, name)
+            pool_checkouts.set(stats.checkouts, name)
+            pool_saturated.set(stats.saturated, name)
+            pool_wait_seconds.set(stats.wait_time, name)
+            pool_timeouts.set(stats.timeouts, name)
+
+
+def init_app(app):
+    @app.before_request
+    def start_request_timer():
+        g.metrics_started = time.perf_counter()
+        writer = get_writer(app)
+        if writer is not None:
+            writer.start()
+
+    @app.after_request
+    def record_request(response):
+        started = g.get('metrics_started')
+        if started is None:
+            return response
+        # unmatched URLs share one label, so scanners can't add series
+        endpoint = request.endpoint or 'unmatched'
+        http_duration.observe(time.perf_counter() - started, endpoint, request.method)
+        http_requests.inc(endpoint, request.method, str(response.status_code))
+
+        stats = query_stats.current()
+        if stats is not None:
+            db_queries.inc(endpoint, amount=stats.count)
+            db_seconds.inc(endpoint, amount=stats.time)
+        return response
@@ -0,0 +1,109 @@
+import sqlite3
+from datetime import datetime
+import sqlalchemy as sa
+from flask import current_app
+from itsdangerous import URLSafeSerializer, BadSignature
+
+# dialects whose planners turn (a, b) < (x, y) into a single index range seek
+ROW_VALUE_DIALECTS = {'postgresql', 'mysql', 'mariadb'}
+if sqlite3.sqlite_version_info >= (3, 15):
+    ROW_VALUE_DIALECTS.add('sqlite')
+
+
+class KeysetPage:
+    """One page of a keyset-paginated query."""
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+# CURSORS
+def _serializer():
+    return URLSafeSerializer(current_app.config['SECRET_KEY'], salt='keyset-cursor')
+
+
+def encode_cursor(values, direction='next'):
+    """Sign the sort-key values of a row into an opaque cursor string."""
+    keys = [{'dt': v.isoformat()} if isinstance(v, datetime) else v for v in values]
+    return _serializer().dumps({'k': keys, 'd': direction})
+
+
+def decode_cursor(cursor):
+    """Return (values, direction), or (None, 'next') for a missing or bad cursor."""
+    if not cursor:
+        return None, 'next'
+    try:
+        data = _serializer().loads(cursor)
+        values = [datetime.fromisoformat(v['dt']) if isinstance(v, dict) else v
+                  for v in data['k']]
+        direction = data['d'] if data['d'] in ('next', 'prev') else 'next'
+    except (BadSignature, KeyError, TypeError, ValueError):
+        return None, 'next'
+    return values, direction
+
+
+# FILTERS
+def keyset_filter(columns, values, after=True, dialect_name=None):
+    """Rows strictly after (or before) ``values`` in descending key order.
+
+    Emits ``(c1, c2) < (:v1, :v2)`` where the dialect supports row values
+    and the equivalent OR/AND expansion elsewhere.
+    """
+    compare = (lambda c, v: c < v) if after else (lambda c, v: c > v)
+    if dialect_name in ROW_VALUE_DIALECTS:
+        return compare(
+            sa.tuple_(*columns),
+            sa.tuple_(*[sa.literal(v, c.type) for c, v in zip(columns, values)])
+        )
+
+    clauses = []
+    for i, column in enumerate(columns):
+        equal = [columns[j] == values[j] for j in range(i)]
+        clauses.append(sa.and_(*equal, compare(column, values[i])))
+    return sa.or_(*clauses)
+
+
+def paginate(query, columns, cursor=None, limit=5):
+    """Fetch one page of ``query`` ordered by ``columns`` descending.
+
+    ``columns`` must end in a unique column (usually the primary key) so the
+    order is total. Invalid cursors fall back to the first page.
+    """
+    values, direction = decode_cursor(cursor)
+    if values is not None and len(values) != len(columns):
+        values, direction = None, 'next'
+    dialect_name = query.session.get_bind().dialect.name
+
+    if values is None:
+        query = query.order_by(*[c.desc() for c in columns])
+    elif direction == 'next':
+        query = query.filter(keyset_filter(columns, values, True, dialect_name)) \
+            .order_by(*[c.desc() for c in columns])
+    else:
+        query = query.filter(keyset_filter(columns, values, False, dialect_name)) \
+            .order_by(*[c.asc() for c in columns])
+
+    items = query.limit(limit + 1).all()
+    has_more = len(items) > limit
+    items = items[:limit]
+    if direction == 'prev' and values is not None:
+        items.reverse()
+
+    def key(item):
+        return [getattr(item, c.key) for c in columns]
+
+    next_cursor = prev_cursor = None
+    if items:
+        if has_more or (direction == 'prev' and values is not None):
+            next_cursor = encode_cursor(key(items[-1]), 'next')
+        if values is not None and (direction == 'next' or has_more):
+            prev_cursor = encode_cursor(key(items[0]), 'prev')
+    return KeysetPage(items, next_cursor, prev_cursor)
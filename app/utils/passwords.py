@@ -0,0 +1,92 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash
+from app.utils import metrics
+
+hash_duration = metrics.histogram(
+    'password_hash_seconds', 'Time to hash or check a password, waiting included, '
+    'by operation.', ('operation',), buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+hash_rejected = metrics.counter(
+    'password_hash_rejected_total', 'Sign-ins and sign-ups turned away because every '
+    'hashing slot stayed busy.')
+
+
+class HashingBusy(RuntimeError):
+    """No hashing slot came free within PASSWORD_HASH_WAIT_SECONDS."""
+
+
+class PasswordHasher:
+    """Hashes and checks passwords off the request thread, a few at a time.
+
+    The work runs in ``workers`` processes (0: in the calling thread) and
+    at most ``concurrency`` calls per server process run or queue at once,
+    so a burst of sign-ins takes that much CPU and no more; the rest wait
+    up to ``wait`` seconds and then get HashingBusy. The pool starts on
+    first use, and again in a forked worker.
+    """
+
+    def __init__(self, method, workers=1, concurrency=2, wait=5.0):
+        self.method = method
+        self.workers = workers
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.wait = wait
+        self.lock = threading.Lock()
+        self.pool = None
+        self.pid = None
+        self.prefix = None
+
+    def _pool(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                # spawned, not forked: the children only import werkzeug
+                self.pool = ProcessPoolExecutor(
+                    self.workers, mp_context=multiprocessing.get_context('spawn'))
+                self.pid = os.getpid()
+            return self.pool
+
+    def _run(self, operation, func, *args):
+        started = time.perf_counter()
+        if not self.slots.acquire(timeout=self.wait):
+            hash_rejected.inc()
+            raise HashingBusy('too many passwords being hashed, try again shortly')
+        try:
+            if not self.workers:
+                return func(*args)
+            return self._pool().submit(func, *args).result()
+        finally:
+            self.slots.release()
+            hash_duration.observe(time.perf_counter() - started, operation)
+
+    def hash(self, password):
+        return self._run('hash', generate_password_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        if not pwhash:
+            return False
+        return self._run('verify', check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """True if ``pwhash`` was made with another algorithm or cost."""
+        if self.prefix is None:
+            # werkzeug fills in defaults ('pbkdf2' -> 'pbkdf2:sha256:1000000'),
+            # so ask it what the configured method stores
+            self.prefix = generate_password_hash('', self.method).split('$', 1)[0]
+        return pwhash.split('$', 1)[0] != self.prefix
+
+
+def get_hasher(app=None):
+    app = app or current_app._get_current_object()
+    return app.extensions['password_hasher']
+
+
+def init_app(app):
+    app.extensions['password_hasher'] = PasswordHasher(
+        app.config['PASSWORD_HASH_METHOD'],
+        workers=app.config['PASSWORD_HASH_WORKERS'],
+        concurrency=app.config['PASSWORD_HASH_CONCURRENCY'],
+        wait=app.config['PASSWORD_HASH_WAIT_SECONDS'],
+    )
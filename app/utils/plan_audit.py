@@ -0,0 +1,195 @@
+import inspect
+import json
+import re
+from datetime import datetime
+import sqlalchemy as sa
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+from app.models import User, Post, Comment, Like, Follow
+from app.utils.pagination import keyset_filter
+
+# name -> function returning the statement to explain
+hot_queries = {}
+
+
+def hot_query(name):
+    """Register a statement builder with the plan audit.
+
+    Builders that take a ``dialect_name`` argument get the audited
+    engine's dialect name.
+    """
+    def decorator(f):
+        hot_queries[name] = f
+        return f
+    return decorator
+
+
+class Explain(Executable, ClauseElement):
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain)
+def compile_explain(element, compiler, **kw):
+    if compiler.dialect.name == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        prefix = 'EXPLAIN (FORMAT JSON) '
+    return prefix + compiler.process(element.statement, **kw)
+
+
+# HOT QUERIES
+SAMPLE_ID = 1
+SAMPLE_TS = datetime(2025, 1, 1)
+
+
+@hot_query('load_user')
+def load_user_query():
+    return sa.select(User).where(User.id == SAMPLE_ID)
+
+
+@hot_query('login')
+def login_query():
+    return sa.select(User).where(User.email == 'someone@example.com')
+
+
+@hot_query('profile_user')
+def profile_user_query():
+    return sa.select(User).where(User.username == 'someone')
+
+
+@hot_query('feed_first_page')
+def feed_first_page_query():
+    return sa.select(Post).order_by(Post.timestamp.desc(), Post.id.desc()).limit(6)
+
+
+@hot_query('feed_next_page')
+def feed_next_page_query(dialect_name):
+    return sa.select(Post).where(
+        keyset_filter((Post.timestamp, Post.id), (SAMPLE_TS, SAMPLE_ID),
+                      dialect_name=dialect_name)
+    ).order_by(Post.timestamp.desc(), Post.id.desc()).limit(6)
+
+
+@hot_query('ranked_feed_next_page')
+def ranked_feed_next_page_query(dialect_name):
+    return sa.select(Post).where(
+        keyset_filter((Post.rank_score, Post.id), (0.5, SAMPLE_ID),
+                      dialect_name=dialect_name)
+    ).order_by(Post.rank_score.desc(), Post.id.desc()).limit(6)
+
+
+@hot_query('profile_posts')
+def profile_posts_query():
+    return sa.select(Post).where(Post.author_id == SAMPLE_ID) \
+        .order_by(Post.timestamp.desc(), Post.id.desc()).limit(6)
+
+
+@hot_query('profile_posts_next_page')
+def profile_posts_next_page_query(dialect_name):
+    return sa.select(Post).where(
+        Post.author_id == SAMPLE_ID,
+        keyset_filter((Post.timestamp, Post.id), (SAMPLE_TS, SAMPLE_ID),
+                      dialect_name=dialect_name)
+    ).order_by(Post.timestamp.desc(), Post.id.desc()).limit(6)
+
+
+@hot_query('comments_for_posts')
+def comments_for_posts_query():
+    return sa.select(Comment).where(Comment.post_id.in_([1, 2, 3, 4, 5]))
+
+
+@hot_query('likes_for_posts')
+def likes_for_posts_query():
+    return sa.select(Like).where(Like.post_id.in_([1, 2, 3, 4, 5]))
+
+
+@hot_query('like_lookup')
+def like_lookup_query():
+    return sa.select(Like).where(Like.author_id == SAMPLE_ID, Like.post_id == SAMPLE_ID)
+
+
+@hot_query('is_following')
+def is_following_query():
+    return sa.select(Follow).where(Follow.follower_id == SAMPLE_ID,
+                                   Follow.followed_id == SAMPLE_ID)
+
+
+@hot_query('followers_count')
+def followers_count_query():
+    return sa.select(sa.func.count()).select_from(Follow) \
+        .where(Follow.followed_id == SAMPLE_ID)
+
+
+@hot_query('followed_count')
+def followed_count_query():
+    return sa.select(sa.func.count()).select_from(Follow) \
+        .where(Follow.follower_id == SAMPLE_ID)
+
+
+# PLAN INSPECTION
+def sqlite_full_scans(rows, tables, limited=False):
+    """Tables walked end to end in a SQLite plan.
+
+    In a ``limited`` statement (one with a LIMIT) ``SCAN t USING INDEX ix``
+    is an ordered index walk that stops at the LIMIT and is allowed;
+    without one it reads every row too, like a bare ``SCAN t`` or a scan
+    of a covering index.
+    """
+    scans = []
+    for row in rows:
+        detail = row[-1]
+        words = detail.split()
+        if len(words) >= 2 and words[0] == 'SCAN' and words[1] in tables \
+                and not (limited and detail.startswith(f'SCAN {words[1]} USING INDEX ')):
+            scans.append(words[1])
+    return scans
+
+
+def postgres_full_scans(plan):
+    """Relations read by a Seq Scan node anywhere in a JSON plan."""
+    scans = []
+    nodes = [plan[0]['Plan']]
+    while nodes:
+        node = nodes.pop()
+        if node.get('Node Type') == 'Seq Scan':
+            scans.append(node.get('Relation Name'))
+        nodes.extend(node.get('Plans', []))
+    return scans
+
+
+def explain(conn, statement):
+    """Return (plan text, full-scanned tables) for one statement."""
+    result = conn.execute(Explain(statement)).fetchall()
+    if conn.dialect.name == 'sqlite':
+        tables = set(sa.inspect(conn).get_table_names())
+        text = '\n'.join(row[-1] for row in result)
+        limited = re.search(r'\bLIMIT\b', str(statement.compile(conn))) is not None
+        return text, sqlite_full_scans(result, tables, limited)
+    plan = result[0][0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return json.dumps(plan, indent=2), postgres_full_scans(plan)
+
+
+def audit(engine, names=None):
+    """Explain every hot query on ``engine``; returns [(name, plan, scans)]."""
+    report = []
+    with engine.connect() as conn:
+        if conn.dialect.name == 'postgresql':
+            # tiny tables make Postgres prefer seq scans; only flag the
+            # queries that have no usable index at all
+            conn.exec_driver_sql('SET enable_seqscan = off')
+        for name, build in hot_queries.items():
+            if names and name not in names:
+                continue
+            if 'dialect_name' in inspect.signature(build).parameters:
+                statement = build(conn.dialect.name)
+            else:
+                statement = build()
+            plan, scans = explain(conn, statement)
+            report.append((name, plan, scans))
+        conn.rollback()
+    return report
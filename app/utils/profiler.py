@@ -0,0 +1,280 @@
+import glob
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from flask import g, request
+from app.utils import query_stats
+
+logger = logging.getLogger(__name__)
+
+SWITCH_FILE = 'profiler.json'
+SWITCH_CHECK_SECONDS = 1.0
+_unsafe = re.compile(r'[^A-Za-z0-9_.-]+')
+
+
+# STACK SAMPLING
+def gevent_patched():
+    """True under gunicorn's gevent worker: requests are greenlets on one thread."""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('threading')
+
+
+class Sampler:
+    """Samples the stacks of registered threads every ``interval`` seconds.
+
+    Request threads ``begin()`` and ``end()`` themselves; the sampler
+    thread walks their frames with ``sys._current_frames()`` and counts
+    each folded stack, so the profiled code runs untouched. It sleeps
+    while no thread is registered.
+
+    Under gevent the requests are greenlets, so the sampler keeps each
+    one's greenlet and reads its suspended frame, or the thread's frame
+    while it runs; the sampler itself is a real thread, which a busy
+    greenlet can't keep from running.
+    """
+
+    IDLE_POLL = 0.1
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.active = {}  # thread ident -> (greenlet or None, Counter of folded stacks)
+        self.green = gevent_patched()
+        if self.green:
+            from gevent import monkey
+            self.lock = monkey.get_original('_thread', 'allocate_lock')()
+            self.sleep = monkey.get_original('time', 'sleep')
+            self.thread_ident = monkey.get_original('_thread', 'get_ident')
+            self.start_thread = monkey.get_original('_thread', 'start_new_thread')
+            self.wakeup = None
+        else:
+            self.lock = threading.Lock()
+            self.sleep = time.sleep
+            self.wakeup = threading.Event()
+        self.hub_thread = None
+        self.pid = None
+
+    def begin(self, ident):
+        task = None
+        if self.green:
+            import greenlet
+            task = greenlet.getcurrent()
+            self.hub_thread = self.thread_ident()
+        with self.lock:
+            self.active[ident] = (task, Counter())
+            # first use, or a forked worker that didn't inherit the thread
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                if self.green:
+                    self.start_thread(self._run, ())
+                else:
+                    threading.Thread(target=self._run, name='profiler-sampler',
+                                     daemon=True).start()
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def end(self, ident):
+        with self.lock:
+            entry = self.active.pop(ident, None)
+        return entry[1] if entry is not None else None
+
+    def frame(self, ident, task, frames):
+        if task is None:
+            return frames.get(ident)
+        if task.gr_frame is not None:
+            return task.gr_frame
+        # no saved frame: it is the greenlet running right now
+        return frames.get(self.hub_thread) if not task.dead else None
+
+    def _run(self):
+        while True:
+            if not self.active:
+                if self.wakeup is None:
+                    self.sleep(self.IDLE_POLL)
+                    continue
+                self.wakeup.wait()
+                self.wakeup.clear()
+            self.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.lock:
+                for ident, (task, stacks) in self.active.items():
+                    frame = self.frame(ident, task, frames)
+                    if frame is not None:
+                        stacks[fold(frame)] += 1
+
+
+_frame_names = {}  # code object -> 'function (path:line)'
+
+
+def frame_name(code):
+    name = _frame_names.get(code)
+    if name is None:
+        # paths relative to the sys.path entry they were imported from
+        path = code.co_filename
+        for prefix in sorted(filter(None, sys.path), key=len, reverse=True):
+            if path.startswith(prefix + os.sep):
+                path = path[len(prefix) + 1:]
+                break
+        name = _frame_names[code] = \
+            f'{code.co_name} ({path}:{code.co_firstlineno})'.replace(';', ':')
+    return name
+
+
+def fold(frame):
+    """'outermost;...;innermost', the collapsed-stack format of flamegraph.pl."""
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame.f_code))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+# RUNTIME SWITCH
+class Switch:
+    """Profiler settings from <PROFILER_DIR>/profiler.json, falling back to config.
+
+    ``flask profiler`` writes the file; every worker notices within
+    SWITCH_CHECK_SECONDS, so profiling is turned on and off without a
+    restart.
+    """
+
+    def __init__(self, directory, defaults):
+        self.path = os.path.join(directory, SWITCH_FILE)
+        self.defaults = defaults
+        self.settings = dict(defaults)
+        self.mtime = None
+        self.checked = 0.0
+
+    def current(self):
+        now = time.monotonic()
+        if now - self.checked >= SWITCH_CHECK_SECONDS:
+            self.checked = now
+            self.reload()
+        return self.settings
+
+    def reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self.mtime:
+            return
+        settings = dict(self.defaults)
+        if mtime is not None:
+            try:
+                with open(self.path) as f:
+                    settings.update(json.load(f))
+            except (OSError, ValueError):
+                logger.warning('ignoring unreadable %s', self.path)
+        self.settings, self.mtime = settings, mtime
+
+
+def read_settings(app):
+    return Switch(app.config['PROFILER_DIR'], default_settings(app)).current()
+
+
+def write_settings(app, **changes):
+    """Update profiler.json for every worker; returns the new settings."""
+    settings = read_settings(app)
+    settings.update({k: v for k, v in changes.items() if v is not None})
+    os.makedirs(app.config['PROFILER_DIR'], exist_ok=True)
+    path = os.path.join(app.config['PROFILER_DIR'], SWITCH_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(settings, f)
+    os.replace(path + '.tmp', path)
+    return settings
+
+
+def default_settings(app):
+    return {
+        'enabled': app.config['PROFILER_ENABLED'],
+        'threshold_ms': app.config['PROFILER_THRESHOLD_MS'],
+        'sample_rate': app.config['PROFILER_SAMPLE_RATE'],
+    }
+
+
+# OUTPUT
+def write_profile(directory, stacks, endpoint, duration_ms, queries, max_files):
+    """Write ``stacks`` as a .folded file named after the request; returns the path.
+
+    The root frame carries the same tags, so they show in the flamegraph.
+    """
+    os.makedirs(directory, exist_ok=True)
+    stamp = datetime.utcnow().strftime('%Y%m%dT%H%M%S.%f')
+    name = f'{stamp}-{_unsafe.sub("_", endpoint)}-{duration_ms}ms-{queries}q-{os.getpid()}.folded'
+    path = os.path.join(directory, name)
+    root = f'{request.method} {endpoint} {duration_ms}ms {queries} queries'
+    with open(path, 'w') as f:
+        for stack, count in stacks.most_common():
+            f.write(f'{root};{stack} {count}\n')
+    prune(directory, max_files)
+    return path
+
+
+def prune(directory, max_files):
+    profiles = sorted(glob.glob(os.path.join(directory, '*.folded')))
+    for path in profiles[:-max_files]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def list_profiles(directory):
+    return sorted(glob.glob(os.path.join(directory, '*.folded')))
+
+
+def init_app(app):
+    switch = Switch(app.config['PROFILER_DIR'], default_settings(app))
+    sampler = Sampler(app.config['PROFILER_INTERVAL_MS'] / 1000)
+    app.extensions['profiler'] = sampler
+
+    @app.before_request
+    def start_profile():
+        settings = switch.current()
+        if not settings['enabled']:
+            return
+        g.profile_started = time.perf_counter()
+        g.profile_sampled = random.random() < settings['sample_rate']
+        g.profile_threshold = settings['threshold_ms']
+        sampler.begin(threading.get_ident())
+
+    @app.after_request
+    def finish_profile(response):
+        # registered early, so this runs after the other after_request hooks
+        started = g.pop('profile_started', None)
+        if started is None:
+            return response
+        stacks = sampler.end(threading.get_ident())
+        duration_ms = round((time.perf_counter() - started) * 1000)
+        # a stream's time is spent waiting for its client, not in our code
+        if response.is_streamed or not stacks \
+                or not (g.profile_sampled or duration_ms >= g.profile_threshold):
+            return response
+        stats = query_stats.current()
+        try:
+            path = write_profile(
+                app.config['PROFILER_DIR'], stacks, request.endpoint or 'unmatched',
+                duration_ms, stats.count if stats is not None else 0,
+                app.config['PROFILER_MAX_FILES'])
+        except OSError:
+            logger.exception('writing profile failed')
+        else:
+            logger.info('profiled %s %s in %d ms: %s',
+                        request.method, request.path, duration_ms, path)
+        return response
+
+    @app.teardown_request
+    def drop_profile(exc):
+        # requests that never reached after_request
+        if g.pop('profile_started', None) is not None:
+            sampler.end(threading.get_ident())
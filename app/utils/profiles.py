@@ -0,0 +1,237 @@
+import threading
+import time
+from collections import OrderedDict
+from types import SimpleNamespace
+from flask import current_app
+from flask_login import UserMixin
+import sqlalchemy as sa
+from app.models import User, Post, Comment, Follow
+from app.utils import metrics
+from app.utils.pagination import paginate
+from app.utils.routing import pinned_to_primary
+
+# the user fields profile pages show, for the profile, post and comment
+# authors and the suggestions alike
+CARD_COLUMNS = (User.id, User.name, User.username, User.headline,
+                User.location, User.about_me, User.email, User.avatar_hash)
+POST_COLUMNS = (Post.id, Post.timestamp, Post.body, Post.body_html,
+                Post.post_name, Post.like_count)
+COMMENT_COLUMNS = (Comment.id, Comment.post_id, Comment.body, Comment.timestamp)
+SUGGESTIONS = 6
+
+
+class ProfileCard(UserMixin):
+    """A user's public fields, detached from the session so it can be cached.
+
+    Compares equal to the User with the same id, like User itself does,
+    so templates can still ask ``current_user == user``.
+    """
+
+    def __init__(self, id, name, username, headline, location, about_me, email,
+                 avatar_hash):
+        self.id = id
+        self.name = name
+        self.username = username
+        self.headline = headline
+        self.location = location
+        self.about_me = about_me
+        self.email = email
+        self.avatar_hash = avatar_hash
+
+    # the same avatar URLs as User
+    gravatar_hash = User.gravatar_hash
+    gravatar = User.gravatar
+
+    def as_tuple(self):
+        return tuple(getattr(self, column.key) for column in CARD_COLUMNS)
+
+
+class Profile:
+    """What a profile page shows that is the same for every viewer."""
+
+    def __init__(self, card, followers, followed, posts, next_cursor):
+        self.card = card
+        self.followers = followers
+        self.followed = followed
+        self.posts = posts
+        self.next_cursor = next_cursor
+        self.last_modified = max((post.timestamp for post in posts), default=None)
+
+    def version(self):
+        """Tokens that change whenever the page would render differently."""
+        posts = [(post.id, post.timestamp, post.like_count,
+                  [(comment.id, comment.author.as_tuple()) for comment in post.comments])
+                 for post in self.posts]
+        return (self.card.as_tuple(), self.followers, self.followed, posts,
+                self.next_cursor is not None)
+
+
+# QUERIES
+def load_profile(session, username, cursor=None, limit=5):
+    """The profile, its counts and one page of its posts with their comments.
+
+    Three queries whatever the page holds: the profile row with both
+    counts as subqueries, the posts, and the comments joined to their
+    authors. Returns None for an unknown username.
+    """
+    followers = sa.select(sa.func.count()).where(Follow.followed_id == User.id) \
+        .scalar_subquery()
+    followed = sa.select(sa.func.count()).where(Follow.follower_id == User.id) \
+        .scalar_subquery()
+    row = session.query(*CARD_COLUMNS, followers, followed) \
+        .filter(User.username == username).first()
+    if row is None:
+        return None
+    card = ProfileCard(*row[:len(CARD_COLUMNS)])
+    follower_count, followed_count = row[len(CARD_COLUMNS):]
+
+    page = paginate(session.query(*POST_COLUMNS).filter(Post.author_id == card.id),
+                    (Post.timestamp, Post.id), cursor=cursor, limit=limit)
+    posts = [SimpleNamespace(**row._asdict(), author=card, comments=[]) for row in page]
+
+    by_id = {post.id: post for post in posts}
+    authors = {}
+    if posts:
+        rows = session.query(*COMMENT_COLUMNS, *CARD_COLUMNS) \
+            .join(User, User.id == Comment.author_id) \
+            .filter(Comment.post_id.in_(by_id)).order_by(Comment.id)
+        for comment in rows:
+            comment_id, post_id, body, timestamp = comment[:len(COMMENT_COLUMNS)]
+            author = comment[len(COMMENT_COLUMNS):]
+            if author[0] not in authors:
+                authors[author[0]] = ProfileCard(*author)
+            by_id[post_id].comments.append(SimpleNamespace(
+                id=comment_id, body=body, timestamp=timestamp, author=authors[author[0]]))
+
+    return Profile(card, follower_count, followed_count, posts, page.next_cursor)
+
+
+def load_viewer(session, viewer_id, user_ids):
+    """(suggested users, ids among them and ``user_ids`` the viewer follows)."""
+    suggestions = [ProfileCard(*row) for row in session.query(*CARD_COLUMNS)
+                   .filter(User.id != viewer_id).order_by(User.id).limit(SUGGESTIONS)]
+    if viewer_id is None:
+        return suggestions, set()
+    following = session.query(Follow.followed_id).filter(
+        Follow.follower_id == viewer_id,
+        Follow.followed_id.in_([card.id for card in suggestions] + list(user_ids)))
+    return suggestions, {row.followed_id for row in following}
+
+
+# CACHE
+class ProfileCache:
+    """Profiles loaded in the last ``ttl`` seconds, by username.
+
+    Per process: writes made in this process drop the profiles they touch
+    (forget_user, forget_post), other workers' copies expire. A load that
+    overlapped such a write isn't kept, since it may predate it. At most
+    ``size`` profiles are kept, least recently used going first.
+    """
+
+    def __init__(self, ttl, size=1000):
+        self.ttl = ttl
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # username -> (expires, Profile)
+        self.by_user = {}  # user id -> username
+        self.by_post = {}  # post id -> username of the cached profile showing it
+        self.generation = 0  # bumped by every forget
+
+    def get(self, username, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            entry = self.entries.get(username)
+            if entry is None:
+                return None
+            if entry[0] <= now:
+                self._drop(username)
+                return None
+            self.entries.move_to_end(username)
+            return entry[1]
+
+    def put(self, profile, generation, now=None):
+        now = time.monotonic() if now is None else now
+        username = profile.card.username
+        with self.lock:
+            if generation != self.generation:
+                return
+            self._drop(username)
+            self.entries[username] = (now + self.ttl, profile)
+            self.by_user[profile.card.id] = username
+            for post in profile.posts:
+                self.by_post[post.id] = username
+            while len(self.entries) > self.size:
+                self._drop(next(iter(self.entries)))
+
+    def _drop(self, username):
+        entry = self.entries.pop(username, None)
+        if entry is None:
+            return
+        profile = entry[1]
+        if self.by_user.get(profile.card.id) == username:
+            del self.by_user[profile.card.id]
+        for post in profile.posts:
+            if self.by_post.get(post.id) == username:
+                del self.by_post[post.id]
+
+    def forget_user(self, user_id):
+        with self.lock:
+            self.generation += 1
+            username = self.by_user.get(user_id)
+            if username is not None:
+                self._drop(username)
+
+    def forget_post(self, post_id):
+        with self.lock:
+            self.generation += 1
+            username = self.by_post.get(post_id)
+            if username is not None:
+                self._drop(username)
+
+
+def get_cache(app=None):
+    """The app's ProfileCache, or None when PROFILE_CACHE_SECONDS is 0."""
+    app = app or current_app._get_current_object()
+    return app.extensions.get('profile_cache')
+
+
+def cached_profile(session, username, cursor=None, limit=5):
+    """load_profile(), served from the cache for first pages.
+
+    A browser that just wrote (see app/utils/routing.py) reads past the
+    cache, which another worker may hold a stale copy in.
+    """
+    cache = get_cache()
+    if cache is None or cursor or pinned_to_primary():
+        return load_profile(session, username, cursor, limit)
+    profile = cache.get(username)
+    if profile is not None:
+        metrics.cache_requests.inc('profile', 'hit')
+        return profile
+    metrics.cache_requests.inc('profile', 'miss')
+    generation = cache.generation
+    profile = load_profile(session, username, limit=limit)
+    if profile is not None:
+        cache.put(profile, generation)
+    return profile
+
+
+def forget_user(*user_ids):
+    """Drop the cached profiles of ``user_ids`` after their profile or follows changed."""
+    cache = get_cache()
+    if cache is not None:
+        for user_id in user_ids:
+            cache.forget_user(user_id)
+
+
+def forget_post(post_id):
+    """Drop the cached profile showing ``post_id`` after a like or comment."""
+    cache = get_cache()
+    if cache is not None:
+        cache.forget_post(post_id)
+
+
+def init_app(app):
+    if app.config['PROFILE_CACHE_SECONDS']:
+        app.extensions['profile_cache'] = ProfileCache(
+            app.config['PROFILE_CACHE_SECONDS'], app.config['PROFILE_CACHE_SIZE'])
@@ -0,0 +1,173 @@
+import json
+import logging
+import re
+import time
+from collections import Counter
+from functools import lru_cache
+from flask import g, has_request_context, request, render_template
+import sqlalchemy as sa
+
+logger = logging.getLogger(__name__)
+
+
+class QueryBudgetExceeded(AssertionError):
+    """A request ran more SQL statements than its view allows (strict mode)."""
+
+
+# FINGERPRINTS
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PARAM = r'(?:\?|%s|%\(\w+\)s|:\w+)'
+_PARAM_LIST = re.compile(rf'\(\s*{_PARAM}(?:\s*,\s*{_PARAM})*\s*\)')
+_SPACE = re.compile(r'\s+')
+
+
+@lru_cache(maxsize=2048)
+def fingerprint(statement):
+    """The shape of a statement: literals and IN lists collapsed.
+
+    Statements that differ only in their parameters, such as the same
+    lazy load issued once per row, share a fingerprint.
+    """
+    shape = _STRING.sub('?', statement)
+    shape = _NUMBER.sub('?', shape)
+    shape = _PARAM_LIST.sub('(...)', shape)
+    return _SPACE.sub(' ', shape).strip()
+
+
+# PER-REQUEST STATS
+class QueryStats:
+    """Statements one request ran, their database time and their shapes."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.count = 0
+        self.time = 0.0
+        self.shapes = Counter()
+        self.shape_time = Counter()
+
+    def record(self, statement, seconds):
+        shape = fingerprint(statement)
+        self.count += 1
+        self.time += seconds
+        self.shapes[shape] += 1
+        self.shape_time[shape] += seconds
+
+    def repeated(self, threshold):
+        """[(shape, count, seconds)] run ``threshold`` times or more, worst first."""
+        return [(shape, count, self.shape_time[shape])
+                for shape, count in self.shapes.most_common()
+                if count >= threshold]
+
+
+def current():
+    """The QueryStats of the request being handled, if it is instrumented."""
+    return g.get('query_stats') if has_request_context() else None
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current() is not None:
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = current()
+    started = conn.info.get('query_started')
+    if stats is not None and started:
+        stats.record(statement, time.perf_counter() - started.pop())
+
+
+def instrument(engine):
+    if not sa.event.contains(engine, 'before_cursor_execute', before_cursor_execute):
+        sa.event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        sa.event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+
+# BUDGETS
+def query_budget(limit):
+    """Cap the SQL statements one request to the view may run.
+
+    Views without a budget get QUERY_BUDGET. Going over is logged, or
+    raises QueryBudgetExceeded when QUERY_BUDGET_STRICT is set.
+    """
+    def decorator(f):
+        f.query_budget = limit
+        return f
+    return decorator
+
+
+def budget_for(app, endpoint):
+    view = app.view_functions.get(endpoint)
+    return getattr(view, 'query_budget', app.config['QUERY_BUDGET'])
+
+
+# REPORTING
+def report(stats, response, budget, threshold):
+    repeated = stats.repeated(threshold)
+    return {
+        'event': 'sql',
+        'method': request.method,
+        'path': request.path,
+        'endpoint': request.endpoint,
+        'status': response.status_code,
+        'queries': stats.count,
+        'db_ms': round(stats.time * 1000, 2),
+        'total_ms': round((time.perf_counter() - stats.started) * 1000, 2),
+        'budget': budget,
+        'over_budget': bool(budget) and stats.count > budget,
+        'repeated': [{'statement': shape, 'count': count, 'ms': round(seconds * 1000, 2)}
+                     for shape, count, seconds in repeated],
+    }
+
+
+def server_timing(record):
+    return (f'db;dur={record["db_ms"]};desc="{record["queries"]} queries", '
+            f'app;dur={record["total_ms"]}')
+
+
+def add_footer(response, record):
+    body = response.get_data(as_text=True)
+    end = body.rfind('</body>')
+    if end == -1:
+        return
+    footer = render_template('_query_stats.html', record=record)
+    response.set_data(body[:end] + footer + body[end:])
+
+
+def init_app(app, db):
+    if not app.config['QUERY_STATS']:
+        return
+
+    with app.app_context():
+        for engine in db.engines.values():
+            instrument(engine)
+
+    @app.before_request
+    def start_query_stats():
+        g.query_stats = QueryStats()
+
+    @app.after_request
+    def report_query_stats(response):
+        # registered right after the profiler's, so it runs after every other
+        # after_request hook and before the profiler's, which reads its counts
+        stats = current()
+        if stats is None:
+            return response
+        budget = budget_for(app, request.endpoint)
+        record = report(stats, response, budget, app.config['QUERY_REPEAT_THRESHOLD'])
+
+        if record['over_budget'] or record['repeated']:
+            logger.warning(json.dumps(record))
+        else:
+            logger.debug(json.dumps(record))
+        if app.config['SERVER_TIMING']:
+            response.headers.add('Server-Timing', server_timing(record))
+        if app.config['QUERY_DEBUG_FOOTER'] and response.mimetype == 'text/html' \
+                and not response.is_streamed and not response.direct_passthrough:
+            add_footer(response, record)
+
+        if record['over_budget'] and app.config['QUERY_BUDGET_STRICT']:
+            raise QueryBudgetExceeded(
+                f'{request.method} {request.path} ran {stats.count} queries, '
+                f'budget {budget}: {json.dumps(record["repeated"])}')
+        return response
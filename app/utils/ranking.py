@@ -0,0 +1,177 @@
+import atexit
+import logging
+import threading
+from datetime import datetime, timedelta
+import sqlalchemy as sa
+from app import db
+from app.models import Post, Comment, Follow
+from app.utils import services
+
+try:
+    import fcntl
+except ImportError:  # no flock on Windows: every process recomputes
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+posts = Post.__table__
+comments = Comment.__table__
+follows = Follow.__table__
+
+# score = weight / (age in hours + AGE_OFFSET) ** GRAVITY, where weight is
+# what a post collected: likes and comments (so the score is their
+# velocity), its author's reach and a boost for featured posts
+BASE_WEIGHT = 1.0
+LIKE_WEIGHT = 1.0
+COMMENT_WEIGHT = 3.0
+FOLLOWER_WEIGHT = 2.0  # per log(followers + 1) of the author
+FEATURED_BOOST = 25.0
+AGE_OFFSET = 2.0
+GRAVITY = 1.5
+# older posts are ranked 0 and keep their chronological order
+HORIZON = timedelta(days=7)
+
+
+def engagement(conn, since, post_id=None):
+    """(id, timestamp, like_count, comment_count, featured, followers) of recent posts."""
+    n_comments = sa.select(sa.func.count()).select_from(comments) \
+        .where(comments.c.post_id == posts.c.id).scalar_subquery()
+    followers = sa.select(sa.func.count()).select_from(follows) \
+        .where(follows.c.followed_id == posts.c.author_id).scalar_subquery()
+    query = sa.select(
+        posts.c.id, posts.c.timestamp, posts.c.like_count, n_comments,
+        sa.func.coalesce(posts.c.featured, False), followers
+    ).where(posts.c.timestamp >= since)
+    if post_id is not None:
+        query = query.where(posts.c.id == post_id)
+    return conn.execute(query).all()
+
+
+def compute_scores(rows, now):
+    """Scores for engagement() rows, computed with NumPy in one pass."""
+    import numpy as np  # imported on first use, it's slow to load
+
+    _, timestamps, likes, n_comments, featured, followers = zip(*rows)
+    ages = (np.datetime64(now, 'us') - np.array(timestamps, dtype='datetime64[us]')) \
+        / np.timedelta64(1, 'h')
+    weight = (BASE_WEIGHT
+              + LIKE_WEIGHT * np.array(likes, dtype=float)
+              + COMMENT_WEIGHT * np.array(n_comments, dtype=float)
+              + FOLLOWER_WEIGHT * np.log1p(np.array(followers, dtype=float))
+              + FEATURED_BOOST * np.array(featured, dtype=bool))
+    return (weight / (np.maximum(ages, 0.0) + AGE_OFFSET) ** GRAVITY).tolist()
+
+
+def rescore(conn, post_id, now=None):
+    """Update one post's score after a like, unlike or comment."""
+    now = now or datetime.utcnow()
+    rows = engagement(conn, now - HORIZON, post_id)
+    if rows:
+        conn.execute(sa.update(posts).where(posts.c.id == post_id)
+                     .values(rank_score=compute_scores(rows, now)[0]))
+
+
+def recompute(conn, now=None, batch_size=1000):
+    """Rescore every post inside HORIZON and zero the ones that left it.
+
+    Returns the number of posts rescored. Commits are left to the caller.
+    """
+    now = now or datetime.utcnow()
+    since = now - HORIZON
+    rows = engagement(conn, since)
+    if rows:
+        scores = compute_scores(rows, now)
+        update = sa.update(posts).where(posts.c.id == sa.bindparam('post_id')) \
+            .values(rank_score=sa.bindparam('score'))
+        params = [dict(post_id=row[0], score=score) for row, score in zip(rows, scores)]
+        for start in range(0, len(params), batch_size):
+            conn.execute(update, params[start:start + batch_size])
+    conn.execute(
+        sa.update(posts)
+        .where(posts.c.rank_score != 0, sa.or_(posts.c.timestamp < since,
+                                               posts.c.timestamp.is_(None)))
+        .values(rank_score=0)
+    )
+    return len(rows)
+
+
+def engines(app):
+    """The writable stores scores are kept on: the primary, and the remote
+    when writes are replicated. A read replica is a copy of one of them.
+    """
+    with app.app_context():
+        found = [db.engine]
+    remote = services.remote_engine()
+    if remote is not None:
+        found.append(remote)
+    return found
+
+
+class FeedRanker:
+    """Recomputes post scores every ``interval`` seconds on a daemon thread.
+
+    ``engines`` is a callable returning the engines to rescore. Every worker
+    runs the thread, but only the one holding an exclusive lock on
+    ``lock_path`` recomputes; the others retry the lock each interval and
+    take over once its holder exits.
+    """
+
+    def __init__(self, engines, interval, lock_path=None):
+        self.engines = engines
+        self.interval = interval
+        self.lock_path = lock_path
+        self.lock_file = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.interval and self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run, name='feed-ranker', daemon=True)
+                self.thread.start()
+
+    def is_leader(self):
+        """True once this process holds the lock, which it keeps until it exits."""
+        if self.lock_file is not None or not self.lock_path or fcntl is None:
+            return True
+        lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self.lock_file = lock_file
+        return True
+
+    def run_once(self):
+        for engine in self.engines():
+            with engine.begin() as conn:
+                recompute(conn)
+
+    def _run(self):
+        while True:
+            try:
+                if self.is_leader():
+                    self.run_once()
+            except Exception:
+                logger.exception('recomputing feed scores failed')
+            if self.stopped.wait(self.interval):
+                return
+
+
+_ranker_lock = threading.Lock()
+
+
+def get_ranker(app):
+    """The app's per-process FeedRanker, started on first use."""
+    with _ranker_lock:
+        ranker = app.extensions.get('feed_ranker')
+        if ranker is None:
+            ranker = app.extensions['feed_ranker'] = FeedRanker(
+                lambda: engines(app), app.config['FEED_RANK_INTERVAL_SECONDS'],
+                app.config['FEED_RANK_LOCK_FILE'])
+            atexit.register(ranker.stopped.set)
+    ranker.start()
+    return ranker
@@ -0,0 +1,187 @@
+import logging
+import math
+import threading
+import time
+from collections import namedtuple
+from flask import abort, request
+from flask_login import current_user
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql, sqlite
+from app.utils import metrics
+
+logger = logging.getLogger(__name__)
+
+# ``rate`` tokens a second into a bucket of ``burst``; ``methods`` limits
+# which requests to the view take one (None: all of them)
+Limit = namedtuple('Limit', 'rate burst methods')
+
+throttled = metrics.counter(
+    'rate_limited_total', 'Requests turned away with 429, by endpoint and reason '
+    '(rate or the queue that was full).', ('endpoint', 'reason'))
+
+
+# TOKEN BUCKETS
+# A bucket is kept as the one number GCRA uses: the time at which it will
+# be full again. At ``now`` it holds ``burst - (full_at - now) * rate``
+# tokens, so taking one is allowed while ``full_at - now`` stays within
+# ``(burst - 1) / rate``, and moves ``full_at`` on by ``1 / rate``. A
+# missing or stale key is a full bucket.
+def take(full_at, now, limit):
+    """(new full_at, seconds to wait); the token was taken if the wait is 0."""
+    full_at = max(full_at or now, now)
+    wait = full_at - now - (limit.burst - 1) / limit.rate
+    if wait > 0:
+        return full_at, wait
+    return full_at + 1 / limit.rate, 0
+
+
+class MemoryStore:
+    """Buckets in a dict: per process, so each worker allows the full rate."""
+
+    PRUNE_EVERY = 1000
+
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def take(self, key, limit, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            self.buckets[key], wait = take(self.buckets.get(key), now, limit)
+            self.calls += 1
+            if self.calls % self.PRUNE_EVERY == 0:
+                self.prune(now)
+        return wait
+
+    def prune(self, now):
+        # full buckets are the same as none
+        for key in [key for key, full_at in self.buckets.items() if full_at <= now]:
+            del self.buckets[key]
+
+
+class DatabaseStore:
+    """Buckets in the rate_limits table, shared by every worker and host.
+
+    Each take is a single upsert, whose WHERE lets it through only while
+    the bucket has a token; a row coming back means the token was taken.
+    Runs on its own connection, outside the request's transaction.
+    """
+
+    PRUNE_EVERY = 1000
+
+    def __init__(self, engine):
+        from app.models import RateLimit
+        self.engine = engine
+        self.table = RateLimit.__table__
+        self.calls = 0
+
+    def take(self, key, limit, now=None):
+        now = time.time() if now is None else now
+        dialect = {'postgresql': postgresql, 'sqlite': sqlite}[self.engine.dialect.name]
+        table = self.table
+        full_at = sa.func.max(table.c.full_at, now) if self.engine.dialect.name == 'sqlite' \
+            else sa.func.greatest(table.c.full_at, now)
+        statement = dialect.insert(table).values(key=key, full_at=now + 1 / limit.rate)
+        statement = statement.on_conflict_do_update(
+            index_elements=['key'],
+            set_={'full_at': full_at + 1 / limit.rate},
+            where=full_at - now <= (limit.burst - 1) / limit.rate,
+        ).returning(table.c.full_at)
+        with self.engine.begin() as conn:
+            if conn.execute(statement).first() is not None:
+                wait = 0
+            else:
+                current = conn.execute(
+                    sa.select(table.c.full_at).where(table.c.key == key)).scalar()
+                wait = take(current, now, limit)[1]
+            self.calls += 1
+            if self.calls % self.PRUNE_EVERY == 0:
+                conn.execute(sa.delete(table).where(table.c.full_at <= now))
+        return wait
+
+
+def create_store(app):
+    kind = app.config['RATELIMIT_STORAGE']
+    if kind == 'memory':
+        return MemoryStore()
+    if kind == 'database':
+        from app import db
+        with app.app_context():
+            return DatabaseStore(db.engine)
+    raise ValueError(f'unknown RATELIMIT_STORAGE {kind!r}')
+
+
+# DECORATORS
+def rate_limit(per_minute, burst=None, methods=None):
+    """Allow each user ``per_minute`` requests to the view, ``burst`` at once.
+
+    Signed-in users are counted by id, anyone else by address. Requests
+    over the limit get 429 with Retry-After.
+    """
+    def decorator(f):
+        f.rate_limit = Limit(per_minute / 60, burst or per_minute,
+                             tuple(methods) if methods else None)
+        return f
+    return decorator
+
+
+def sheds_load(*queues, methods=None):
+    """Turn the view away with 429 while any of ``queues`` is past its high-water mark.
+
+    A view that feeds replication or email names those queues, so that a
+    backlog stops growing instead of piling up work for the background loop.
+    """
+    def decorator(f):
+        f.sheds_load = (queues, tuple(methods) if methods else None)
+        return f
+    return decorator
+
+
+def client_key():
+    if current_user.is_authenticated:
+        return f'user:{current_user.get_id()}'
+    return f'addr:{request.remote_addr}'
+
+
+def retry_after(seconds):
+    return max(1, math.ceil(seconds))
+
+
+def init_app(app):
+    if not app.config['RATELIMIT_ENABLED']:
+        return
+
+    from app.email import email_queue
+    from app.utils.dual_db import replication_queue
+    # queue name -> (current depth, high-water mark)
+    queues = {
+        'replication': (replication_queue.value,
+                        app.config['BACKPRESSURE_REPLICATION_HIGH_WATER']),
+        'email': (email_queue.value, app.config['BACKPRESSURE_EMAIL_HIGH_WATER']),
+    }
+    store = create_store(app)
+    app.extensions['rate_limiter'] = store
+
+    @app.before_request
+    def check_rate_limit():
+        view = app.view_functions.get(request.endpoint)
+        limit = getattr(view, 'rate_limit', None)
+        if limit is not None and (limit.methods is None or request.method in limit.methods):
+            wait = store.take(f'{request.endpoint}:{client_key()}', limit)
+            if wait:
+                throttled.inc(request.endpoint, 'rate')
+                abort(429, description='Too many requests, slow down.',
+                      retry_after=retry_after(wait))
+
+        names, methods = getattr(view, 'sheds_load', ((), None))
+        if methods is not None and request.method not in methods:
+            return
+        for name in names:
+            depth, high_water = queues[name]
+            if depth() >= high_water:
+                throttled.inc(request.endpoint, name)
+                logger.warning('shedding %s %s: %s queue at %d',
+                               request.method, request.path, name, depth())
+                abort(429, description='Busy right now, try again shortly.',
+                      retry_after=app.config['BACKPRESSURE_RETRY_AFTER'])
@@ -0,0 +1,98 @@
+import time
+from contextlib import contextmanager
+from functools import wraps
+import sqlalchemy as sa
+from flask import session as cookie_session, request, has_request_context, current_app
+from flask_sqlalchemy.session import Session
+
+REPLICA_BIND = 'replica'
+# columns whose updates are bookkeeping (User.ping) rather than user writes
+HEARTBEAT_COLUMNS = {'last_seen'}
+STICKY_KEY = '_primary_until'
+
+
+class RoutingSession(Session):
+    """Session that serves reads from the local replica when allowed.
+
+    Reads go to the ``replica`` bind only inside ``use_replica()`` (or a
+    ``@read_replica`` view), and only until the session writes something
+    or while the browser is pinned to the primary after a recent write.
+    Flushes always go to the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self.info.get('use_replica') and not self._flushing \
+                and not self.info.get('wrote') and not self._pinned_to_primary():
+            engine = self._db.engines.get(REPLICA_BIND)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def _pinned_to_primary(self):
+        if 'pinned' not in self.info:
+            until = cookie_session.get(STICKY_KEY, 0) if has_request_context() else 0
+            self.info['pinned'] = until > time.time()
+        return self.info['pinned']
+
+
+def is_heartbeat(session):
+    """True when a flush only touched heartbeat columns such as last_seen."""
+    if session.new or session.deleted:
+        return False
+    for obj in session.dirty:
+        for attr in sa.inspect(obj).attrs:
+            if attr.key not in HEARTBEAT_COLUMNS and attr.history.has_changes():
+                return False
+    return True
+
+
+@sa.event.listens_for(RoutingSession, 'after_flush')
+def record_write(session, flush_context):
+    if not is_heartbeat(session):
+        session.info['wrote'] = True
+
+
+def mark_write(session):
+    """Record a write made with Core statements, which never flush."""
+    session.info['wrote'] = True
+
+
+def pinned_to_primary():
+    """True while this browser is pinned to the primary after a recent write."""
+    return has_request_context() and cookie_session.get(STICKY_KEY, 0) > time.time()
+
+
+@contextmanager
+def use_replica(session):
+    previous = session.info.get('use_replica', False)
+    session.info['use_replica'] = True
+    try:
+        yield session
+    finally:
+        session.info['use_replica'] = previous
+
+
+def read_replica(f):
+    """Let GET/HEAD requests of a view read from the local replica."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if request.method in ('GET', 'HEAD'):
+            db = current_app.extensions['sqlalchemy']
+            with use_replica(db.session):
+                return f(*args, **kwargs)
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+def init_app(app, db):
+    # read-your-writes: after a write, skip the replica and the per-worker
+    # profile cache (app/utils/profiles.py) until neither can be stale, so
+    # the cookie is set with or without a replica
+    pinned_for = max(app.config['READ_YOUR_WRITES_SECONDS'],
+                     app.config['PROFILE_CACHE_SECONDS'])
+
+    @app.after_request
+    def pin_writer_to_primary(response):
+        if db.session.info.get('wrote'):
+            cookie_session[STICKY_KEY] = time.time() + pinned_for
+        return response
@@ -0,0 +1,196 @@
+import re
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import joinedload
+from app.models import Post, Comment, User, SearchDocument
+from app.utils.pagination import paginate, KeysetPage
+
+documents = SearchDocument.__table__
+
+# SQLite keeps an FTS5 index over search_documents in step with triggers;
+# Postgres uses a GIN index on the tsvector expression below
+SQLITE_FTS_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(
+        body, content='search_documents', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2')""",
+    """CREATE TRIGGER IF NOT EXISTS search_documents_ai AFTER INSERT ON search_documents BEGIN
+        INSERT INTO search_fts(rowid, body) VALUES (new.id, new.body);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS search_documents_ad AFTER DELETE ON search_documents BEGIN
+        INSERT INTO search_fts(search_fts, rowid, body) VALUES ('delete', old.id, old.body);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS search_documents_au AFTER UPDATE ON search_documents BEGIN
+        INSERT INTO search_fts(search_fts, rowid, body) VALUES ('delete', old.id, old.body);
+        INSERT INTO search_fts(rowid, body) VALUES (new.id, new.body);
+    END""",
+]
+POSTGRES_GIN_DDL = (
+    "CREATE INDEX IF NOT EXISTS ix_search_documents_tsv ON search_documents "
+    "USING GIN (to_tsvector('simple', body))"
+)
+MAX_TERMS = 8
+
+_fts_available = {}
+
+
+# DOCUMENTS
+KINDS = {Post: 'post', Comment: 'comment', User: 'user'}
+
+
+def document(kind, obj):
+    """The search document of a post, comment or user (model or row)."""
+    if kind == 'user':
+        body = ' '.join(filter(None, [obj.name, obj.username, obj.headline, obj.talks_about]))
+        return dict(kind=kind, doc_id=obj.id, body=body, timestamp=obj.member_since)
+    return dict(kind=kind, doc_id=obj.id, body=obj.body or '', timestamp=obj.timestamp)
+
+
+def index_documents(conn, docs):
+    """Insert or replace search documents (dicts from document())."""
+    if not docs:
+        return
+    name = conn.dialect.name
+    if name in ('sqlite', 'postgresql'):
+        insert = (sqlite.insert if name == 'sqlite' else postgresql.insert)(documents)
+        conn.execute(insert.on_conflict_do_update(
+            index_elements=['kind', 'doc_id'],
+            set_={'body': insert.excluded.body, 'timestamp': insert.excluded.timestamp}
+        ), docs)
+    else:
+        for doc in docs:
+            conn.execute(sa.delete(documents).where(
+                documents.c.kind == doc['kind'], documents.c.doc_id == doc['doc_id']))
+        conn.execute(sa.insert(documents), docs)
+
+
+def index_objects(conn, *objs):
+    index_documents(conn, [document(KINDS[type(obj)], obj) for obj in objs])
+
+
+# QUERIES
+def query_terms(q):
+    """Words of a search box query; punctuation never reaches a MATCH."""
+    return re.findall(r'\w+', (q or '').lower())[:MAX_TERMS]
+
+
+def has_fts(bind):
+    key = str(bind.url)
+    if key not in _fts_available:
+        with bind.connect() as conn:
+            _fts_available[key] = conn.exec_driver_sql(
+                "SELECT 1 FROM sqlite_master WHERE name = 'search_fts'").first() is not None
+    return _fts_available[key]
+
+
+def ranked(bind, terms):
+    """Matching documents with a score, using the best index the database has."""
+    columns = (documents.c.id, documents.c.kind, documents.c.doc_id)
+    if bind.dialect.name == 'sqlite' and has_fts(bind):
+        # every word, the last one as a prefix for search-as-you-type
+        match = ' '.join(f'"{t}"' for t in terms[:-1]) + f' "{terms[-1]}"*'
+        fts = sa.table('search_fts', sa.column('rowid'))
+        fts_column = sa.literal_column('search_fts')
+        # bm25() is lower-is-better and only valid inside a MATCH query
+        return sa.select(*columns, (-sa.func.bm25(fts_column)).label('score')) \
+            .select_from(documents.join(fts, fts.c.rowid == documents.c.id)) \
+            .where(fts_column.match(match))
+    if bind.dialect.name == 'postgresql':
+        vector = sa.func.to_tsvector('simple', documents.c.body)
+        tsquery = sa.func.to_tsquery('simple', ' & '.join(terms[:-1] + [terms[-1] + ':*']))
+        return sa.select(*columns, sa.func.ts_rank_cd(vector, tsquery).label('score')) \
+            .where(vector.op('@@')(tsquery))
+    # no text index: every word as a substring, newest first
+    return sa.select(*columns, sa.literal(0.0).label('score')).where(sa.and_(*[
+        documents.c.body.ilike('%' + t.replace('\\', '\\\\').replace('%', '\\%')
+                               .replace('_', '\\_') + '%', escape='\\')
+        for t in terms
+    ]))
+
+
+def search(session, q, kind=None, cursor=None, limit=10):
+    """Ranked, keyset-paginated search; a KeysetPage of (kind, doc_id) rows."""
+    terms = query_terms(q)
+    if not terms:
+        return KeysetPage([])
+    query = ranked(session.get_bind(), terms)
+    if kind:
+        query = query.where(documents.c.kind == kind)
+
+    ranked_docs = query.subquery('ranked')
+    query = session.query(ranked_docs.c.kind, ranked_docs.c.doc_id,
+                          ranked_docs.c.score, ranked_docs.c.id)
+    return paginate(query, (ranked_docs.c.score, ranked_docs.c.id), cursor=cursor, limit=limit)
+
+
+def load_results(session, page):
+    """The Post, Comment and User objects of a search page, in rank order."""
+    wanted = {'post': [], 'comment': [], 'user': []}
+    for row in page:
+        wanted[row.kind].append(row.doc_id)
+    found = {}
+    if wanted['post']:
+        for post in session.query(Post).options(joinedload(Post.author)) \
+                .filter(Post.id.in_(wanted['post'])):
+            found['post', post.id] = post
+    if wanted['comment']:
+        for comment in session.query(Comment) \
+                .options(joinedload(Comment.author), joinedload(Comment.post)) \
+                .filter(Comment.id.in_(wanted['comment'])):
+            found['comment', comment.id] = comment
+    if wanted['user']:
+        for user in session.query(User).filter(User.id.in_(wanted['user'])):
+            found['user', user.id] = user
+    # a source deleted since it was indexed simply drops out
+    return [(row.kind, found[row.kind, row.doc_id]) for row in page
+            if (row.kind, row.doc_id) in found]
+
+
+# MAINTENANCE
+def ensure_index(conn):
+    """Create search_documents and the dialect's text index if missing."""
+    documents.create(conn, checkfirst=True)
+    if conn.dialect.name == 'sqlite':
+        new = conn.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE name = 'search_fts'").first() is None
+        for ddl in SQLITE_FTS_DDL:
+            conn.exec_driver_sql(ddl)
+        if new:
+            # index rows written before the triggers existed
+            conn.exec_driver_sql("INSERT INTO search_fts(search_fts) VALUES ('rebuild')")
+        _fts_available[str(conn.engine.url)] = True
+    elif conn.dialect.name == 'postgresql':
+        conn.exec_driver_sql(POSTGRES_GIN_DDL)
+
+
+SOURCES = (
+    (Post, ('id', 'body', 'timestamp')),
+    (Comment, ('id', 'body', 'timestamp')),
+    (User, ('id', 'name', 'username', 'headline', 'talks_about', 'member_since')),
+)
+
+
+def reindex(conn, batch_size=500):
+    """Rebuild every document in id-ordered batches, committing each one.
+
+    Yields (kind, rows) per batch so callers can report progress; memory
+    stays at one batch whatever the table sizes.
+    """
+    ensure_index(conn)
+    conn.commit()
+    for model, columns in SOURCES:
+        table = model.__table__
+        last_id = 0
+        while True:
+            rows = conn.execute(
+                sa.select(*[table.c[c] for c in columns])
+                .where(table.c.id > last_id).order_by(table.c.id).limit(batch_size)
+            ).all()
+            if not rows:
+                break
+            index_documents(conn, [document(KINDS[model], row) for row in rows])
+            conn.commit()
+            last_id = rows[-1].id
+            yield model.__tablename__, len(rows)
+    if conn.dialect.name == 'sqlite':
+        conn.exec_driver_sql("INSERT INTO search_fts(search_fts) VALUES ('optimize')")
+        conn.commit()
@@ -0,0 +1,69 @@
+import os
+import threading
+import sqlalchemy as sa
+from sqlalchemy.orm import sessionmaker
+from config import config
+from app.utils.engine import engine_options, configure_engine
+
+# Outside services are created on first use, not at import, so CLI
+# commands and cold starts don't pay for clients they never touch.
+REMOTE_DB_URL = os.environ.get('REMOTE_CTRACK_DB_URL')
+SUPABASE_URL = os.environ.get('SUPABASE_URL')
+SUPABASE_KEY = os.environ.get('SUPABASE_KEY')
+
+_services = {}
+_lock = threading.Lock()
+
+
+def _get(name, factory):
+    service = _services.get(name)
+    if service is None:
+        with _lock:
+            service = _services.get(name)
+            if service is None:
+                service = _services[name] = factory()
+    return service
+
+
+def create_remote_engine(url):
+    # no app may exist yet, so read settings straight off the config class
+    config_class = config[os.getenv('FLASK_CONFIG') or 'default']
+    settings = {key: getattr(config_class, key)
+                for key in dir(config_class) if key.isupper()}
+    engine = sa.create_engine(url, **engine_options(url, settings, prefix='REMOTE_DB'))
+    return configure_engine(engine, 'remote', settings, prefix='REMOTE_DB')
+
+
+def remote_enabled():
+    """True when writes should be replicated to the remote database."""
+    return bool(REMOTE_DB_URL)
+
+
+def remote_engine():
+    """The remote (Supabase Postgres) engine, or None when not configured."""
+    if not REMOTE_DB_URL:
+        return None
+    return _get('remote_engine', lambda: create_remote_engine(REMOTE_DB_URL))
+
+
+def remote_session():
+    """A new ORM session on the remote database."""
+    return _get('remote_sessionmaker', lambda: sessionmaker(bind=remote_engine()))()
+
+
+async def storage():
+    """Supabase storage; the async client lives on the background loop."""
+    client = _services.get('supabase')
+    if client is None:
+        from supabase import acreate_client
+        client = _services['supabase'] = await acreate_client(SUPABASE_URL, SUPABASE_KEY)
+    return client.storage
+
+
+def reset():
+    """Forget every client, e.g. in a forked worker (see lifecycle.after_fork)."""
+    with _lock:
+        engine = _services.get('remote_engine')
+        if engine is not None:
+            engine.dispose(close=False)
+        _services.clear()
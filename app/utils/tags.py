@@ -0,0 +1,108 @@
+import re
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql, sqlite
+from app.models import User, PostTag, PostMention, TagTrend
+
+post_tags = PostTag.__table__
+post_mentions = PostMention.__table__
+tag_trends = TagTrend.__table__
+users = User.__table__
+
+MAX_TAG_LENGTH = 64
+MAX_PER_POST = 20
+
+# fenced blocks and inline code: a #include in a snippet isn't a tag
+CODE = re.compile(r'```.*?```|~~~.*?~~~|`[^`\n]*`', re.S)
+# not inside a word, a URL fragment (page#part, /#part) or an entity (&#39;);
+# a markdown heading has a space after the # so it never matches
+HASHTAG = re.compile(r'(?<![\w&/#])#(\w+)')
+# an email address has a word character before the @
+MENTION = re.compile(r'(?<![\w@./])@(\w+)')
+
+
+# EXTRACTION
+def _unique(words, limit):
+    seen = []
+    for word in words:
+        if word not in seen and len(word) <= MAX_TAG_LENGTH:
+            seen.append(word)
+    return seen[:limit]
+
+
+def extract_tags(body):
+    """Lower-cased hashtags of a markdown body, in order of appearance."""
+    text = CODE.sub(' ', body or '')
+    return _unique((tag.lower() for tag in HASHTAG.findall(text)
+                    if not tag.isdigit()), MAX_PER_POST)
+
+
+def extract_mentions(body):
+    """Usernames @mentioned in a markdown body (not yet checked to exist)."""
+    text = CODE.sub(' ', body or '')
+    return _unique(MENTION.findall(text), MAX_PER_POST)
+
+
+def post_rows(conn, post):
+    """The post_tags and post_mentions rows of a saved post.
+
+    Mentions of usernames nobody has are dropped.
+    """
+    tags = [dict(post_id=post.id, tag=tag, timestamp=post.timestamp)
+            for tag in extract_tags(post.body)]
+    names = extract_mentions(post.body)
+    mentions = []
+    if names:
+        user_ids = conn.execute(
+            sa.select(users.c.id).where(users.c.username.in_(names))).scalars()
+        mentions = [dict(post_id=post.id, user_id=user_id, timestamp=post.timestamp)
+                    for user_id in user_ids]
+    return tags, mentions
+
+
+def save_rows(conn, tags, mentions):
+    if tags:
+        conn.execute(sa.insert(post_tags), tags)
+    if mentions:
+        conn.execute(sa.insert(post_mentions), mentions)
+
+
+# TRENDING
+def add_trend_counts(conn, counts):
+    """Add {(bucket, tag): uses} to tag_trends."""
+    rows = [dict(tag=tag, bucket=bucket, count=n) for (bucket, tag), n in counts.items()]
+    if not rows:
+        return
+    name = conn.dialect.name
+    if name in ('sqlite', 'postgresql'):
+        insert = (sqlite.insert if name == 'sqlite' else postgresql.insert)(tag_trends)
+        conn.execute(insert.on_conflict_do_update(
+            index_elements=['tag', 'bucket'],
+            set_={'count': tag_trends.c.count + insert.excluded.count}
+        ), rows)
+        return
+    for row in rows:
+        updated = conn.execute(
+            sa.update(tag_trends)
+            .where(tag_trends.c.tag == row['tag'], tag_trends.c.bucket == row['bucket'])
+            .values(count=tag_trends.c.count + row['count'])
+        ).rowcount
+        if not updated:
+            conn.execute(sa.insert(tag_trends), row)
+
+
+def prune_trends(conn, before):
+    """Drop buckets that slid out of the window."""
+    conn.execute(sa.delete(tag_trends).where(tag_trends.c.bucket < before))
+
+
+def load_trending(conn, since, limit):
+    """[(tag, uses)] since ``since``, most used first."""
+    uses = sa.func.sum(tag_trends.c.count).label('uses')
+    rows = conn.execute(
+        sa.select(tag_trends.c.tag, uses)
+        .where(tag_trends.c.bucket >= since)
+        .group_by(tag_trends.c.tag)
+        .order_by(uses.desc(), tag_trends.c.tag)
+        .limit(limit)
+    ).all()
+    return [(row.tag, int(row.uses)) for row in rows]
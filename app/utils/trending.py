@@ -0,0 +1,105 @@
+import atexit
+import logging
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+from app import db
+from app.utils.tags import add_trend_counts, prune_trends, load_trending
+
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1)
+
+
+class TrendingTags:
+    """Hashtag uses over a sliding window, shared by all workers via tag_trends.
+
+    ``record()`` only bumps an in-memory counter for the current time
+    bucket. Every ``interval`` seconds a daemon thread adds those counts to
+    the table, drops buckets older than ``window`` and reloads the top
+    ``size`` tags, so ``top()`` never touches the database on a request.
+    ``interval=0`` writes on every record (tests).
+    """
+
+    def __init__(self, engine, window, bucket, interval, size=10):
+        self.engine = engine
+        self.window = window
+        self.bucket = bucket
+        self.interval = interval
+        self.size = size
+        self.pending = Counter()  # (bucket start, tag) -> uses
+        self.ranking = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def bucket_of(self, when):
+        return EPOCH + (when - EPOCH) // self.bucket * self.bucket
+
+    def record(self, tags, when=None):
+        if not tags:
+            return
+        bucket = self.bucket_of(when or datetime.utcnow())
+        with self.lock:
+            for tag in tags:
+                self.pending[bucket, tag] += 1
+            self._start()
+        if not self.interval:
+            self.flush()
+
+    def top(self, n=None):
+        """[(tag, uses)] over the window as of the last flush."""
+        if self.ranking is None:
+            with self.lock:
+                self._start()
+            self.reload()
+        return self.ranking[:n or self.size]
+
+    def reload(self):
+        since = datetime.utcnow() - self.window
+        with self.engine.connect() as conn:
+            self.ranking = load_trending(conn, since, self.size)
+
+    def flush(self):
+        """Write pending counts and reload the ranking."""
+        with self.lock:
+            counts, self.pending = self.pending, Counter()
+        if counts:
+            with self.engine.begin() as conn:
+                add_trend_counts(conn, counts)
+                prune_trends(conn, self.bucket_of(datetime.utcnow() - self.window))
+        self.reload()
+
+    def _start(self):
+        if self.interval and self.thread is None:
+            self.thread = threading.Thread(
+                target=self._run, name='trending-tags', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('flushing trending tags failed')
+
+
+_trending_lock = threading.Lock()
+
+
+def get_trending(app):
+    """The app's per-process TrendingTags."""
+    with _trending_lock:
+        trending = app.extensions.get('trending_tags')
+        if trending is None:
+            with app.app_context():
+                engine = db.engine
+            trending = app.extensions['trending_tags'] = TrendingTags(
+                engine,
+                window=timedelta(hours=app.config['TRENDING_WINDOW_HOURS']),
+                bucket=timedelta(seconds=app.config['TRENDING_BUCKET_SECONDS']),
+                interval=app.config['TRENDING_FLUSH_SECONDS'],
+                size=app.config['TRENDING_SIZE'],
+            )
+            atexit.register(trending.flush)
+    return trending
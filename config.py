@@ -16,6 +16,124 @@ class Config:
     CTRACK_ADMIN = os.environ.get('CTRACK_ADMIN')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     BREVO_API_KEY = os.environ.get('BREVO_API_KEY')
+    # log instead of calling Brevo (tests, benchmarks)
+    MAIL_SUPPRESS_SEND = os.environ.get('MAIL_SUPPRESS_SEND') == '1'
+    CTRACK_AVATAR_PROXY = os.environ.get('CTRACK_AVATAR_PROXY') == '1'
+    CTRACK_AVATAR_CACHE_DIR = os.environ.get('CTRACK_AVATAR_CACHE_DIR') or \
+        os.path.join(base_dir, 'avatar-cache')
+
+    # werkzeug hash method and cost; older hashes are upgraded at sign-in.
+    # Hashing runs in PASSWORD_HASH_WORKERS processes (0: the request
+    # thread), at most PASSWORD_HASH_CONCURRENCY at a time per server
+    # process; see app/utils/passwords.py
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', '1'))
+    PASSWORD_HASH_CONCURRENCY = int(os.environ.get('PASSWORD_HASH_CONCURRENCY', '2'))
+    PASSWORD_HASH_WAIT_SECONDS = 5
+
+    # connection pools, see app/utils/engine.py
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '5'))
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', '10'))
+    DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', '10'))
+    DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', '1800'))
+    DB_POOL_PRE_PING = True
+    DB_STATEMENT_TIMEOUT_MS = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', '0'))
+    # the remote engine is used by the replication threads in dual_db
+    REMOTE_DB_POOL_SIZE = int(os.environ.get('REMOTE_DB_POOL_SIZE', '10'))
+    REMOTE_DB_MAX_OVERFLOW = int(os.environ.get('REMOTE_DB_MAX_OVERFLOW', '20'))
+    REMOTE_DB_POOL_TIMEOUT = int(os.environ.get('REMOTE_DB_POOL_TIMEOUT', '30'))
+    REMOTE_DB_POOL_RECYCLE = int(os.environ.get('REMOTE_DB_POOL_RECYCLE', '300'))
+    REMOTE_DB_POOL_PRE_PING = True
+    REMOTE_DB_STATEMENT_TIMEOUT_MS = int(
+        os.environ.get('REMOTE_DB_STATEMENT_TIMEOUT_MS', '15000'))
+    # collapse like/unlike flip-flops within one worker, 0 writes every
+    # click immediately; across workers the page's debounce does it
+    LIKE_COALESCE_WINDOW_MS = int(os.environ.get('LIKE_COALESCE_WINDOW_MS', '1500'))
+    # trending hashtags, see app/utils/trending.py; counts reach the
+    # database every TRENDING_FLUSH_SECONDS (0 writes them right away)
+    TRENDING_WINDOW_HOURS = int(os.environ.get('TRENDING_WINDOW_HOURS', '24'))
+    TRENDING_BUCKET_SECONDS = 900
+    TRENDING_FLUSH_SECONDS = int(os.environ.get('TRENDING_FLUSH_SECONDS', '30'))
+    TRENDING_SIZE = 5
+    # ranked feed (/feed?sort=top): scores are rescored on every like and
+    # comment and decayed every FEED_RANK_INTERVAL_SECONDS, see
+    # app/utils/ranking.py (0 leaves decay to `flask rank-feed`); only the
+    # worker holding FEED_RANK_LOCK_FILE does it
+    FEED_RANK_INTERVAL_SECONDS = int(os.environ.get('FEED_RANK_INTERVAL_SECONDS', '300'))
+    FEED_RANK_LOCK_FILE = os.environ.get('FEED_RANK_LOCK_FILE') or \
+        os.path.join(base_dir, 'feed-rank.lock')
+    # executor threads for blocking outbound calls, see app/utils/aio.py
+    BACKGROUND_WORKERS = int(os.environ.get('BACKGROUND_WORKERS', '8'))
+    # live like/comment counts over SSE, see app/utils/live.py; writes
+    # leave new counts in count_events, which each worker with open
+    # streams polls every LIVE_POLL_SECONDS
+    LIVE_HEARTBEAT_SECONDS = 15
+    LIVE_MAX_SECONDS = int(os.environ.get('LIVE_MAX_SECONDS', '300'))
+    LIVE_MAX_POSTS = 100
+    LIVE_POLL_SECONDS = float(os.environ.get('LIVE_POLL_SECONDS', '1'))
+    LIVE_EVENT_RETENTION_SECONDS = 60
+    # per-user token buckets on write views (@rate_limit) kept in 'memory'
+    # (per worker) or the 'database' (shared), and 429s from @sheds_load
+    # views while replication or email has this many jobs waiting, see
+    # app/utils/ratelimit.py
+    RATELIMIT_ENABLED = os.environ.get('RATELIMIT_ENABLED', '1') == '1'
+    RATELIMIT_STORAGE = os.environ.get('RATELIMIT_STORAGE', 'memory')
+    BACKPRESSURE_REPLICATION_HIGH_WATER = int(
+        os.environ.get('BACKPRESSURE_REPLICATION_HIGH_WATER', '500'))
+    BACKPRESSURE_EMAIL_HIGH_WATER = int(os.environ.get('BACKPRESSURE_EMAIL_HIGH_WATER', '200'))
+    BACKPRESSURE_RETRY_AFTER = 5
+    # `flask verify-replication` compares local and remote in chunks of
+    # REPLICATION_VERIFY_CHUNK rows and saves what it found for /metrics
+    REPLICATION_VERIFY_CHUNK = int(os.environ.get('REPLICATION_VERIFY_CHUNK', '500'))
+    REPLICATION_STATUS_FILE = os.environ.get('REPLICATION_STATUS_FILE') or \
+        os.path.join(base_dir, 'replication-status.json')
+    # read/write split, see app/utils/routing.py; a browser that wrote reads
+    # from the primary for READ_YOUR_WRITES_SECONDS (or PROFILE_CACHE_SECONDS
+    # if longer), past the replica and the profile cache
+    READ_REPLICA_URL = os.environ.get('READ_REPLICA_DB_URL')
+    READ_YOUR_WRITES_SECONDS = int(os.environ.get('READ_YOUR_WRITES_SECONDS', '10'))
+    # profile pages load in a fixed few queries; the part every viewer
+    # sees is kept per worker for PROFILE_CACHE_SECONDS and dropped by that
+    # worker's writes to it, see app/utils/profiles.py (0 turns it off)
+    PROFILE_CACHE_SECONDS = int(os.environ.get('PROFILE_CACHE_SECONDS', '10'))
+    PROFILE_CACHE_SIZE = 1000
+    # ETag/304 for feed and profile pages, far-future caching for
+    # fingerprinted static files, see app/utils/http_cache.py
+    CONDITIONAL_GET = os.environ.get('CONDITIONAL_GET', '1') == '1'
+    STATIC_MAX_AGE = 365 * 24 * 3600
+    # per-request SQL counts, database time and N+1 shapes, see
+    # app/utils/query_stats.py; views over QUERY_BUDGET (or their own
+    # @query_budget) are logged, or fail in strict mode
+    QUERY_STATS = os.environ.get('QUERY_STATS', '1') == '1'
+    QUERY_BUDGET = int(os.environ.get('QUERY_BUDGET', '50'))
+    QUERY_BUDGET_STRICT = False
+    QUERY_REPEAT_THRESHOLD = 5
+    QUERY_DEBUG_FOOTER = False
+    SERVER_TIMING = os.environ.get('SERVER_TIMING') == '1'
+    # /metrics, see app/utils/metrics.py; with several worker processes
+    # each writes its numbers to METRICS_DIR every METRICS_FLUSH_SECONDS
+    # (gunicorn.conf.py sets one up). Outside debug and testing /metrics
+    # answers only requests bearing METRICS_TOKEN, and 404s while it's unset
+    METRICS_DIR = os.environ.get('METRICS_DIR')
+    METRICS_FLUSH_SECONDS = int(os.environ.get('METRICS_FLUSH_SECONDS', '10'))
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    # stack-sampled profiles of slow (or randomly sampled) requests,
+    # written to PROFILER_DIR as .folded files; `flask profiler` switches
+    # it on and off at runtime, see app/utils/profiler.py
+    PROFILER_ENABLED = os.environ.get('PROFILER_ENABLED') == '1'
+    PROFILER_DIR = os.environ.get('PROFILER_DIR') or os.path.join(base_dir, 'profiles')
+    PROFILER_THRESHOLD_MS = int(os.environ.get('PROFILER_THRESHOLD_MS', '500'))
+    PROFILER_SAMPLE_RATE = float(os.environ.get('PROFILER_SAMPLE_RATE', '0'))
+    PROFILER_INTERVAL_MS = 5
+    PROFILER_MAX_FILES = 200
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64 * 1024,  # negative means KiB
+        'busy_timeout': 5000,
+        'temp_store': 'MEMORY',
+    }
 
     @staticmethod
     def init_app(app):
@@ -24,24 +142,51 @@ class Config:
 
 class DevelopmentConfig(Config):
     DEBUG = True
+    QUERY_DEBUG_FOOTER = True
+    SERVER_TIMING = True
     SQLALCHEMY_DATABASE_URI = os.environ.get('DEV_DATABASE_URL') or \
         'sqlite:///' + os.path.join(base_dir, 'data-dev.sqlite')
 
 
 class TestingConfig(Config):
     TESTING = True
+    DB_POOL_SIZE = 2
+    DB_MAX_OVERFLOW = 0
+    LIKE_COALESCE_WINDOW_MS = 0
+    LIVE_POLL_SECONDS = 0
+    MAIL_SUPPRESS_SEND = True
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
+    PASSWORD_HASH_WORKERS = 0
+    TRENDING_FLUSH_SECONDS = 0
+    FEED_RANK_INTERVAL_SECONDS = 0
+    QUERY_BUDGET_STRICT = True
+    SERVER_TIMING = True
     SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL') or \
         'sqlite://'
 
 
 class ProductionConfig(Config):
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '10'))
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', '20'))
+    DB_STATEMENT_TIMEOUT_MS = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', '10000'))
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(base_dir, 'app.db')
 
 
+class BenchmarkConfig(ProductionConfig):
+    # `flask bench`: production settings against a throwaway database;
+    # email is suppressed and the command turns replication off; the
+    # simulated users click faster than any rate limit allows
+    MAIL_SUPPRESS_SEND = True
+    RATELIMIT_ENABLED = False
+    SQLALCHEMY_DATABASE_URI = os.environ.get('BENCH_DATABASE_URL') or \
+        'sqlite:///' + os.path.join(base_dir, 'bench.sqlite')
+
+
 config = {
     'development': DevelopmentConfig,
     'testing': TestingConfig,
     'production': ProductionConfig,
+    'benchmark': BenchmarkConfig,
     'default': DevelopmentConfig
 }
@@ -1,16 +1,38 @@
+import hmac
 import os
+import sys
+import click
 from app import create_app
 from app import db
 from app.models import User, Post
-from flask import jsonify
+from flask import jsonify, request, abort, Response
 from flask_migrate import Migrate
+from app.utils.engine import pool_status
+from app.utils import metrics
 
 app = create_app(os.getenv('FLASK_CONFIG') or 'default')
 migrate = Migrate(app, db)
 
 @app.route('/system_status', methods=['GET'])
 def system_status():
-    return jsonify({'message': "System is running properly ✅"}), 200
+    return jsonify({
+        'message': "System is running properly ✅",
+        'pools': pool_status()
+    }), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    # open only while debugging or testing; everywhere else it needs the token
+    token = app.config['METRICS_TOKEN']
+    if not token:
+        if not (app.debug or app.testing):
+            abort(404)
+    elif not hmac.compare_digest(request.headers.get('Authorization', '').encode(),
+                                 f'Bearer {token}'.encode()):
+        abort(401)
+    return Response(metrics.exposition(app),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
 
 
 @app.shell_context_processor
@@ -18,5 +40,305 @@ def make_shell_context():
     return dict(db=db, User=User, Post=Post)
 
 
+@app.cli.command('audit-plans')
+@click.option('--remote', is_flag=True, help='Audit the remote database instead.')
+@click.option('--verbose', '-v', is_flag=True, help='Print every plan.')
+@click.argument('queries', nargs=-1)
+def audit_plans(remote, verbose, queries):
+    """EXPLAIN the hot queries and fail if any does a full table scan."""
+    from app.utils.plan_audit import audit
+    if remote:
+        from app.utils.services import remote_engine
+        engine = remote_engine()
+        if engine is None:
+            raise click.UsageError('REMOTE_CTRACK_DB_URL is not set')
+    else:
+        engine = db.engine
+
+    failed = False
+    for name, plan, scans in audit(engine, queries):
+        if scans:
+            failed = True
+            click.echo(f'FAIL {name}: full scan of {", ".join(scans)}')
+        else:
+            click.echo(f'ok   {name}')
+        if verbose or scans:
+            click.echo('     ' + plan.replace('\n', '\n     '))
+    sys.exit(1 if failed else 0)
+
+
+@app.cli.command('reindex-search')
+@click.option('--remote', is_flag=True, help='Reindex the remote database instead.')
+@click.option('--batch-size', default=500, show_default=True, help='Rows per transaction.')
+def reindex_search(remote, batch_size):
+    """Rebuild the search index from posts, comments and users."""
+    from app.utils.search import reindex
+    if remote:
+        from app.utils.services import remote_engine
+        engine = remote_engine()
+        if engine is None:
+            raise click.UsageError('REMOTE_CTRACK_DB_URL is not set')
+    else:
+        engine = db.engine
+
+    totals = {}
+    with engine.connect() as conn:
+        for table, rows in reindex(conn, batch_size):
+            totals[table] = totals.get(table, 0) + rows
+            click.echo(f'{table}: {totals[table]} indexed')
+    click.echo('search index rebuilt: ' + ', '.join(f'{n} {t}' for t, n in totals.items()))
+
+
+@app.cli.command('rank-feed')
+@click.option('--remote', is_flag=True, help='Only rescore the remote database.')
+def rank_feed(remote):
+    """Recompute the ranked feed's post scores once (e.g. from cron).
+
+    Rescores the primary and, when writes are replicated, the remote.
+    """
+    from app.utils.ranking import engines, recompute
+    from app.utils.services import remote_engine
+    if remote:
+        if remote_engine() is None:
+            raise click.UsageError('REMOTE_CTRACK_DB_URL is not set')
+        targets = [remote_engine()]
+    else:
+        targets = engines(app)
+
+    for engine in targets:
+        with engine.begin() as conn:
+            rescored = recompute(conn)
+        click.echo(f'rescored {rescored} posts on {engine.url}')
+
+
+@app.cli.command('verify-replication')
+@click.option('--table', 'tables', multiple=True, help='Only compare these tables.')
+@click.option('--chunk-size', type=int, help='Rows per hashed chunk [REPLICATION_VERIFY_CHUNK].')
+@click.option('--repair', is_flag=True, help='Write the local rows to the remote where they differ.')
+@click.option('--show', default=5, show_default=True, help='Keys to list per kind.')
+def verify_replication(tables, chunk_size, repair, show):
+    """Compare the local and remote databases; exits 1 while they differ.
+
+    Cheap enough for cron every few minutes: only chunks whose hashes
+    differ are read row by row.
+    """
+    from app.utils import consistency
+    from app.utils.services import remote_engine
+    remote = remote_engine()
+    if remote is None:
+        raise click.UsageError('REMOTE_CTRACK_DB_URL is not set')
+    unknown = set(tables) - set(consistency.SPECS_BY_NAME)
+    if unknown:
+        raise click.UsageError(f'unknown tables: {", ".join(sorted(unknown))}')
+    chunk_size = chunk_size or app.config['REPLICATION_VERIFY_CHUNK']
+
+    with db.engine.connect() as local, remote.connect() as remote_conn:
+        reports = consistency.verify(local, remote_conn, tables, chunk_size)
+        for report in reports:
+            counts = report.as_dict()
+            click.echo(f"{'ok  ' if report.consistent else 'DIFF'} {report.name}: "
+                       f"{counts['local_rows']} local, {counts['remote_rows']} remote, "
+                       f"{counts['mismatched_chunks']}/{counts['chunks']} chunks differ")
+            for kind in ('missing', 'extra', 'differing'):
+                keys = getattr(report, kind)
+                if keys:
+                    more = f' (+{len(keys) - show} more)' if len(keys) > show else ''
+                    click.echo(f'     {kind}: {", ".join(map(str, keys[:show]))}{more}')
+            if report.oldest_missing:
+                click.echo(f'     oldest missing row written {report.oldest_missing}')
+
+        if repair and not all(report.consistent for report in reports):
+            written = consistency.repair(local, remote_conn, reports)
+            remote_conn.commit()
+            click.echo(f'repaired {written} rows on the remote; checking again')
+            reports = consistency.verify(local, remote_conn, tables, chunk_size)
+
+    consistency.save_status(app.config['REPLICATION_STATUS_FILE'], reports)
+    sys.exit(0 if all(report.consistent for report in reports) else 1)
+
+
+@app.cli.command('bench')
+@click.option('--seed/--no-seed', 'reseed', default=True, show_default=True,
+              help='Recreate and fill the benchmark database first.')
+@click.option('--users', default=200, show_default=True)
+@click.option('--follows', default=20, show_default=True, help='Follows per user.')
+@click.option('--posts', default=2000, show_default=True)
+@click.option('--likes', default=5, show_default=True, help='Likes per post.')
+@click.option('--comments', default=2, show_default=True, help='Comments per post.')
+@click.option('--requests', 'per_journey', default=100, show_default=True,
+              help='Test client requests per journey.')
+@click.option('--http-requests', default=1000, show_default=True,
+              help='Requests of the concurrent HTTP load (0 skips it).')
+@click.option('--concurrency', default=16, show_default=True)
+@click.option('--url', help='Load this server instead of an in-process one.')
+@click.option('--journey', 'journeys', multiple=True, help='Only run these journeys.')
+@click.option('--save', type=click.Path(dir_okay=False), help='Write the results as JSON.')
+@click.option('--compare', type=click.Path(exists=True, dir_okay=False),
+              help='Baseline JSON to compare with; exits 1 on a regression.')
+@click.option('--tolerance', default=0.2, show_default=True,
+              help='Allowed p95/throughput change before it counts as a regression.')
+@click.option('--random-seed', default=1, show_default=True)
+def bench(reseed, users, follows, posts, likes, comments, per_journey, http_requests,
+          concurrency, url, journeys, save, compare, tolerance, random_seed):
+    """Benchmark the main user journeys against a seeded database.
+
+    Uses FLASK_CONFIG=benchmark whatever the current config, so only the
+    BENCH_DATABASE_URL database (default bench.sqlite) is ever written.
+    """
+    import json
+    import logging
+    import random
+    from app.utils import bench as harness, services
+
+    # benchmark writes must never reach the remote database
+    services.REMOTE_DB_URL = None
+    bench_app = create_app('benchmark')
+    harness.count_queries(bench_app)
+    # the per-request N+1 warnings would drown the report
+    logging.getLogger('app.utils.query_stats').setLevel(logging.ERROR)
+    rng = random.Random(random_seed)
+
+    volumes = dict(users=users, follows=follows, posts=posts, likes=likes, comments=comments)
+    if reseed:
+        volumes = harness.seed(bench_app, rng=rng, **volumes)
+        click.echo('seeded ' + ', '.join(f'{n} {name}' for name, n in volumes.items()))
+    fixture = harness.Fixture(bench_app, rng)
+
+    results = {'environment': harness.environment(bench_app, volumes)}
+    results['sequential'] = harness.run_sequential(bench_app, fixture, per_journey, journeys)
+    click.echo(harness.format_report('sequential (test client)', results['sequential']))
+    if http_requests:
+        results['concurrent'] = harness.run_concurrent(
+            bench_app, fixture, http_requests, concurrency, url, journeys)
+        click.echo(harness.format_report(
+            f'concurrent (HTTP, {concurrency} clients)', results['concurrent']))
+
+    if save:
+        harness.save(save, results)
+        click.echo(f'results saved to {save}')
+    if compare:
+        with open(compare) as f:
+            regressions = harness.compare(json.load(f), results, tolerance)
+        for line in regressions:
+            click.echo(f'REGRESSION {line}')
+        if regressions:
+            sys.exit(1)
+        click.echo(f'no regressions against {compare}')
+
+
+@app.cli.command('import-data')
+@click.option('--users', 'users_path', type=click.Path(exists=True, dir_okay=False),
+              help='CSV/JSONL: username, email, password or password_hash, name, ...')
+@click.option('--follows', 'follows_path', type=click.Path(exists=True, dir_okay=False),
+              help='CSV/JSONL: follower, followed (usernames).')
+@click.option('--posts', 'posts_path', type=click.Path(exists=True, dir_okay=False),
+              help='CSV/JSONL: author (username), body, timestamp, featured.')
+@click.option('--generate-users', default=0, show_default=True,
+              help='Also generate this many users (<prefix><n>).')
+@click.option('--generate-follows', default=0, show_default=True,
+              help='Follows per generated user, among the generated users.')
+@click.option('--generate-posts', default=0, show_default=True,
+              help='Posts by the generated users.')
+@click.option('--prefix', default='user', show_default=True, help='Generated usernames.')
+@click.option('--export', type=click.Path(file_okay=False),
+              help='Write the generated data here as JSONL instead of importing it.')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows per transaction.')
+@click.option('--workers', type=int, help='Processes hashing passwords and rendering '
+              'posts, 0 for none [CPU count].')
+@click.option('--no-remote', is_flag=True, help="Don't replicate to the remote database.")
+@click.option('--random-seed', default=1, show_default=True)
+def import_data(users_path, follows_path, posts_path, generate_users, generate_follows,
+                generate_posts, prefix, export, batch_size, workers, no_remote, random_seed):
+    """Bulk-load users, then follows, then posts, from files or generated.
+
+    Each batch is one executemany and one commit, replayed on the remote
+    in a transaction of its own. Existing usernames and emails, and users
+    with neither a password nor a password_hash, are skipped.
+    """
+    import itertools
+    import random
+    from app.utils import bulk_import
+    from app.utils.services import remote_engine
+    if (generate_follows or generate_posts) and not generate_users:
+        raise click.UsageError('--generate-follows/--generate-posts need --generate-users')
+
+    rng = random.Random(random_seed)
+    sources = {'users': [], 'follows': [], 'posts': []}
+    for kind, path in (('users', users_path), ('follows', follows_path), ('posts', posts_path)):
+        if path:
+            sources[kind].append(bulk_import.read_rows(path))
+    if generate_users:
+        usernames = [f'{prefix}{i}' for i in range(generate_users)]
+        sources['users'].append(bulk_import.generate_users(generate_users, prefix))
+        if generate_follows:
+            sources['follows'].append(
+                bulk_import.generate_follows(usernames, generate_follows, rng))
+        if generate_posts:
+            sources['posts'].append(bulk_import.generate_posts(generate_posts, usernames, rng))
+    if not any(sources.values()):
+        raise click.UsageError('nothing to import: give files or --generate-users')
+
+    if export:
+        os.makedirs(export, exist_ok=True)
+        for kind, streams in sources.items():
+            if streams:
+                path = os.path.join(export, f'{kind}.jsonl')
+                count = bulk_import.write_rows(path, itertools.chain(*streams))
+                click.echo(f'{kind}: {count} rows written to {path}')
+        return
+
+    remote = None if no_remote else remote_engine()
+    with db.engine.connect() as conn:
+        importer = bulk_import.Importer(conn, remote, workers, batch_size,
+                                        app.config['PASSWORD_HASH_METHOD'])
+        try:
+            for kind, streams in sources.items():
+                if not streams:
+                    continue
+                imported = skipped = 0
+                for done, left_out in getattr(importer, kind)(itertools.chain(*streams)):
+                    imported += done
+                    skipped += left_out
+                    click.echo(f'{kind}: {imported} imported, {skipped} skipped')
+            click.echo('ranking posts' + (' and waiting for the remote' if remote else ''))
+            importer.finish()
+        finally:
+            importer.close()
+    click.echo('import done')
+
+
+@app.cli.command('profiler')
+@click.argument('action', type=click.Choice(['on', 'off', 'status']), default='status')
+@click.option('--threshold-ms', type=int, help='Profile requests slower than this.')
+@click.option('--sample-rate', type=float, help='Also profile this share of all requests.')
+def profiler(action, threshold_ms, sample_rate):
+    """Switch request profiling on or off in every running worker."""
+    from app.utils.profiler import read_settings, write_settings, list_profiles
+    if action == 'status' and threshold_ms is None and sample_rate is None:
+        settings = read_settings(app)
+    else:
+        enabled = {'on': True, 'off': False}.get(action)
+        settings = write_settings(app, enabled=enabled, threshold_ms=threshold_ms,
+                                  sample_rate=sample_rate)
+    click.echo(f"profiler {'on' if settings['enabled'] else 'off'}: requests over "
+               f"{settings['threshold_ms']} ms, sample rate {settings['sample_rate']}")
+    profiles = list_profiles(app.config['PROFILER_DIR'])
+    click.echo(f"{len(profiles)} profiles in {app.config['PROFILER_DIR']}")
+    for path in profiles[-5:]:
+        click.echo(f'  {os.path.basename(path)}')
+
+
+@app.cli.command('import-profile')
+@click.option('--module', default='ctrack', show_default=True, help='Module to import.')
+@click.option('--top', default=15, show_default=True, help='Subsystems to list.')
+def import_profile(module, top):
+    """Show import time per subsystem, measured in a fresh interpreter."""
+    from app.utils.importtime import import_profile
+    totals = import_profile(module)
+    for name, us in sorted(totals.items(), key=lambda item: -item[1])[:top]:
+        click.echo(f'{us / 1000:8.1f} ms  {name}')
+    click.echo(f'{sum(totals.values()) / 1000:8.1f} ms  total')
+
+
 if __name__ == '__main__':
     app.run()
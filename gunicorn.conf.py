@@ -0,0 +1,81 @@
+"""Production server settings; start with `gunicorn` from the repo root.
+
+Over Postgres workers are gevent's: every request is a greenlet, so the
+SSE streams of open pages (one each, for minutes) and slow uploads cost a
+worker little and never hold up other requests. SQLite calls can't yield,
+so a wait on its write lock would stall a whole gevent worker; over SQLite
+(the default database) workers are gthread. The app is preloaded and
+shared copy-on-write, and the hooks below reopen pools in each worker and
+drain deferred writes on the way out.
+"""
+import multiprocessing
+import os
+import tempfile
+from config import config as app_configs
+
+wsgi_app = 'ctrack:app'
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+
+# the primary database the app will use, read without importing the app
+database_url = app_configs[os.getenv('FLASK_CONFIG') or 'default'].SQLALCHEMY_DATABASE_URI
+on_postgres = database_url.startswith(('postgres://', 'postgresql'))
+
+workers = int(os.environ.get('WEB_CONCURRENCY', min(multiprocessing.cpu_count() * 2 + 1, 8)))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS') or ('gevent' if on_postgres else 'gthread')
+# concurrent requests and streams per gevent worker; idle streams hold no
+# database connection, requests past DB_POOL_SIZE + DB_MAX_OVERFLOW wait
+# for one
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', '2000'))
+# threads per gthread worker
+threads = int(os.environ.get('GUNICORN_THREADS', '16'))
+preload_app = True
+
+if worker_class == 'gevent':
+    # patch before the app is preloaded, so the locks, threads and sockets
+    # it creates at import are gevent's; psycopg2 then waits on Postgres
+    # without blocking the worker
+    from gevent import monkey
+    monkey.patch_all()
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+# recycle workers now and then, staggered so they don't all restart at once
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', '1000'))
+max_requests_jitter = max_requests // 10
+timeout = 60
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', '30'))
+keepalive = 5
+
+accesslog = '-'
+errorlog = '-'
+
+# workers write their metrics here for /metrics to add up; a fresh
+# directory per start, so counters of a previous run don't linger
+os.environ.setdefault('METRICS_DIR', tempfile.mkdtemp(prefix='ctrack-metrics-'))
+
+
+def on_starting(server):
+    if worker_class == 'gevent' and not on_postgres:
+        server.log.warning('gevent workers over %s: every SQLite call, and any wait on '
+                           'its write lock, blocks the whole worker; use gthread',
+                           database_url.split(':', 1)[0])
+
+
+def post_fork(server, worker):
+    from ctrack import app
+    from app.utils.lifecycle import after_fork
+    after_fork(app)
+
+
+def worker_exit(server, worker):
+    from ctrack import app
+    from app.utils.lifecycle import drain
+    left = drain(app, timeout=graceful_timeout / 2)
+    if left:
+        server.log.warning('worker %s exited with %d background tasks unfinished',
+                           worker.pid, left)
+
+
+def child_exit(server, worker):
+    from app.utils.metrics import mark_process_dead
+    mark_process_dead(worker.pid, os.environ['METRICS_DIR'])
@@ -0,0 +1,31 @@
+"""post like_count
+
+Revision ID: 3c8e5f0b7a14
+Revises: 9a41c7e05d22
+Create Date: 2026-10-19 12:20:05.774912
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c8e5f0b7a14'
+down_revision = '9a41c7e05d22'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('posts', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('like_count', sa.Integer(), nullable=False, server_default='0'))
+
+    op.execute(
+        'UPDATE posts SET like_count = '
+        '(SELECT COUNT(*) FROM likes WHERE likes.post_id = posts.id)'
+    )
+
+
+def downgrade():
+    with op.batch_alter_table('posts', schema=None) as batch_op:
+        batch_op.drop_column('like_count')
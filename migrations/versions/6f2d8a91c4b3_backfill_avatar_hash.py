@@ -0,0 +1,52 @@
+"""backfill avatar_hash
+
+Revision ID: 6f2d8a91c4b3
+Revises: b25c8f6b7814
+Create Date: 2026-10-19 10:12:31.402118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import hashlib
+
+
+# revision identifiers, used by Alembic.
+revision = '6f2d8a91c4b3'
+down_revision = 'b25c8f6b7814'
+branch_labels = None
+depends_on = None
+
+
+users = sa.table(
+    'users',
+    sa.column('id', sa.Integer),
+    sa.column('email', sa.String),
+    sa.column('avatar_hash', sa.String),
+)
+
+
+def upgrade():
+    conn = op.get_bind()
+    rows = conn.execute(
+        sa.select(users.c.id, users.c.email).where(
+            users.c.avatar_hash.is_(None), users.c.email.isnot(None))
+    ).fetchall()
+    if rows:
+        conn.execute(
+            users.update()
+            .where(users.c.id == sa.bindparam('user_id'))
+            .values(avatar_hash=sa.bindparam('hash')),
+            [
+                {
+                    'user_id': row.id,
+                    'hash': hashlib.md5(row.email.lower().encode('utf-8'),
+                                        usedforsecurity=False).hexdigest()
+                }
+                for row in rows
+            ]
+        )
+
+
+def downgrade():
+    # avatar_hash is derived from email, nothing to undo
+    pass
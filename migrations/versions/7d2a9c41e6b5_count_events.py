@@ -0,0 +1,37 @@
+"""count events
+
+Revision ID: 7d2a9c41e6b5
+Revises: c3e71b5a90d4
+Create Date: 2026-10-19 21:12:48.530194
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7d2a9c41e6b5'
+down_revision = 'c3e71b5a90d4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # like/comment counts on their way to the live streams of every worker
+    op.create_table('count_events',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.Column('likes', sa.Integer(), nullable=True),
+    sa.Column('comments', sa.Integer(), nullable=True),
+    sa.Column('created', sa.Float(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('count_events', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_count_events_created'), ['created'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('count_events', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_count_events_created'))
+
+    op.drop_table('count_events')
@@ -0,0 +1,107 @@
+"""post tags and mentions
+
+Revision ID: 7d3a9c51e8f2
+Revises: e4b19c7d2a60
+Create Date: 2026-10-19 15:02:47.190264
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from app.utils.tags import extract_tags, extract_mentions
+
+
+# revision identifiers, used by Alembic.
+revision = '7d3a9c51e8f2'
+down_revision = 'e4b19c7d2a60'
+branch_labels = None
+depends_on = None
+
+
+posts = sa.table(
+    'posts',
+    sa.column('id', sa.Integer),
+    sa.column('body', sa.Text),
+    sa.column('timestamp', sa.DateTime),
+)
+users = sa.table(
+    'users',
+    sa.column('id', sa.Integer),
+    sa.column('username', sa.String),
+)
+BATCH_SIZE = 500
+
+
+def upgrade():
+    op.create_table('post_tags',
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.Column('tag', sa.String(length=64), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['post_id'], ['posts.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('post_id', 'tag')
+    )
+    with op.batch_alter_table('post_tags', schema=None) as batch_op:
+        batch_op.create_index('ix_post_tags_tag_timestamp_post_id', ['tag', 'timestamp', 'post_id'], unique=False)
+
+    op.create_table('post_mentions',
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['post_id'], ['posts.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('post_id', 'user_id')
+    )
+    with op.batch_alter_table('post_mentions', schema=None) as batch_op:
+        batch_op.create_index('ix_post_mentions_user_id_timestamp_post_id', ['user_id', 'timestamp', 'post_id'], unique=False)
+
+    op.create_table('tag_trends',
+    sa.Column('tag', sa.String(length=64), nullable=False),
+    sa.Column('bucket', sa.DateTime(), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('tag', 'bucket')
+    )
+    with op.batch_alter_table('tag_trends', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_tag_trends_bucket'), ['bucket'], unique=False)
+
+    # tag what is already posted, a batch of posts at a time
+    conn = op.get_bind()
+    post_tags = sa.table('post_tags', sa.column('post_id'), sa.column('tag'), sa.column('timestamp'))
+    post_mentions = sa.table('post_mentions', sa.column('post_id'), sa.column('user_id'), sa.column('timestamp'))
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            sa.select(posts.c.id, posts.c.body, posts.c.timestamp)
+            .where(posts.c.id > last_id, posts.c.timestamp.isnot(None))
+            .order_by(posts.c.id).limit(BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+        names = {name for row in rows for name in extract_mentions(row.body)}
+        user_ids = dict(conn.execute(
+            sa.select(users.c.username, users.c.id).where(users.c.username.in_(names))
+        ).all()) if names else {}
+        tags, mentions = [], []
+        for row in rows:
+            tags += [dict(post_id=row.id, tag=tag, timestamp=row.timestamp)
+                     for tag in extract_tags(row.body)]
+            mentions += [dict(post_id=row.id, user_id=user_ids[name], timestamp=row.timestamp)
+                         for name in extract_mentions(row.body) if name in user_ids]
+        if tags:
+            conn.execute(post_tags.insert(), tags)
+        if mentions:
+            conn.execute(post_mentions.insert(), mentions)
+        last_id = rows[-1].id
+
+
+def downgrade():
+    with op.batch_alter_table('tag_trends', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_tag_trends_bucket'))
+
+    op.drop_table('tag_trends')
+    with op.batch_alter_table('post_mentions', schema=None) as batch_op:
+        batch_op.drop_index('ix_post_mentions_user_id_timestamp_post_id')
+
+    op.drop_table('post_mentions')
+    with op.batch_alter_table('post_tags', schema=None) as batch_op:
+        batch_op.drop_index('ix_post_tags_tag_timestamp_post_id')
+
+    op.drop_table('post_tags')
@@ -0,0 +1,54 @@
+"""feed and lookup indexes
+
+Revision ID: 9a41c7e05d22
+Revises: 6f2d8a91c4b3
+Create Date: 2026-10-19 11:03:47.118530
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a41c7e05d22'
+down_revision = '6f2d8a91c4b3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # keep the oldest like of each (author, post) pair before enforcing uniqueness
+    op.execute(
+        'DELETE FROM likes WHERE id NOT IN '
+        '(SELECT min_id FROM (SELECT MIN(id) AS min_id FROM likes '
+        'GROUP BY author_id, post_id) AS keep)'
+    )
+    with op.batch_alter_table('likes', schema=None) as batch_op:
+        batch_op.create_index('uq_likes_author_id_post_id', ['author_id', 'post_id'], unique=True)
+        batch_op.create_index('ix_likes_post_id', ['post_id'], unique=False)
+
+    with op.batch_alter_table('posts', schema=None) as batch_op:
+        batch_op.create_index('ix_posts_timestamp_id', ['timestamp', 'id'], unique=False)
+        batch_op.create_index('ix_posts_author_id_timestamp_id', ['author_id', 'timestamp', 'id'], unique=False)
+
+    with op.batch_alter_table('comments', schema=None) as batch_op:
+        batch_op.create_index('ix_comments_post_id_timestamp', ['post_id', 'timestamp'], unique=False)
+
+    with op.batch_alter_table('follows', schema=None) as batch_op:
+        batch_op.create_index('ix_follows_followed_id', ['followed_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('follows', schema=None) as batch_op:
+        batch_op.drop_index('ix_follows_followed_id')
+
+    with op.batch_alter_table('comments', schema=None) as batch_op:
+        batch_op.drop_index('ix_comments_post_id_timestamp')
+
+    with op.batch_alter_table('posts', schema=None) as batch_op:
+        batch_op.drop_index('ix_posts_author_id_timestamp_id')
+        batch_op.drop_index('ix_posts_timestamp_id')
+
+    with op.batch_alter_table('likes', schema=None) as batch_op:
+        batch_op.drop_index('ix_likes_post_id')
+        batch_op.drop_index('uq_likes_author_id_post_id')
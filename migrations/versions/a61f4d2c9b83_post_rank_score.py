@@ -0,0 +1,29 @@
+"""post rank_score
+
+Revision ID: a61f4d2c9b83
+Revises: 7d3a9c51e8f2
+Create Date: 2026-10-19 16:18:09.553871
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a61f4d2c9b83'
+down_revision = '7d3a9c51e8f2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # filled in by the app's feed ranker, or `flask rank-feed`
+    with op.batch_alter_table('posts', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('rank_score', sa.Float(), nullable=False, server_default='0'))
+        batch_op.create_index('ix_posts_rank_score_id', ['rank_score', 'id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('posts', schema=None) as batch_op:
+        batch_op.drop_index('ix_posts_rank_score_id')
+        batch_op.drop_column('rank_score')
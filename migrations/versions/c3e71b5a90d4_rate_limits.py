@@ -0,0 +1,34 @@
+"""rate limits
+
+Revision ID: c3e71b5a90d4
+Revises: a61f4d2c9b83
+Create Date: 2026-10-19 18:41:27.306518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3e71b5a90d4'
+down_revision = 'a61f4d2c9b83'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # token buckets shared by all workers when RATELIMIT_STORAGE is 'database'
+    op.create_table('rate_limits',
+    sa.Column('key', sa.String(length=128), nullable=False),
+    sa.Column('full_at', sa.Float(), nullable=False),
+    sa.PrimaryKeyConstraint('key')
+    )
+    with op.batch_alter_table('rate_limits', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_rate_limits_full_at'), ['full_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('rate_limits', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_rate_limits_full_at'))
+
+    op.drop_table('rate_limits')
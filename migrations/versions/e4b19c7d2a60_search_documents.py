@@ -0,0 +1,86 @@
+"""search documents
+
+Revision ID: e4b19c7d2a60
+Revises: 3c8e5f0b7a14
+Create Date: 2026-10-19 13:41:22.508316
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4b19c7d2a60'
+down_revision = '3c8e5f0b7a14'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('search_documents',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('kind', sa.String(length=8), nullable=False),
+    sa.Column('doc_id', sa.Integer(), nullable=False),
+    sa.Column('body', sa.Text(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('search_documents', schema=None) as batch_op:
+        batch_op.create_index('uq_search_documents_kind_doc_id', ['kind', 'doc_id'], unique=True)
+
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute(
+            "CREATE VIRTUAL TABLE search_fts USING fts5("
+            "body, content='search_documents', content_rowid='id', "
+            "tokenize='unicode61 remove_diacritics 2')"
+        )
+        op.execute(
+            "CREATE TRIGGER search_documents_ai AFTER INSERT ON search_documents BEGIN "
+            "INSERT INTO search_fts(rowid, body) VALUES (new.id, new.body); END"
+        )
+        op.execute(
+            "CREATE TRIGGER search_documents_ad AFTER DELETE ON search_documents BEGIN "
+            "INSERT INTO search_fts(search_fts, rowid, body) VALUES ('delete', old.id, old.body); END"
+        )
+        op.execute(
+            "CREATE TRIGGER search_documents_au AFTER UPDATE ON search_documents BEGIN "
+            "INSERT INTO search_fts(search_fts, rowid, body) VALUES ('delete', old.id, old.body); "
+            "INSERT INTO search_fts(rowid, body) VALUES (new.id, new.body); END"
+        )
+    elif dialect == 'postgresql':
+        op.execute(
+            "CREATE INDEX ix_search_documents_tsv ON search_documents "
+            "USING GIN (to_tsvector('simple', body))"
+        )
+
+    # index what already exists (on SQLite the triggers fill search_fts)
+    op.execute(
+        "INSERT INTO search_documents (kind, doc_id, body, timestamp) "
+        "SELECT 'post', id, COALESCE(body, ''), timestamp FROM posts"
+    )
+    op.execute(
+        "INSERT INTO search_documents (kind, doc_id, body, timestamp) "
+        "SELECT 'comment', id, COALESCE(body, ''), timestamp FROM comments"
+    )
+    op.execute(
+        "INSERT INTO search_documents (kind, doc_id, body, timestamp) "
+        "SELECT 'user', id, TRIM(COALESCE(name, '') || ' ' || COALESCE(username, '') || ' ' "
+        "|| COALESCE(headline, '') || ' ' || COALESCE(talks_about, '')), member_since FROM users"
+    )
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute("DROP TRIGGER IF EXISTS search_documents_au")
+        op.execute("DROP TRIGGER IF EXISTS search_documents_ad")
+        op.execute("DROP TRIGGER IF EXISTS search_documents_ai")
+        op.execute("DROP TABLE IF EXISTS search_fts")
+    elif dialect == 'postgresql':
+        op.execute("DROP INDEX IF EXISTS ix_search_documents_tsv")
+
+    with op.batch_alter_table('search_documents', schema=None) as batch_op:
+        batch_op.drop_index('uq_search_documents_kind_doc_id')
+
+    op.drop_table('search_documents')
@@ -0,0 +1,41 @@
+import unittest
+from app import create_app, db
+from app.models import User
+from app.utils.query_stats import query_budget, QueryBudgetExceeded
+
+
+class QueryBudgetTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+
+        @query_budget(2)
+        def three_queries():
+            for _ in range(3):
+                User.query.count()
+            return 'ok'
+
+        @query_budget(3)
+        def within_budget():
+            for _ in range(3):
+                User.query.count()
+            return 'ok'
+
+        self.app.add_url_rule('/three-queries', view_func=three_queries)
+        self.app.add_url_rule('/within-budget', view_func=within_budget)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_over_budget_fails_when_testing(self):
+        with self.assertRaises(QueryBudgetExceeded):
+            self.client.get('/three-queries')
+
+    def test_within_budget_passes(self):
+        response = self.client.get('/within-budget')
+        self.assertEqual(response.status_code, 200)